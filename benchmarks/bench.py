@@ -0,0 +1,247 @@
+'''
+Measures BRICK's own overhead and throughput with a stand-in AZURE2
+executable (fake_azure2.py), so the numbers are reproducible on machines
+without AZURE2.
+
+Synthetic problems are generated for every combination of level-group count
+and data-segment count. For each problem the script times predict,
+extrapolate and reaction_rate (median over --repeat calls), and the
+throughput of batches of predictions over multiprocessing Pools with the
+requested worker counts. All metrics are in seconds (per call or per
+evaluation), so lower is better. The azure2 metric is the cost of the
+stand-in executable alone; BRICK's overhead per call is predict - azure2.
+
+Usage (from this directory, with brick installed):
+    python bench.py
+    python bench.py --save-baseline baseline.json
+    python bench.py --baseline baseline.json --tolerance 0.2
+
+With --baseline, every metric that is slower than the baseline by more than
+the tolerance is reported, and the script exits with status 1.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from multiprocessing import Pool
+
+import numpy as np
+
+from brick import utility
+from brick.azr import AZR
+
+FAKE_AZURE2 = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fake_azure2.py')
+
+CONFIG = '''<config>
+true
+output/
+checks/
+none
+none
+none
+none
+none
+none
+none
+none
+</config>'''
+
+# A level group of 12C+p.azr: a proton channel and a capture channel.
+LEVEL_ROWS = [
+    ' 0.5    1       2.3689    0    1    1    1    0    2    1    0             34963.2  0.5    1    0    1            0 1.00728      12    1    6      1.94351      1.94351    0    0          0.0     0     3.4       5.5857            0       0',
+    ' 0.5    1       2.3689    0    1    2    1    2    2    1    0           -0.609648    1    1  0.5   -1            0       0      13    0    7      1.94351            0    0    0          0.0    10       0            0            0       7'
+]
+
+FOOTER = '''<targetInt>
+</targetInt>
+<lastRun>
+0
+""
+""
+1 1
+0 ""
+1 1 0
+</lastRun>'''
+
+
+def make_problem(directory, nlevels, nsegments, npoints=50):
+    '''
+    Writes a synthetic .azr file (and its data files) with nlevels level
+    groups and nsegments data segments of npoints points each.
+    Returns the .azr filename (relative to directory).
+    '''
+    os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+    rng = np.random.default_rng(0)
+
+    levels = []
+    for (i, e) in enumerate(np.linspace(2, 6, nlevels)):
+        for row in LEVEL_ROWS:
+            row = row.split()
+            row[0] = str(0.5 + i)
+            row[2] = f'{e:.4f}'
+            levels.append('  '.join(row))
+        levels.append('')
+
+    segments = []
+    for i in range(nsegments):
+        filename = f'data/segment_{i}.dat'
+        energies = np.sort(rng.uniform(0.2, 3, npoints))
+        xs = 1e-8 * (1 + rng.uniform(size=npoints))
+        np.savetxt(os.path.join(directory, filename),
+                   np.column_stack((energies, 90*np.ones(npoints), xs, 0.1*xs)))
+        segments.append(f'1 1 2 0 10 0 180 0 1 {int(i < 2)} 10 {filename}')
+
+    contents = [CONFIG, '<levels>'] + levels + ['</levels>',
+        '<segmentsData>'] + segments + ['</segmentsData>', '<segmentsTest>',
+        '1 1 2 0.1 3.0 0.01 0 0 0 0', '</segmentsTest>', FOOTER]
+
+    input_filename = f'bench_{nlevels}_{nsegments}.azr'
+    with open(os.path.join(directory, input_filename), 'w') as f:
+        f.write('\n'.join(contents) + '\n')
+    return input_filename
+
+
+def median_time(f, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+_azr = None
+
+def _init_worker(azr):
+    global _azr
+    _azr = azr
+
+
+def _predict(theta):
+    return _azr.predict(theta, dress_up=False)
+
+
+def benchmark_problem(input_filename, workers, repeat, nbatch):
+    azr = AZR(input_filename)
+    azr.command = FAKE_AZURE2
+    theta = np.array(azr.config.get_input_values())
+    temperatures = np.linspace(0.01, 1, 50)
+
+    # Cost of the stand-in AZURE2 alone, so that BRICK's overhead can be
+    # read off as (predict - azure2).
+    workspace = azr.config.generate_workspace(theta)
+    workspace_input, output_dir, data_dir = workspace
+    results = {}
+    results['azure2'] = median_time(
+        lambda: utility.run_AZURE2(workspace_input, command=FAKE_AZURE2),
+        repeat)
+    shutil.rmtree(output_dir)
+    shutil.rmtree(data_dir)
+    os.remove(workspace_input)
+
+    results['predict'] = median_time(lambda: azr.predict(theta), repeat)
+    results['extrapolate'] = median_time(lambda: azr.extrapolate(theta),
+                                         repeat)
+    results['reaction_rate'] = median_time(
+        lambda: azr.reaction_rate(theta, 1, 2, temperatures), repeat)
+
+    thetas = [theta * (1 + 1e-3*i) for i in range(nbatch)]
+    for n in workers:
+        with Pool(processes=n, initializer=_init_worker,
+                  initargs=(azr,)) as pool:
+            pool.map(_predict, thetas[:n]) # warm up
+            start = time.perf_counter()
+            pool.map(_predict, thetas)
+            elapsed = time.perf_counter() - start
+        results[f'batch_per_eval[workers={n}]'] = elapsed / nbatch
+
+    return results
+
+
+def run(levels, segments, workers, repeat, nbatch):
+    '''
+    Runs the benchmarks in a temporary directory and returns a dictionary of
+    metric name -> seconds.
+    '''
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='brick_bench_')
+    results = {}
+    try:
+        os.chdir(directory)
+        for nl in levels:
+            for ns in segments:
+                input_filename = make_problem(directory, nl, ns)
+                problem = benchmark_problem(input_filename, workers, repeat,
+                                            nbatch)
+                for (name, value) in problem.items():
+                    results[f'{name}[levels={nl},segments={ns}]'] = value
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns a list of (metric, baseline, current) for every metric that is
+    slower than its baseline value by more than the (fractional) tolerance.
+    '''
+    regressions = []
+    for (name, value) in results.items():
+        if name in baseline and value > baseline[name] * (1 + tolerance):
+            regressions.append((name, baseline[name], value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--levels', type=int, nargs='+', default=[2, 8])
+    parser.add_argument('--segments', type=int, nargs='+', default=[2, 16])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--batch', type=int, default=32,
+                        help='number of thetas per batch')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='seconds the stand-in AZURE2 sleeps per run')
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    os.environ['FAKE_AZURE2_DELAY'] = str(args.delay)
+    os.environ['OMP_NUM_THREADS'] = '1'
+
+    results = run(args.levels, args.segments, args.workers, args.repeat,
+                  args.batch)
+
+    width = max(len(name) for name in results)
+    for (name, value) in results.items():
+        print(f'{name:<{width}}  {value*1e3:10.3f} ms')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s) (tolerance '
+                  f'{args.tolerance:.0%}):')
+            for (name, before, after) in regressions:
+                print(f'  {name}: {before*1e3:.3f} ms -> {after*1e3:.3f} ms')
+            return 1
+        print('\nNo regressions.')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
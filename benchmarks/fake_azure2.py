@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+'''
+Stand-in for the AZURE2 executable.
+
+It understands the same command line (input file, --no-gui, --no-readline,
+--use-brune, --gsl-coul) and stdin menu choices that BRICK uses:
+    1 : calculate the data segments
+    3 : extrapolate the test segments
+    5 : calculate a reaction rate
+and writes correctly shaped output files (AZUREOut_*.out, AZUREOut_*.extrap,
+parameters.out, intEC.dat and reactionrates.out) to the output directory of
+the input file. The "physics" is a cheap sum of Breit-Wigner-like terms, so
+the output changes with the level parameters (and the data columns are
+scaled by the normalization factors, like AZURE2 does).
+
+Environment variables:
+    FAKE_AZURE2_DELAY : seconds to sleep per run (default 0) to emulate the
+                        cost of the R-matrix calculation
+'''
+
+import os
+import sys
+import time
+import numpy as np
+
+J_INDEX = 0
+PI_INDEX = 1
+ENERGY_INDEX = 2
+CHANNEL_INDEX = 5
+WIDTH_INDEX = 11
+LIGHT_MASS_INDEX = 17
+HEAVY_MASS_INDEX = 18
+LIGHT_CHARGE_INDEX = 19
+HEAVY_CHARGE_INDEX = 20
+
+INCLUDE_INDEX = 0
+IN_CHANNEL_INDEX = 1
+OUT_CHANNEL_INDEX = 2
+REACTION_TYPE = 7
+NORM_FACTOR_INDEX = 8
+FILEPATH_INDEX = 11
+
+
+def section(contents, name):
+    start = contents.index(f'<{name}>')+1
+    stop = contents.index(f'</{name}>')
+    return contents[start:stop]
+
+
+def read_levels(contents):
+    groups = []
+    group = []
+    for row in section(contents, 'levels'):
+        if row.strip() == '':
+            if group:
+                groups.append(group)
+            group = []
+        else:
+            group.append(row.split())
+    if group:
+        groups.append(group)
+    return groups
+
+
+def model(energies, groups):
+    '''
+    Cheap stand-in for an R-matrix cross section (b).
+    '''
+    xs = np.zeros_like(energies)
+    for group in groups:
+        e_level = float(group[0][ENERGY_INDEX])
+        widths = np.array([float(row[WIDTH_INDEX]) for row in group])
+        if not np.all(np.isfinite(widths)) or not np.isfinite(e_level):
+            raise ValueError('Bad level parameters.')
+        strength = np.sqrt(np.sum(widths**2))
+        xs += 1e-9 * strength / ((energies - e_level)**2 + 0.01)
+    return xs
+
+
+def pair_properties(groups, pair):
+    for group in groups:
+        for row in group:
+            if int(row[CHANNEL_INDEX]) == pair:
+                m1 = float(row[LIGHT_MASS_INDEX])
+                m2 = float(row[HEAVY_MASS_INDEX])
+                return (m1*m2/(m1 + m2), float(row[LIGHT_CHARGE_INDEX]),
+                        float(row[HEAVY_CHARGE_INDEX]))
+    raise ValueError(f'Unknown particle pair {pair}.')
+
+
+def sfactor(energies, xs, groups, pair):
+    mu, z1, z2 = pair_properties(groups, pair)
+    return xs * energies * np.exp(0.989534*z1*z2*np.sqrt(mu/energies))
+
+
+def output_name(in_channel, out_channel, extension):
+    if out_channel != -1:
+        return f'AZUREOut_aa={in_channel}_R={out_channel}.{extension}'
+    return f'AZUREOut_aa={in_channel}_TOTAL_CAPTURE.{extension}'
+
+
+def calculate(contents, groups, output_dir, ext_capture_file):
+    files = {}
+    all_energies = []
+    for row in section(contents, 'segmentsData'):
+        if row.strip() == '':
+            continue
+        row = row.split()
+        if int(row[INCLUDE_INDEX]) != 1:
+            continue
+        offset = 2 if int(row[REACTION_TYPE]) == 2 else 0
+        norm_factor = float(row[NORM_FACTOR_INDEX + offset])
+        data = np.loadtxt(row[FILEPATH_INDEX + offset], ndmin=2)
+        energies = data[:, 0]
+        angles = data[:, 1] if data.shape[1] > 3 else np.zeros_like(energies)
+        xs = data[:, -2] * norm_factor
+        dxs = data[:, -1] * norm_factor
+        penetrability = energies * np.exp(1 / np.sqrt(energies))
+        fit = model(energies, groups)
+        block = np.column_stack((energies, energies + 1.94, angles, fit,
+            fit*penetrability, xs, dxs, xs*penetrability, dxs*penetrability))
+        name = output_name(int(row[IN_CHANNEL_INDEX]),
+                           int(row[OUT_CHANNEL_INDEX]), 'out')
+        files.setdefault(name, []).append(block)
+        all_energies.append(energies)
+
+    for (name, blocks) in files.items():
+        np.savetxt(os.path.join(output_dir, name), np.vstack(blocks),
+                   fmt='%.8e')
+
+    if ext_capture_file == '':
+        # smooth functions of the energies of the data points
+        e = np.hstack(all_energies) if all_energies else np.zeros(0)
+        x = np.exp(-e)
+        y = -e*np.exp(-e)
+        with open(os.path.join(output_dir, 'intEC.dat'), 'w') as f:
+            f.write(''.join(f'({xi:.5e},{yi:.5e})\n' for (xi, yi) in
+                            zip(x, y)))
+
+
+def extrapolate(contents, groups, output_dir):
+    files = {}
+    for row in section(contents, 'segmentsTest'):
+        if row.strip() == '':
+            continue
+        row = row.split()
+        if int(row[INCLUDE_INDEX]) != 1:
+            continue
+        e_min, e_max, e_step = map(float, row[3:6])
+        if e_step > 0:
+            energies = np.arange(e_min, e_max + e_step/2, e_step)
+        else:
+            energies = np.array([e_min])
+        fit = model(energies, groups)
+        block = np.column_stack((energies, energies + 1.94,
+            np.zeros_like(energies), fit,
+            sfactor(energies, fit, groups, int(row[IN_CHANNEL_INDEX]))))
+        name = output_name(int(row[IN_CHANNEL_INDEX]),
+                           int(row[OUT_CHANNEL_INDEX]), 'extrap')
+        files.setdefault(name, []).append(block)
+
+    for (name, blocks) in files.items():
+        np.savetxt(os.path.join(output_dir, name), np.vstack(blocks),
+                   fmt='%.8e')
+
+
+def write_parameters(groups, output_dir):
+    lines = []
+    for group in groups:
+        parity = '+' if int(group[0][PI_INDEX]) > 0 else '-'
+        lines.append(f'J = {float(group[0][J_INDEX])}{parity}   '
+                     f'E_level = {float(group[0][ENERGY_INDEX])} MeV')
+        for row in group:
+            width = float(row[WIDTH_INDEX])
+            g = np.sign(width) * np.sqrt(abs(width)) * 1e-3
+            lines.append(f'  R = {int(row[CHANNEL_INDEX])}  l = 0  s = 0.5  '
+                         f'g_int = {g:.6e} MeV^(1/2)  G = {width:.6e} eV')
+        lines.append('')
+    with open(os.path.join(output_dir, 'parameters.out'), 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def reaction_rate(groups, output_dir, entrance_pair, temperatures_filename):
+    temperatures = np.atleast_1d(np.loadtxt(temperatures_filename))
+    mu = pair_properties(groups, entrance_pair)[0]
+    energies = np.linspace(0.01, 3, 6000)
+    xs = model(energies, groups)
+    rates = []
+    for t in temperatures:
+        y = xs * energies * np.exp(-11.605*energies/t)
+        integral = np.sum(0.5*(y[1:] + y[:-1])*np.diff(energies))
+        rates.append(3.7318e10 / np.sqrt(mu) * t**-1.5 * integral)
+    with open(os.path.join(output_dir, 'reactionrates.out'), 'w') as f:
+        f.write('T9 Rate\n')
+        for (t, r) in zip(temperatures, rates):
+            f.write(f'{t:.6e} {r:.6e}\n')
+
+
+def main(argv):
+    input_filename = argv[1]
+    with open(input_filename, 'r') as f:
+        contents = f.read().split('\n')
+    output_dir = contents[2].split()[0]
+
+    menu = sys.stdin.read().split('\n')
+    choice = int(menu[0])
+
+    delay = float(os.environ.get('FAKE_AZURE2_DELAY', '0'))
+    if delay > 0:
+        time.sleep(delay)
+
+    groups = read_levels(contents)
+    try:
+        if choice == 1:
+            calculate(contents, groups, output_dir, menu[2].strip())
+            write_parameters(groups, output_dir)
+        elif choice == 3:
+            extrapolate(contents, groups, output_dir)
+            write_parameters(groups, output_dir)
+        elif choice == 5:
+            reaction_rate(groups, output_dir, int(menu[2]), menu[5].strip())
+        else:
+            print(f'Unsupported menu choice: {choice}', file=sys.stderr)
+            return 1
+    except ValueError as e:
+        print(f'Fake AZURE2 failed: {e}', file=sys.stderr)
+        return 1
+
+    print('Calculation complete.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
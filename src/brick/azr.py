@@ -4,14 +4,21 @@ Defines classes for interacting with AZURE2.
 
 import os
 import shutil
+from collections import Counter
 import numpy as np
 from . import level
 from . import utility
 from .parameter import Parameter
-from .output import Output
+from .output import Output, Evaluation, FIT_COLUMNS, column_indices
 from .data import Data
 from .nodata import Test
 from .configuration import Config
+from .shifts import ExtCaptureGrid
+from .rates import MaxwellianRate, pair_properties
+from . import batch
+from . import errors
+from .capture import Capture
+from .hooks import Hooks
 
 def clean_up(input_file, output_dir, data_dir):
     shutil.rmtree(output_dir)
@@ -39,9 +46,54 @@ class AZR:
     ext_capture_file_extrap : Filenme where external capture integral results
                               for segments without data have been stored.
     command                 : Name of AZURE2 binary.
+    ext_capture_grid        : ExtCaptureGrid used to interpolate the external
+                              capture integrals when energy shifts are sampled
+                              (see precompute_ext_capture_integrals).
+    executor                : Evaluates predict_batch (e.g.
+                              batch.SharedMemoryExecutor or
+                              distributed.BrokerExecutor). If None, the batch
+                              is evaluated serially in this process.
+    reuse_rmatrix           : Bool that indicates whether predict reuses the
+                              output of the last AZURE2 run (last_run) when
+                              only the normalization factors in theta changed.
+                              The data columns are rescaled instead of running
+                              AZURE2.
+    check_reuse             : If True (and reuse_rmatrix), AZURE2 is run anyway
+                              and the rescaled output is checked against it
+                              (to within the relative tolerance reuse_rtol).
+    capture                 : What is kept of the AZURE2 output: 'discard',
+                              'ring' (the last capture_size KB) or 'log'
+                              (appended to capture_log). See capture.py.
+    validate                : Bool that indicates whether predict_batch
+                              checks the thetas against config.constraints
+                              (see constraints.py) first. Rejected thetas are
+                              not passed to AZURE2.
+    static_columns          : Columns of the output files that do not depend
+                              on the R-matrix parameters, kept from the first
+                              run (see read_columns).
+    run_cache               : cache.RunCache that serves AZURE2 runs with
+                              inputs that have been run before (by any method
+                              or process sharing it). If None, AZURE2 is
+                              always run.
+    error_counts            : Number of failed AZURE2 runs of each kind (see
+                              errors.py). Failures in worker processes are
+                              counted in their copies.
+    hooks                   : hooks.Hooks registry of callbacks that observe
+                              the stages (rendering, AZURE2 run, parsing) of
+                              predict, extrapolate, reaction_rate and
+                              evaluate. Copies sent to worker processes have
+                              no callbacks.
+
+    Optional attributes specified at instantiation:
+    cache_dir               : Directory where the parsed input file (and its
+                              data) is cached. See cache.ConfigCache.
+    mmap_data               : Bool that indicates whether the data points are
+                              read from memory-mapped binary copies of the
+                              data files (written next to them). See
+                              data.load_points.
     '''
     def __init__(self, input_filename, parameters=None, output_filenames=None,
-                 extrap_filenames=None):
+                 extrap_filenames=None, cache_dir=None, mmap_data=False):
         # Give default values to attributes that are not specified at
         # instantiation. These values must be changed *after* instantiation.
         self.use_brune = True
@@ -52,8 +104,24 @@ class AZR:
         self.command = 'AZURE2'
         self.root_directory = ''
         self.verbose = True
+        self.ext_capture_grid = None
+        self.executor = None
+        self.reuse_rmatrix = False
+        self.check_reuse = False
+        self.reuse_rtol = 1e-4
+        self.last_run = None
+        self.static_columns = {}
+        self.capture = 'ring'
+        self.capture_size = 16
+        self.capture_log = None
+        self.error_counts = Counter()
+        self.validate = True
+        self.rate_grids = {}
+        self.run_cache = None
+        self.hooks = Hooks()
         
-        self.config = Config(input_filename, parameters=parameters)
+        self.config = Config(input_filename, parameters=parameters,
+                             cache_dir=cache_dir, mmap_data=mmap_data)
 
         '''
         If parameters are not specified, they are inferred from the input file.
@@ -80,13 +148,60 @@ class AZR:
             self.extrap_filenames = extrap_filenames
 
 
-    def predict(self, theta, mod_data=None, dress_up=True, full_output=False):
+    def __getstate__(self):
+        # The executor (pools, sockets, threads) stays in this process. Copies
+        # sent to worker processes evaluate serially. Callbacks (hooks) may
+        # not be picklable and observe this process only.
+        state = self.__dict__.copy()
+        state['executor'] = None
+        state['hooks'] = Hooks()
+        return state
+
+
+    def new_capture(self):
+        return Capture(self.capture, size=self.capture_size,
+                       logfile=self.capture_log)
+
+
+    def failure(self, capture, message):
+        '''
+        Classifies a failed AZURE2 run from its captured output (see
+        errors.py), counts it in error_counts and returns the exception.
+        '''
+        error = errors.classify(capture.text(), capture.returncode, message)
+        self.error_counts[type(error).__name__] += 1
+        if self.verbose:
+            print(message)
+            if capture.policy != 'discard':
+                print('AZURE output:')
+                print(capture.text())
+        return error
+
+
+    def predict(self, theta, mod_data=None, dress_up=True, full_output=False,
+                segments=None, workspace=None, columns=None):
         '''
         Takes:
             * a point in parameter space, theta.
             * dress_up    : Use Output class.
             * full_output : Return reduced width amplitudes as well.
             * mod_data    : Do any parametes in theta modify the original data?
+            * segments    : Indices (into config.data.segments) of the data
+                            segments to compute. All other segments are
+                            excluded from the AZURE2 calculation, and only
+                            the output files they generate are read. If an
+                            external capture file is used, it must have been
+                            generated with the same segments.
+            * workspace   : Workspace prepared for theta (and segments) by
+                            config.generate_workspaces. It is removed
+                            afterwards.
+            * columns     : Columns of the output files to return (names in
+                            output.COLUMNS, e.g. ('xs_com_fit',
+                            'xs_com_data', 'xs_err_com_data'), or indices).
+                            An array with only these columns is returned
+                            for every output file (dress_up is ignored).
+                            Only the calculated columns are read; the others
+                            are kept from the first run (see read_columns).
         Does:
             * creates a random filename ([rand].azr)
             * creates a (similarly) random output directory (output_[rand]/)
@@ -100,52 +215,272 @@ class AZR:
         Returns:
             * predicted values and (optionally) reduced width amplitudes.
         '''
-
-        workspace = self.config.generate_workspace(
-            theta,
-            prepend=self.root_directory,
-            mod_data=mod_data
-        )
+        assert (segments is None or self.config.n3 == 0 or
+                self.ext_capture_grid is None), '''
+The interpolated external capture integrals (ext_capture_grid) cover every
+data segment. They cannot be used with a subset of the segments.'''
+        reused = None
+        if self.reuse_rmatrix and mod_data is None:
+            reused = self.rescale_last_run(theta, segments, full_output)
+            if reused is not None and not self.check_reuse:
+                if workspace is not None:
+                    clean_up(*workspace)
+                return self.package_output(*reused, dress_up, full_output,
+                                           columns)
+
+        trace = self.hooks.trace('predict', theta)
+        trace.emit('before_render')
+        if workspace is None:
+            try:
+                workspace = self.config.generate_workspace(
+                    theta,
+                    prepend=self.root_directory,
+                    mod_data=mod_data,
+                    segment_indices=segments
+                )
+            except:
+                trace.error('render')
+                raise
         input_filename, output_dir, data_dir = workspace
 
+        if segments is None:
+            output_filenames = self.output_filenames
+        else:
+            output_filenames = self.config.data.get_output_files(segments)
+
+        ext_capture_file = self.data_ext_capture_file(theta, data_dir)
+        trace.emit('after_render', workspace)
+
+        trace.emit('before_run')
         try:
             response = utility.run_AZURE2(input_filename, choice=1,
                 use_brune=self.use_brune, ext_par_file=self.ext_par_file,
-                ext_capture_file=self.ext_capture_file, use_gsl=self.use_gsl,
-                command=self.command)
+                ext_capture_file=ext_capture_file, use_gsl=self.use_gsl,
+                command=self.command, capture=self.new_capture(),
+                run_cache=self.run_cache)
         except:
             shutil.rmtree(output_dir)
             shutil.rmtree(data_dir)
             os.remove(input_filename)
             if self.verbose:
                 print('AZURE2 did not execute properly.')
+            trace.error('run')
             raise
+        trace.emit('after_run')
 
         try:
-            if dress_up:
-                output = [Output(output_dir + '/' + of) for of in
-                          self.output_filenames]
+            if columns is not None and not (self.reuse_rmatrix and
+                                            mod_data is None):
+                values = self.read_columns(output_dir, output_filenames,
+                    theta, segments, column_indices(columns),
+                    static=(mod_data is None and self.config.n3 == 0))
+                # The columns have been selected.
+                (columns, dress_up) = (None, False)
             else:
-                output = [np.loadtxt(output_dir + '/' + of) for of in
-                          self.output_filenames]
-
-            if full_output:
-                output = (output, utility.read_rwas_jpi(output_dir))
+                values = [np.loadtxt(output_dir + '/' + of) for of in
+                          output_filenames]
+            rwas = utility.read_rwas_jpi(output_dir) if full_output else None
 
             shutil.rmtree(output_dir)
             shutil.rmtree(data_dir)
             os.remove(input_filename)
-
-            return output
-        except:
+        except Exception as e:
             shutil.rmtree(output_dir)
             shutil.rmtree(data_dir)
             os.remove(input_filename)
-            if self.verbose:
-                print('Output files were not properly read.')
-                print('AZURE output:')
-                print(response)
-            raise
+            error = self.failure(response,
+                'Output files were not properly read.')
+            trace.error('parse', error)
+            raise error from e
+        trace.emit('after_parse')
+
+        if self.reuse_rmatrix and mod_data is None:
+            if reused is not None:
+                self.check_rescaled_output(reused[0], values)
+            self.last_run = (np.array(theta, dtype=float), segments,
+                             self.run_settings(),
+                             [np.copy(v) for v in values], rwas)
+
+        return self.package_output(values, rwas, dress_up, full_output,
+                                   columns)
+
+
+    def data_ext_capture_file(self, theta, data_dir):
+        '''
+        Returns the external capture file (as it is passed to AZURE2) of a
+        calculation of the data segments at theta. Interpolated integrals
+        (ext_capture_grid) are written for every data segment, so they are
+        only used for calculations of all of the segments (see predict).
+        '''
+        # If energy shifts are sampled, the external capture integrals are
+        # interpolated rather than computed by AZURE2.
+        ext_capture_file = self.ext_capture_file
+        if self.config.n3 > 0 and self.ext_capture_grid is not None:
+            n = self.config.n1 + self.config.n2
+            ext_capture_file = data_dir + '/intEC.dat'
+            utility.write_ext_capture_file(ext_capture_file,
+                self.ext_capture_grid.evaluate(theta[n:n+self.config.n3]))
+            ext_capture_file += '\n'
+        return ext_capture_file
+
+
+    def read_columns(self, output_dir, output_files, theta, segments, indices,
+                     static=True):
+        '''
+        Reads the columns (indices) of the output files of a run.
+        Only the calculated columns (FIT_COLUMNS) are parsed. If static, the
+        other columns (energies, angles and data) are kept (static_columns)
+        from the first run with the same output files and segments, and the
+        data columns are rescaled to the normalization factors in theta. (They
+        agree with the columns AZURE2 writes to within the precision of its
+        output files.)
+        Returns a list of (n, len(indices)) arrays.
+        '''
+        key = (tuple(output_files), None if segments is None else
+               tuple(segments))
+        n1 = self.config.n1
+        norm = np.array(theta[n1:n1+self.config.n2], dtype=float)
+        if not static or key not in self.static_columns:
+            values = [np.loadtxt(output_dir + '/' + of, ndmin=2) for of in
+                      output_files]
+            if static and np.all(norm != 0):
+                self.static_columns[key] = (norm, [np.copy(v) for v in values])
+            return [v[:, indices] for v in values]
+
+        last_norm, last_values = self.static_columns[key]
+        fit = [c for c in FIT_COLUMNS if c in indices]
+        if fit:
+            parsed = [np.loadtxt(output_dir + '/' + of, usecols=fit, ndmin=2)
+                      for of in output_files]
+
+        # rescaling of the data columns
+        scales = [np.ones(v.shape[0]) for v in last_values]
+        rows = self.config.data.segment_rows(segments, list(output_files))
+        for (i, ratio) in zip(self.config.data.norm_segment_indices,
+                              norm/last_norm):
+            if i in rows and ratio != 1:
+                k, r = rows[i]
+                scales[k][r] = ratio
+
+        values = []
+        for (k, v) in enumerate(last_values):
+            out = np.empty((v.shape[0], len(indices)))
+            for (j, c) in enumerate(indices):
+                if c in FIT_COLUMNS:
+                    out[:, j] = parsed[k][:, fit.index(c)]
+                elif c >= 5:
+                    out[:, j] = v[:, c] * scales[k]
+                else:
+                    out[:, j] = v[:, c]
+            values.append(out)
+        return values
+
+
+    def package_output(self, values, rwas, dress_up, full_output,
+                       columns=None):
+        if columns is not None:
+            indices = column_indices(columns)
+            output = [v[:, indices] for v in values]
+        elif dress_up:
+            output = [Output(v, is_array=True) for v in values]
+        else:
+            output = values
+        if full_output:
+            return output, rwas
+        return output
+
+
+    def run_settings(self):
+        '''
+        Returns the attributes (other than theta) that AZURE2's output
+        depends on.
+        '''
+        return (self.use_brune, self.use_gsl, self.ext_par_file,
+                self.ext_capture_file, self.command)
+
+
+    def rescale_last_run(self, theta, segments, full_output):
+        '''
+        If theta differs from the theta of the last AZURE2 run (see
+        reuse_rmatrix) only in the normalization factors, returns the output
+        of that run with the data (columns 5-8) rescaled to the new
+        normalization factors, and its reduced width amplitudes. Otherwise,
+        returns None.
+        '''
+        if self.last_run is None:
+            return None
+        last_theta, last_segments, settings, values, rwas = self.last_run
+
+        n1 = self.config.n1
+        n2 = self.config.n2
+        theta = np.asarray(theta, dtype=float)
+        if (theta.shape != last_theta.shape or segments != last_segments or
+                settings != self.run_settings() or
+                (full_output and rwas is None)):
+            return None
+        if not (np.array_equal(theta[:n1], last_theta[:n1]) and
+                np.array_equal(theta[n1+n2:], last_theta[n1+n2:])):
+            return None
+
+        old = last_theta[n1:n1+n2]
+        new = theta[n1:n1+n2]
+        if np.any(old == 0):
+            return None
+
+        if segments is None:
+            output_files = self.output_filenames
+        else:
+            output_files = self.config.data.get_output_files(segments)
+        rows = self.config.data.segment_rows(segments, output_files)
+
+        values = [np.copy(v) for v in values]
+        for (i, ratio) in zip(self.config.data.norm_segment_indices,
+                              new/old):
+            if i in rows and ratio != 1:
+                k, r = rows[i]
+                values[k][r, 5:9] *= ratio
+        return values, rwas
+
+
+    def check_rescaled_output(self, rescaled, values):
+        '''
+        Compares the rescaled output of the last run with the output AZURE2
+        generated (see check_reuse).
+        '''
+        for (a, b) in zip(rescaled, values):
+            assert np.allclose(a, b, rtol=self.reuse_rtol, atol=0), f'''
+The rescaled output does not match the output of AZURE2. The largest relative
+difference is {np.max(np.abs(a - b) / np.maximum(np.abs(b), 1e-300))}.'''
+
+
+    def predict_batch(self, thetas, segments=None, full_output=False):
+        '''
+        Evaluates predict (with dress_up=False) at each point in thetas.
+        The evaluation is handed to the executor (see batch.py).
+        Returns a batch.BatchResult, which holds every prediction in one
+        (len(thetas), nrows, 9) array.
+        If validate is set, thetas rejected by config.constraints are marked
+        as failed without running AZURE2.
+        '''
+        valid = None
+        if self.validate and len(thetas) > 0:
+            valid = self.config.constraints.check(thetas)
+            if valid.all():
+                valid = None
+            else:
+                thetas = [thetas[k] for k in np.flatnonzero(valid)]
+
+        if self.executor is None or len(thetas) == 0:
+            result = batch.evaluate_serial(self, thetas, segments=segments,
+                                           full_output=full_output)
+        else:
+            result = self.executor.map(self, thetas, segments=segments,
+                                       full_output=full_output)
+
+        if valid is not None:
+            result = batch.expand(result, valid,
+                                  'Rejected by the constraints.')
+        return result
 
 
     def extrapolate(self, theta, segment_indices=None, use_brune=None,
@@ -153,10 +488,18 @@ class AZR:
         '''
         See predict() documentation.
         '''
-        workspace = self.config.generate_workspace_extrap(theta,
-            segment_indices=segment_indices)
+        trace = self.hooks.trace('extrapolate', theta)
+        trace.emit('before_render')
+        try:
+            workspace = self.config.generate_workspace_extrap(theta,
+                segment_indices=segment_indices)
+        except:
+            trace.error('render')
+            raise
         input_filename, output_dir, output_files = workspace
+        trace.emit('after_render', (input_filename, output_dir, None))
 
+        trace.emit('before_run')
         try:
             response = utility.run_AZURE2(input_filename, choice=3,
                 use_brune=use_brune if use_brune is not None else self.use_brune,
@@ -164,25 +507,201 @@ class AZR:
                 ext_par_file=self.ext_par_file,
                 ext_capture_file=(ext_capture_file if ext_capture_file is not
                     None else self.ext_capture_file_extrap),
-                command=self.command)
+                command=self.command, capture=self.new_capture(),
+                run_cache=self.run_cache)
         except:
             shutil.rmtree(output_dir)
             os.remove(input_filename)
             if self.verbose:
                 print('AZURE2 did not execute properly.')
+            trace.error('run')
             raise
+        trace.emit('after_run')
 
         try:
             output = [np.loadtxt(output_dir + '/' + of) for of in output_files]
             shutil.rmtree(output_dir)
             os.remove(input_filename)
-            return output
-        except:
+        except Exception as e:
             shutil.rmtree(output_dir)
             os.remove(input_filename)
-            if self.verbose:
-                print('Output files could not be read.')
-            raise
+            error = self.failure(response, 'Output files could not be read.')
+            trace.error('parse', error)
+            raise error from e
+        trace.emit('after_parse')
+        return output
+
+
+    def evaluate(self, theta, data=True, extrap=True, rwas=True, rate=None,
+                 rate_segment=None, segments=None, extrap_segments=None,
+                 dress_up=True):
+        '''
+        Takes:
+            * a point in parameter space, theta.
+            * data            : Compute the data segments (see predict)?
+            * extrap          : Extrapolate the test segments (see
+                                extrapolate)?
+            * rwas            : Read the reduced width amplitudes?
+            * rate            : (entrance_pair, exit_pair, temperatures) of a
+                                reaction rate (see reaction_rate), or None.
+            * rate_segment    : If provided, the rate is integrated in this
+                                process from the S factor of that test
+                                segment (see integrate_rate), which is
+                                extrapolated along with extrap_segments.
+            * segments        : Indices of the data segments to compute (see
+                                predict).
+            * extrap_segments : Indices of the test segments to extrapolate
+                                (see extrapolate).
+            * dress_up        : Use Output class for the data.
+        Does:
+            * writes one input file, with the data and the test segments
+              selected, to one workspace
+            * runs AZURE2 in the workspace once for each menu choice the
+              products need (AZURE2 exits after every choice): 1 for the
+              data, 3 for the extrapolation (and the S factor of
+              rate_segment) and 5 for a rate computed by AZURE2. The reduced
+              width amplitudes are read from the output of these runs.
+            * reads the output files and deletes the workspace
+        If rate_segment writes to the same output file as another test
+        segment in extrap_segments, its S factor is extrapolated separately
+        (see integrate_rate).
+        Returns:
+            * an output.Evaluation
+        '''
+        test = self.config.test
+        requested = []
+        if extrap:
+            requested = (list(extrap_segments) if extrap_segments is not None
+                         else [i for (i, s) in enumerate(test.all_segments)
+                               if s.include])
+        extrap_indices = extrap_segments
+
+        fuse_rate = rate is not None and rate_segment is not None
+        if fuse_rate:
+            segment = test.all_segments[rate_segment]
+            assert segment.in_channel == rate[0], f'''
+Test segment {rate_segment} does not start from particle pair {rate[0]}.'''
+            fuse_rate = all(test.all_segments[i].output_filename !=
+                            segment.output_filename for i in requested if i !=
+                            rate_segment)
+            if fuse_rate:
+                extrap_indices = sorted(set(requested) | {rate_segment})
+
+        choices = []
+        if data or (rwas and not (extrap or fuse_rate)):
+            choices.append(1)
+        if extrap or fuse_rate:
+            choices.append(3)
+        if rate is not None and rate_segment is None:
+            choices.append(5)
+
+        output_files = None
+        if data:
+            output_files = (self.output_filenames if segments is None else
+                            self.config.data.get_output_files(segments))
+        extrap_files = test.get_output_files(requested) if extrap else None
+        evaluation = Evaluation(theta, output_files=output_files,
+                                extrap_files=extrap_files, choices=choices)
+
+        if choices:
+            assert (segments is None or self.config.n3 == 0 or
+                    self.ext_capture_grid is None), '''
+The interpolated external capture integrals (ext_capture_grid) cover every
+data segment. They cannot be used with a subset of the segments.'''
+            trace = self.hooks.trace('evaluate', theta)
+            trace.emit('before_render')
+            try:
+                workspace = self.config.generate_workspace(
+                    theta,
+                    prepend=self.root_directory,
+                    segment_indices=segments,
+                    extrap_indices=extrap_indices
+                )
+            except:
+                trace.error('render')
+                raise
+            input_filename, output_dir, data_dir = workspace
+            ext_capture_files = {
+                1: self.data_ext_capture_file(theta, data_dir),
+                3: self.ext_capture_file_extrap
+            }
+            if 5 in choices:
+                temperatures_filename = data_dir + '/temps.txt'
+                np.savetxt(temperatures_filename,
+                           np.asarray(rate[2], dtype=float).T)
+            trace.emit('after_render', workspace)
+
+            responses = {}
+            for choice in choices:
+                trace.emit('before_run')
+                try:
+                    if choice == 5:
+                        responses[choice] = utility.reaction_rate(
+                            input_filename, temperatures_filename, rate[0],
+                            rate[1], use_brune=self.use_brune,
+                            use_gsl=self.use_gsl, command=self.command,
+                            capture=self.new_capture(),
+                            run_cache=self.run_cache)
+                    else:
+                        responses[choice] = utility.run_AZURE2(
+                            input_filename, choice=choice,
+                            use_brune=self.use_brune,
+                            ext_par_file=self.ext_par_file,
+                            ext_capture_file=ext_capture_files[choice],
+                            use_gsl=self.use_gsl, command=self.command,
+                            capture=self.new_capture(),
+                            run_cache=self.run_cache)
+                except:
+                    clean_up(input_filename, output_dir, data_dir)
+                    if self.verbose:
+                        print('AZURE2 did not execute properly.')
+                    trace.error('run')
+                    raise
+                trace.emit('after_run')
+
+            choice = None
+            try:
+                if data:
+                    choice = 1
+                    evaluation.data = [np.loadtxt(output_dir + '/' + of) for
+                                       of in output_files]
+                    if dress_up:
+                        evaluation.data = [Output(v, is_array=True) for v in
+                                           evaluation.data]
+                if extrap or fuse_rate:
+                    choice = 3
+                    extrap_output = {of: np.loadtxt(output_dir + '/' + of)
+                                     for of in test.get_output_files(
+                                         extrap_indices)}
+                    if extrap:
+                        evaluation.extrap = [extrap_output[of] for of in
+                                             extrap_files]
+                if rwas:
+                    choice = choices[0]
+                    evaluation.rwas = utility.read_rwas_jpi(output_dir)
+                if 5 in choices:
+                    choice = 5
+                    evaluation.rate = np.loadtxt(
+                        output_dir + '/reactionrates.out', skiprows=1)
+            except Exception as e:
+                clean_up(input_filename, output_dir, data_dir)
+                error = self.failure(responses[choice],
+                    f'Output files of menu choice {choice} were not properly '
+                    'read.')
+                trace.error('parse', error)
+                raise error from e
+            clean_up(input_filename, output_dir, data_dir)
+            trace.emit('after_parse')
+
+            if fuse_rate:
+                name = test.all_segments[rate_segment].output_filename
+                evaluation.rate = self.maxwellian_rate(extrap_output[name],
+                    rate_segment, rate[2])
+
+        if rate is not None and rate_segment is not None and not fuse_rate:
+            evaluation.rate = self.integrate_rate(theta, rate_segment, rate[2])
+
+        return evaluation
 
 
     def rwas(self, theta):
@@ -193,43 +712,58 @@ class AZR:
         input_filename, output_dir = utility.random_output_dir_filename()
         new_levels = self.config.generate_levels(theta)
         utility.write_input_file(self.config.input_file_contents, new_levels,
-                                 input_filename, output_dir)
-        response = utility.run_AZURE2(input_filename, choice=1,
-            use_brune=self.use_brune, ext_par_file=self.ext_par_file,
-            ext_capture_file=self.ext_capture_file, use_gsl=self.use_gsl,
-            command=self.command)
-
-        rwas = utility.read_rwas_jpi(output_dir)
-
-        shutil.rmtree(output_dir)
-        os.remove(input_filename)
+                                 input_filename, output_dir,
+                                 float_format=self.config.float_format)
+        try:
+            response = utility.run_AZURE2(input_filename, choice=1,
+                use_brune=self.use_brune, ext_par_file=self.ext_par_file,
+                ext_capture_file=self.ext_capture_file, use_gsl=self.use_gsl,
+                command=self.command, capture=self.new_capture(),
+                run_cache=self.run_cache)
+            try:
+                rwas = utility.read_rwas_jpi(output_dir)
+            except Exception as e:
+                raise self.failure(response,
+                    'Parameter file was not properly read.') from e
+        finally:
+            shutil.rmtree(output_dir)
+            os.remove(input_filename)
 
         return rwas
 
     
-    def ext_capture_integrals(self, use_gsl=False, mod_data=False):
+    def ext_capture_integrals(self, use_gsl=False, mod_data=None):
         '''
         Returns the AZURE2 output of external capture integrals.
+        mod_data : list of (segment index, modified data) (see predict)
         '''
-        input_filename, output_dir, data_dir = utility.random_workspace()
+        input_filename, output_dir, data_dir = utility.random_workspace(
+            prepend=self.root_directory)
 
+        contents = self.config.input_file_contents.copy()
         if mod_data:
-            self.config.update_data_directories(data_dir)
+            contents = self.config.update_data_directories(data_dir, contents)
+            for (i, data) in mod_data:
+                self.config.data.segments[i].update_dir(data_dir, data)
 
         new_levels = self.config.initial_levels.copy()
         new_levels = [l for sl in new_levels for l in sl]
-        utility.write_input_file(self.config.input_file_contents, new_levels,
-                                 input_filename, output_dir)
-        response = utility.run_AZURE2(input_filename, choice=1,
-            use_brune=self.use_brune, ext_par_file=self.ext_par_file,
-            ext_capture_file='\n', use_gsl=use_gsl,
-            command=self.command)
-
-        ec = utility.read_ext_capture_file(output_dir + '/intEC.dat')
-
-        shutil.rmtree(output_dir)
-        shutil.rmtree(data_dir)
-        os.remove(input_filename)
+        utility.write_input_file(contents, new_levels, input_filename,
+                                 output_dir,
+                                 float_format=self.config.float_format)
+        try:
+            response = utility.run_AZURE2(input_filename, choice=1,
+                use_brune=self.use_brune, ext_par_file=self.ext_par_file,
+                ext_capture_file='\n', use_gsl=use_gsl,
+                command=self.command, capture=self.new_capture(),
+                run_cache=self.run_cache)
+            try:
+                ec = utility.read_ext_capture_file(output_dir + '/intEC.dat')
+            except Exception as e:
+                raise self.failure(response,
+                    'External capture file was not properly read.') from e
+        finally:
+            clean_up(input_filename, output_dir, data_dir)
 
         return ec
 
@@ -246,13 +780,49 @@ class AZR:
         * Evaluates the external capture (EC) integrals.
         * Returns the values from the EC file.
         '''
-        for (i, shift) in zip(segment_indices, shifts):
-            self.config.data.segments[i].shift_energies(shift)
+        mod_data = [(i, self.config.data.segments[i].shift_energies(shift))
+                    for (i, shift) in zip(segment_indices, shifts)]
 
-        return self.ext_capture_integrals(use_gsl=use_gsl, mod_data=True)
+        return self.ext_capture_integrals(use_gsl=use_gsl, mod_data=mod_data)
 
 
-    def reaction_rate(self, theta, entrance_pair, exit_pair, temperatures):
+    def precompute_ext_capture_integrals(self, shifts, segment_indices=None,
+                                         use_gsl=False):
+        '''
+        Prepares the sampling of energy shifts without additional AZURE2 runs
+        for the external capture (EC) integrals.
+        Takes:
+          * a grid of shifts (MeV, lab) that covers the sampled range
+          * the indices of the shifted data segments (if not provided, the
+            segments already registered with config.add_energy_shifts)
+        Does:
+          * registers the shifts of the segments as sampled parameters
+            (config.add_energy_shifts), if they are not already
+          * evaluates the EC integrals with each segment shifted by each shift
+            on the grid (len(shifts) AZURE2 runs per segment)
+          * stores the tables in ext_capture_grid
+        predict then interpolates the EC integrals at the shifts in theta and
+        passes them to AZURE2 as the external capture file.
+        '''
+        if segment_indices is None:
+            segment_indices = self.config.shift_segment_indices
+        elif list(segment_indices) != self.config.shift_segment_indices:
+            assert self.config.n3 == 0, '''
+Energy shifts have already been added for different segments.'''
+            self.config.add_energy_shifts(segment_indices)
+
+        base = self.ext_capture_integrals(use_gsl=use_gsl)
+        tables = []
+        for i in segment_indices:
+            tables.append([self.update_ext_capture_integrals([i], [shift],
+                           use_gsl=use_gsl) for shift in shifts])
+
+        self.ext_capture_grid = ExtCaptureGrid(shifts, base, tables)
+        return self.ext_capture_grid
+
+
+    def reaction_rate(self, theta, entrance_pair, exit_pair, temperatures,
+                      segment_index=None):
         '''
         Computes the reaction rate for entrance_pair -> exit_pair at
         parameter-space point, theta, for temperatures listed in the array,
@@ -261,34 +831,90 @@ class AZR:
         entrance_pair : int
         exit_pair : int
         temperatures : NumPy array of temperatures in GK
+        segment_index : If provided, the rate is integrated in this process
+                        from the S factor of that test segment (see
+                        integrate_rate) rather than by AZURE2.
         '''
-        workspace = self.config.generate_workspace(
-            theta,
-            prepend=self.root_directory,
-        )
+        if segment_index is not None:
+            segment = self.config.test.all_segments[segment_index]
+            assert segment.in_channel == entrance_pair, f'''
+Test segment {segment_index} does not start from particle pair {entrance_pair}.'''
+            return self.integrate_rate(theta, segment_index, temperatures)
+
+        trace = self.hooks.trace('reaction_rate', theta)
+        trace.emit('before_render')
+        try:
+            workspace = self.config.generate_workspace(
+                theta,
+                prepend=self.root_directory,
+            )
+        except:
+            trace.error('render')
+            raise
         input_filename, output_dir, data_dir = workspace
         temperatures_filename = output_dir + '/temps.txt'
         np.savetxt(temperatures_filename, temperatures.T)
+        trace.emit('after_render', workspace)
 
+        trace.emit('before_run')
         try:
             response = utility.reaction_rate(input_filename,
                     temperatures_filename, entrance_pair, exit_pair,
                     use_brune=self.use_brune, use_gsl=self.use_gsl,
-                    command=self.command)
+                    command=self.command, capture=self.new_capture(),
+                    run_cache=self.run_cache)
         except:
             clean_up(input_filename, output_dir, data_dir)
             if self.verbose:
                 print('AZURE2 did not execute properly.')
+            trace.error('run')
             raise
+        trace.emit('after_run')
 
         try:
             output = np.loadtxt(output_dir + '/reactionrates.out', skiprows=1)
             clean_up(input_filename, output_dir, data_dir)
-            return output
-        except:
+        except Exception as e:
             clean_up(input_filename, output_dir, data_dir)
-            if self.verbose:
-                print('Output reaction rate file was not properly read.')
-                print('AZURE output:')
-                print(response)
-            raise
+            error = self.failure(response,
+                'Output reaction rate file was not properly read.')
+            trace.error('parse', error)
+            raise error from e
+        trace.emit('after_parse')
+        return output
+
+
+    def integrate_rate(self, theta, segment_index, temperatures):
+        '''
+        Computes the Maxwellian-averaged reaction rate (cm^3 mol^-1 s^-1) at
+        temperatures (GK) from the S factor that AZURE2 extrapolates for the
+        test segment segment_index (an index into config.test.all_segments).
+        The energies of the test segment serve as the quadrature grid, so
+        they must cover the Gamow window of every temperature. The weights
+        are computed once per segment and set of temperatures (rate_grids).
+        See rates.py.
+        Returns an array of (temperature, rate) rows.
+        '''
+        output = self.extrapolate(theta, segment_indices=[segment_index])[0]
+        return self.maxwellian_rate(output, segment_index, temperatures)
+
+
+    def maxwellian_rate(self, output, segment_index, temperatures):
+        '''
+        Integrates the rate from the extrapolated output of the test segment
+        segment_index (see integrate_rate).
+        '''
+        energies = output[:, 0]
+        sfactor = output[:, 4]
+
+        temperatures = np.atleast_1d(np.asarray(temperatures, dtype=float))
+        key = (segment_index, tuple(temperatures))
+        rate = self.rate_grids.get(key)
+        if rate is None or not np.array_equal(rate.energies, energies):
+            segment = self.config.test.all_segments[segment_index]
+            mu, z1, z2 = pair_properties(self.config.input_file_contents,
+                                         segment.in_channel)
+            rate = MaxwellianRate(energies, temperatures, mu, z1, z2)
+            self.rate_grids[key] = rate
+
+        return np.column_stack((temperatures, rate(sfactor)))
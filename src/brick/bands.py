@@ -0,0 +1,218 @@
+'''
+Streaming credible bands for posterior-predictive quantities.
+
+Stacking (n_samples, n_points) arrays to call np.percentile requires memory
+that grows with the number of samples. BandAccumulator instead keeps, for
+every point, the values at a fixed set of cumulative probabilities (nodes
+that are densest in the tails, as in a t-digest). Samples are buffered and
+merged into that summary in batches, and summaries from different processes
+can be merged. The memory is O(compression * n_points), independent of the
+number of samples.
+'''
+
+import math
+import numpy as np
+
+# Cumulative probabilities of the 1 and 2 sigma bounds of a normal
+# distribution.
+ONE_SIGMA = 0.5 * (1 + math.erf(1 / math.sqrt(2)))
+TWO_SIGMA = 0.5 * (1 + math.erf(2 / math.sqrt(2)))
+
+
+def interpolate_columns(x, xp, fp):
+    '''
+    Column-wise linear interpolation: for every column k, returns
+    np.interp(x, xp[:, k], fp[:, k]). xp must increase (non-strictly) along
+    axis 0 and lie in [0, 1].
+    '''
+    m, n = xp.shape
+    columns = np.arange(n)
+    # Offsetting each column by twice its index makes the flattened array
+    # monotonic, so a single searchsorted call handles every column.
+    xp_flat = (xp + 2*columns).T.ravel()
+    fp_flat = fp.T.ravel()
+    targets = (x[None, :] + 2*columns[:, None]).ravel()
+
+    i = np.searchsorted(xp_flat, targets)
+    lower_bound = np.repeat(columns*m, x.size) + 1
+    i = np.clip(i, lower_bound, lower_bound + m - 2)
+
+    x0 = xp_flat[i-1]
+    x1 = xp_flat[i]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(x1 > x0, (targets - x0) / (x1 - x0), 0.5)
+    t = np.clip(t, 0, 1)
+    f = (1-t)*fp_flat[i-1] + t*fp_flat[i]
+    return f.reshape(n, x.size).T
+
+
+def cdf_at(x, xp, fp, before):
+    '''
+    Evaluates the piecewise-linear CDFs (xp, fp), sorted along axis 0, at the
+    points x, given the number of points of xp that precede each point
+    (before). All arrays have a column for every point.
+    '''
+    k = xp.shape[0]
+    lower = np.clip(before-1, 0, k-1)
+    upper = np.clip(before, 0, k-1)
+    x0 = np.take_along_axis(xp, lower, axis=0)
+    x1 = np.take_along_axis(xp, upper, axis=0)
+    f0 = np.take_along_axis(fp, lower, axis=0)
+    f1 = np.take_along_axis(fp, upper, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(x1 > x0, (x - x0) / (x1 - x0), 0)
+    f = f0 + np.clip(t, 0, 1)*(f1 - f0)
+    f[before == 0] = 0
+    f[before == k] = 1
+    return f
+
+
+def merge_cdfs(xa, fa, wa, xb, fb, wb):
+    '''
+    Merges two piecewise-linear CDFs with weights wa and wb. Each is given by
+    its points (x, sorted along axis 0) and cumulative probabilities (f, from
+    0 to 1), with a column for every point.
+    Returns the points and cumulative probabilities of the mixture.
+    '''
+    ka = xa.shape[0]
+    x = np.vstack((xa, xb))
+    f = np.vstack((fa, fb))
+    order = np.argsort(x, axis=0, kind='stable')
+    x = np.take_along_axis(x, order, axis=0)
+    f = np.take_along_axis(f, order, axis=0)
+
+    from_b = order >= ka
+    b_before = np.cumsum(from_b, axis=0) - from_b
+    a_before = np.cumsum(~from_b, axis=0) - ~from_b
+
+    f_other = np.where(from_b, cdf_at(x, xa, fa, a_before),
+                       cdf_at(x, xb, fb, b_before))
+    f_mix = np.where(from_b, wb*f + wa*f_other, wa*f + wb*f_other)
+    f_mix = np.maximum.accumulate(f_mix, axis=0) / (wa + wb)
+    return x, f_mix
+
+
+class BandAccumulator:
+    '''
+    Accumulates samples of an array of n_points values (e.g. the S factor at
+    the energies of an extrapolation) and returns quantiles at each point.
+
+    compression : number of cumulative probabilities (nodes) kept per point
+    buffer_size : number of samples that are buffered before they are merged
+                  into the summary (default: 10*compression)
+
+    Typical use:
+        acc = BandAccumulator()
+        for theta in samples:
+            acc.add(azr.extrapolate(theta)[0][:, 4])
+        bands = acc.bands()
+    '''
+    def __init__(self, compression=200, buffer_size=None):
+        self.compression = compression
+        if buffer_size is None:
+            buffer_size = 10*compression
+        self.buffer_size = buffer_size
+
+        # Chebyshev-like nodes: denser near 0 and 1.
+        j = np.arange(compression)
+        self.nodes = 0.5 * (1 - np.cos(np.pi * (j + 0.5) / compression))
+        self.cdf = np.hstack(([0], self.nodes, [1]))
+
+        self.n_points = None
+        self.count = 0
+        # Values at the cumulative probabilities in cdf (the first and last
+        # rows are the minimum and maximum): (compression + 2, n_points)
+        self.values = None
+        self.buffer = []
+        self.nbuffer = 0
+
+
+    def add(self, samples):
+        '''
+        Adds one sample (n_points,) or several samples (n_samples, n_points).
+        '''
+        samples = np.asarray(samples, dtype=float)
+        if samples.ndim == 1:
+            samples = samples[None, :]
+        if self.n_points is None:
+            self.n_points = samples.shape[1]
+        assert samples.shape[1] == self.n_points, f'''
+Expected samples of {self.n_points} points, not {samples.shape[1]}.'''
+
+        self.buffer.append(samples)
+        self.nbuffer += samples.shape[0]
+        if self.nbuffer >= self.buffer_size:
+            self.flush()
+
+
+    def flush(self):
+        '''
+        Merges the buffered samples into the summary.
+        '''
+        if self.nbuffer == 0:
+            return
+        samples = np.sort(np.vstack(self.buffer), axis=0)
+        self.buffer = []
+        self.nbuffer = 0
+
+        # Empirical CDF of the samples (bounded by the extreme samples).
+        m = samples.shape[0]
+        x = np.vstack((samples[0], samples, samples[-1]))
+        f = np.hstack(([0], (np.arange(m) + 0.5) / m, [1]))
+        self.combine(x, np.repeat(f[:, None], self.n_points, axis=1), m)
+
+
+    def combine(self, x, f, weight):
+        '''
+        Merges a piecewise-linear CDF (points x and cumulative probabilities
+        f, sorted along axis 0) that represents weight samples into the
+        summary.
+        '''
+        if self.values is not None:
+            cdf = np.repeat(self.cdf[:, None], self.n_points, axis=1)
+            x, f = merge_cdfs(self.values, cdf, self.count, x, f, weight)
+
+        values = interpolate_columns(self.nodes, f, x)
+        self.values = np.vstack((x[0], values, x[-1]))
+        self.count += weight
+
+
+    def merge(self, other):
+        '''
+        Merges the samples accumulated by other (a BandAccumulator) into this
+        one.
+        '''
+        other.flush()
+        if other.values is None:
+            return
+        if self.n_points is None:
+            self.n_points = other.n_points
+        self.flush()
+        cdf = np.repeat(other.cdf[:, None], other.n_points, axis=1)
+        self.combine(other.values, cdf, other.count)
+
+
+    def quantiles(self, q):
+        '''
+        Returns the estimated quantiles q (cumulative probabilities, array)
+        at every point: (len(q), n_points).
+        '''
+        self.flush()
+        q = np.atleast_1d(np.asarray(q, dtype=float))
+        k = np.clip(np.searchsorted(self.cdf, q), 1, self.cdf.size-1)
+        t = ((q - self.cdf[k-1]) / (self.cdf[k] - self.cdf[k-1]))[:, None]
+        return (1-t)*self.values[k-1] + t*self.values[k]
+
+
+    def bands(self):
+        '''
+        Returns a dictionary with the median and the 1 and 2 sigma bands
+        (tuples of lower and upper bounds) at every point.
+        '''
+        q = self.quantiles([1-TWO_SIGMA, 1-ONE_SIGMA, 0.5, ONE_SIGMA,
+                            TWO_SIGMA])
+        return {
+            'median': q[2],
+            '1sigma': (q[1], q[3]),
+            '2sigma': (q[0], q[4])
+        }
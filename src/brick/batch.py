@@ -0,0 +1,458 @@
+'''
+Batched evaluation of AZR.predict over many points in parameter space.
+
+An executor evaluates a batch of thetas and returns a BatchResult. Executors
+have a single method,
+    map(azr, thetas, segments=None, full_output=False) -> BatchResult,
+so they can be swapped without changing the calling code (see
+AZR.predict_batch).
+
+SharedMemoryExecutor runs the predictions in a multiprocessing Pool. The
+workers write their outputs directly into a preallocated shared-memory block,
+and the parent reads zero-copy views of it. Only small headers (status and,
+optionally, reduced width amplitudes) are sent through pipes.
+
+AutoscalingExecutor picks the number of processes and the number of OpenMP
+threads per AZURE2 process for a SharedMemoryExecutor by measuring the
+throughput of the first batches.
+'''
+
+import os
+import time
+import shutil
+from multiprocessing import Pool
+import numpy as np
+
+# number of columns in the AZUREOut_*.out files (see Output)
+NCOLUMNS = 9
+
+
+class BatchResult:
+    '''
+    Results of a batch of predictions.
+
+    values       : (N, nrows, 9) array. values[k] holds the output files
+                   of the kth prediction, stacked in the order of output_files.
+                   (Rows of failed predictions are NaN.)
+    ok           : (N,) array of bools. Did the kth prediction succeed?
+    output_files : output files (AZUREOut_*.out) in values
+    rows         : number of rows of each output file
+    rwas         : reduced width amplitudes of each prediction (if requested)
+    errors       : error message of each failed prediction (None otherwise)
+    '''
+    def __init__(self, values, ok, output_files, rows, rwas=None,
+                 errors=None):
+        self.values = values
+        self.ok = ok
+        self.output_files = output_files
+        self.rows = rows
+        self.rwas = rwas
+        self.errors = errors if errors is not None else [None]*len(ok)
+        self.offsets = np.hstack(([0], np.cumsum(rows))).astype(int)
+
+
+    def split(self, k):
+        '''
+        Returns the kth prediction as a list of arrays, one per output file
+        (like AZR.predict with dress_up=False).
+        '''
+        return [self.values[k, self.offsets[i]:self.offsets[i+1]] for i in
+                range(len(self.rows))]
+
+
+def expand(result, valid, error):
+    '''
+    Returns a BatchResult with the predictions in result at the positions of
+    valid (array of bools) and failed predictions (with the error message)
+    everywhere else.
+    '''
+    n = valid.size
+    index = np.flatnonzero(valid)
+    values = np.full((n,) + result.values.shape[1:], np.nan)
+    values[index] = result.values
+    ok = np.zeros(n, dtype=bool)
+    ok[index] = result.ok
+    errors = [error]*n
+    rwas = [None]*n if result.rwas is not None else None
+    for (k, i) in enumerate(index):
+        errors[i] = result.errors[k]
+        if rwas is not None:
+            rwas[i] = result.rwas[k]
+    return BatchResult(values, ok, result.output_files, result.rows, rwas,
+                       errors)
+
+
+def layout(azr, segments=None):
+    '''
+    Returns the output files read by azr.predict (with the given segments)
+    and the number of rows in each.
+    '''
+    output_files = azr.output_filenames if segments is None else None
+    return azr.config.data.output_layout(segments, output_files)
+
+
+def predict_one(azr, theta, segments=None, full_output=False, workspace=None):
+    '''
+    Runs a single prediction and returns the output files stacked into one
+    array (and the reduced width amplitudes, if full_output).
+    '''
+    output = azr.predict(theta, dress_up=False, full_output=full_output,
+                         segments=segments, workspace=workspace)
+    rwas = None
+    if full_output:
+        output, rwas = output
+    output = [np.atleast_2d(o) for o in output]
+    return np.concatenate(output, axis=0), rwas
+
+
+def evaluate_serial(azr, thetas, segments=None, full_output=False):
+    '''
+    Evaluates the batch in this process, one theta after the other.
+    '''
+    output_files, rows = layout(azr, segments)
+    values = np.full((len(thetas), sum(rows), NCOLUMNS), np.nan)
+    ok = np.zeros(len(thetas), dtype=bool)
+    rwas = [None]*len(thetas) if full_output else None
+    errors = [None]*len(thetas)
+
+    # The input files of the whole batch are rendered at once, unless they
+    # depend on more than theta (sampled energy shifts).
+    if azr.config.n3 == 0 and len(thetas) > 0:
+        workspaces = azr.config.generate_workspaces(thetas,
+            prepend=azr.root_directory, segment_indices=segments)
+    else:
+        workspaces = [None]*len(thetas)
+
+    k = 0
+    try:
+        for (k, theta) in enumerate(thetas):
+            try:
+                mu, r = predict_one(azr, theta, segments, full_output,
+                                    workspaces[k])
+                values[k] = mu
+                ok[k] = True
+                if full_output:
+                    rwas[k] = r
+            except Exception as e:
+                errors[k] = repr(e)
+    finally:
+        # Workspaces that were not used (if the loop was interrupted).
+        for workspace in workspaces[k+1:]:
+            if workspace is not None:
+                shutil.rmtree(workspace[1])
+                shutil.rmtree(workspace[2])
+                os.remove(workspace[0])
+
+    return BatchResult(values, ok, output_files, rows, rwas, errors)
+
+
+def attach_shared_memory(name):
+    '''
+    Attaches to an existing shared-memory block without handing it to this
+    process's resource tracker (the creating process owns it).
+    '''
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: the workers share the resource tracker of the
+        # process that created the block (see SharedMemoryExecutor.start), so
+        # registering it again is a no-op (and unregistering it would drop
+        # the creator's registration).
+        return shared_memory.SharedMemory(name=name)
+
+
+# State of each worker process of SharedMemoryExecutor.
+_worker_azr = None
+_worker_blocks = {}
+
+def _init_worker(azr, omp_threads):
+    global _worker_azr
+    _worker_azr = azr
+    if omp_threads is not None:
+        os.environ['OMP_NUM_THREADS'] = str(omp_threads)
+
+
+def _predict_into(task):
+    '''
+    Runs one prediction in a worker and writes it into the shared block.
+    Returns a small header: (index, ok, rwas, error message).
+    '''
+    name, shape, k, theta, segments, full_output = task
+    try:
+        mu, rwas = predict_one(_worker_azr, theta, segments, full_output)
+        assert mu.shape == shape[1:], f'''
+Output shape {mu.shape} does not match the expected shape {shape[1:]}.'''
+        if name not in _worker_blocks:
+            # The executor has moved to a new (larger) block.
+            for old in _worker_blocks.values():
+                old.close()
+            _worker_blocks.clear()
+            _worker_blocks[name] = attach_shared_memory(name)
+        block = _worker_blocks[name]
+        values = np.ndarray(shape, dtype=float, buffer=block.buf)
+        values[k] = mu
+        return k, True, rwas, None
+    except Exception as e:
+        return k, False, None, repr(e)
+
+
+class SharedMemoryExecutor:
+    '''
+    Evaluates batches of predictions in a Pool of nprocs processes, with the
+    outputs transported through shared memory.
+
+    nprocs      : number of worker processes
+    omp_threads : OMP_NUM_THREADS for the AZURE2 processes launched by each
+                  worker (inherited if None)
+
+    The workers receive a copy of the AZR object when the pool is started
+    (the first time map is called with it). If the AZR object is modified
+    afterwards, call close() so that the next map call starts a new pool.
+
+    The arrays of a BatchResult are views of the shared block, which is
+    reused by the next map call. Copy them if they need to outlive it.
+    '''
+    def __init__(self, nprocs=None, omp_threads=None):
+        self.nprocs = nprocs if nprocs is not None else os.cpu_count()
+        self.omp_threads = omp_threads
+        self.pool = None
+        self.azr = None
+        self.block = None
+
+
+    def start(self, azr):
+        self.close_pool()
+        # The workers must share this process's resource tracker (see
+        # attach_shared_memory), so it is started before they are.
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+        self.pool = Pool(processes=self.nprocs, initializer=_init_worker,
+                         initargs=(azr, self.omp_threads))
+        self.azr = azr
+
+
+    def allocate(self, nbytes):
+        '''
+        Makes sure the shared block holds at least nbytes.
+        '''
+        from multiprocessing import shared_memory
+        if self.block is not None and self.block.size >= nbytes:
+            return self.block
+        self.release()
+        self.block = shared_memory.SharedMemory(create=True,
+                                                size=max(nbytes, 1))
+        return self.block
+
+
+    def map(self, azr, thetas, segments=None, full_output=False):
+        if self.pool is None or azr is not self.azr:
+            self.start(azr)
+
+        output_files, rows = layout(azr, segments)
+        shape = (len(thetas), sum(rows), NCOLUMNS)
+        block = self.allocate(int(np.prod(shape)) * 8)
+        values = np.ndarray(shape, dtype=float, buffer=block.buf)
+        values[:] = np.nan
+
+        tasks = [(block.name, shape, k, theta, segments, full_output) for
+                 (k, theta) in enumerate(thetas)]
+        headers = self.pool.map(_predict_into, tasks)
+
+        ok = np.zeros(len(thetas), dtype=bool)
+        rwas = [None]*len(thetas) if full_output else None
+        errors = [None]*len(thetas)
+        for (k, success, r, message) in headers:
+            ok[k] = success
+            errors[k] = message
+            if full_output:
+                rwas[k] = r
+
+        return BatchResult(values, ok, output_files, rows, rwas, errors)
+
+
+    def release(self):
+        '''
+        Releases the shared block. Views that are still referenced keep the
+        memory mapped until they are garbage collected.
+        '''
+        if self.block is None:
+            return
+        try:
+            self.block.close()
+        except BufferError:
+            pass
+        self.block.unlink()
+        self.block = None
+
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.pool = None
+        self.azr = None
+
+
+    def close(self):
+        '''
+        Stops the worker processes and releases the shared block.
+        '''
+        self.close_pool()
+        self.release()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def default_candidates(cpus):
+    '''
+    Returns the (nprocs, omp_threads) pairs that use all cpus, with the
+    number of threads a power of 2.
+    '''
+    candidates = []
+    omp_threads = 1
+    while omp_threads <= cpus:
+        candidates.append((cpus // omp_threads, omp_threads))
+        omp_threads *= 2
+    return candidates
+
+
+class AutoscalingExecutor:
+    '''
+    Evaluates batches with a SharedMemoryExecutor whose number of processes
+    and OpenMP threads (per AZURE2 process) are chosen from measurements.
+
+    cpus       : number of cores available (os.cpu_count() if None)
+    candidates : (nprocs, omp_threads) pairs to try (see default_candidates)
+    probes     : number of batches evaluated with each candidate while probing
+    tolerance  : If the throughput (predictions per second, averaged over the
+                 last window batches) drops below tolerance times the
+                 throughput measured for the chosen configuration, every
+                 candidate is probed again (e.g. under memory pressure or I/O
+                 contention).
+    window     : number of batches averaged while monitoring
+    verbose    : Print the chosen configuration?
+
+    The probing batches are ordinary batches: their results are returned.
+    choice holds the chosen (nprocs, omp_threads) and history the
+    throughput of every batch as (nprocs, omp_threads, throughput).
+    '''
+    def __init__(self, cpus=None, candidates=None, probes=1, tolerance=0.7,
+                 window=5, verbose=True):
+        self.cpus = cpus if cpus is not None else os.cpu_count()
+        self.candidates = (candidates if candidates is not None else
+                           default_candidates(self.cpus))
+        self.probes = probes
+        self.tolerance = tolerance
+        self.window = window
+        self.verbose = verbose
+
+        self.executor = None
+        self.configuration = None
+        self.choice = None
+        self.baseline = None
+        self.history = []
+        self.recent = []
+        self.measurements = {}
+        self.queue = []
+        self.reprobe()
+
+
+    def reprobe(self):
+        '''
+        Starts probing every candidate again.
+        '''
+        self.queue = [c for c in self.candidates for _ in range(self.probes)]
+        self.measurements = {}
+        self.recent = []
+
+
+    def use(self, configuration, azr):
+        if configuration == self.configuration:
+            return
+        if self.executor is not None:
+            self.executor.close()
+        nprocs, omp_threads = configuration
+        self.executor = SharedMemoryExecutor(nprocs=nprocs,
+                                             omp_threads=omp_threads)
+        # The pool is started outside of the timed region.
+        self.executor.start(azr)
+        self.configuration = configuration
+
+
+    def map(self, azr, thetas, segments=None, full_output=False):
+        probing = len(self.queue) > 0
+        configuration = self.queue.pop(0) if probing else self.choice
+        self.use(configuration, azr)
+        if self.executor.azr is not azr:
+            self.executor.start(azr)
+
+        start = time.perf_counter()
+        result = self.executor.map(azr, thetas, segments=segments,
+                                   full_output=full_output)
+        throughput = len(thetas) / max(time.perf_counter() - start, 1e-9)
+        self.history.append(configuration + (throughput,))
+
+        if probing:
+            self.measurements.setdefault(configuration, []).append(throughput)
+            if len(self.queue) == 0:
+                self.choose()
+        else:
+            self.recent = (self.recent + [throughput])[-self.window:]
+            if (len(self.recent) == self.window and
+                    np.mean(self.recent) < self.tolerance*self.baseline):
+                if self.verbose:
+                    print(f'''Throughput dropped to {np.mean(self.recent):.3g} \
+predictions/s (from {self.baseline:.3g}). Probing again.''')
+                self.reprobe()
+        return result
+
+
+    def choose(self):
+        throughputs = {c: np.mean(t) for (c, t) in self.measurements.items()}
+        self.choice = max(throughputs, key=throughputs.get)
+        self.baseline = throughputs[self.choice]
+        if self.verbose:
+            print(self.report())
+
+
+    def report(self):
+        '''
+        Returns a description of the chosen configuration, followed by the
+        mean throughput measured for each candidate probed (since the last
+        reprobe).
+        '''
+        if self.choice is None:
+            lines = ['No configuration has been chosen yet.']
+        else:
+            nprocs, omp_threads = self.choice
+            lines = [f'Chosen: {nprocs} processes with '
+                     f'OMP_NUM_THREADS={omp_threads} '
+                     f'({self.baseline:.3g} predictions/s)']
+        for ((nprocs, omp_threads), throughputs) in self.measurements.items():
+            lines.append(f'    {nprocs} processes with '
+                         f'OMP_NUM_THREADS={omp_threads}: '
+                         f'{np.mean(throughputs):.3g} predictions/s '
+                         f'({len(throughputs)} batches)')
+        return '\n'.join(lines)
+
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.close()
+        self.executor = None
+        self.configuration = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,414 @@
+'''
+On-disk caches that spare BRICK work it has already done.
+
+ConfigCache stores the parsed contents of an .azr file (the contents, levels,
+Data and Test) so that new AZR instances, including those created in every
+worker process, do not have to parse the input file and its data files again.
+
+RunCache stores the results of AZURE2 runs (the output directory and the
+captured output), so that a run with the same inputs, started by any AZR
+method in any process, is not repeated.
+'''
+
+import io
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import pickle
+import tarfile
+import hashlib
+import numpy as np
+from . import utility
+from .constants import *
+
+def file_hash(filename):
+    '''
+    Returns the SHA-256 hex digest of the contents of filename.
+    '''
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_signature(filename):
+    '''
+    Returns a dictionary that identifies the current version of filename:
+    its absolute path, modification time (ns), size and hash.
+    '''
+    stat = os.stat(filename)
+    return {
+        'path': os.path.abspath(filename),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': file_hash(filename)
+    }
+
+
+def signature_matches(signature):
+    '''
+    Is the file described by signature (see file_signature) unchanged?
+    The hash is only recomputed if the modification time or size differ.
+    '''
+    try:
+        stat = os.stat(signature['path'])
+    except OSError:
+        return False
+    if (stat.st_mtime_ns == signature['mtime_ns'] and
+            stat.st_size == signature['size']):
+        return True
+    return file_hash(signature['path']) == signature['sha256']
+
+
+class ConfigCache:
+    '''
+    Cache of parsed .azr files.
+
+    Each input file gets its own entry (a directory in the cache directory)
+    that contains:
+        * manifest.json : signatures of the .azr file and its data files
+        * parsed.pkl    : contents, levels, Data and Test (without data points)
+        * values.npy    : data points of all segments (see SegmentTable)
+
+    An entry is only used if none of the files listed in its manifest has
+    changed. The data files are listed in the input file relative to the
+    working directory, and the parsed data depends on whether it is
+    memory-mapped, so entries are kept per working directory and mmap_data
+    setting (see entry).
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+
+    def entry(self, input_filename, mmap_data=False):
+        '''
+        Returns the directory of the entry that belongs to input_filename,
+        parsed in the current working directory with mmap_data.
+        '''
+        key = hashlib.sha256(json.dumps({
+            'input': os.path.abspath(input_filename),
+            'cwd': os.getcwd(),
+            'mmap_data': bool(mmap_data)
+        }, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key)
+
+
+    def load(self, input_filename, mmap_data=False):
+        '''
+        Returns (contents, levels, data, test) for input_filename if a valid
+        entry exists. Otherwise, returns None.
+        '''
+        entry = self.entry(input_filename, mmap_data)
+        try:
+            with open(os.path.join(entry, 'manifest.json'), 'r') as f:
+                manifest = json.load(f)
+            if not all(signature_matches(s) for s in manifest['files']):
+                return None
+            with open(os.path.join(entry, 'parsed.pkl'), 'rb') as f:
+                contents, levels, data, test = pickle.load(f)
+            # Memory-mapped (read-only), so that worker processes share the
+            # pages of the data points.
+            data.table.values = np.load(os.path.join(entry, 'values.npy'),
+                                        mmap_mode='r')
+        except (OSError, ValueError, KeyError, EOFError, pickle.PickleError):
+            return None
+        return contents, levels, data, test
+
+
+    def save(self, input_filename, parsed, mmap_data=False):
+        '''
+        Stores parsed, (contents, levels, data, test), as the entry for
+        input_filename (parsed with mmap_data).
+        Concurrent writers do not interfere with each other: the entry is
+        written to a temporary directory that is then renamed.
+        '''
+        contents, levels, data, test = parsed
+        entry = self.entry(input_filename, mmap_data)
+        tmp = entry + '_' + utility.random_string()
+        os.mkdir(tmp)
+
+        files = [input_filename] + [seg.filepath for seg in data.segments]
+        manifest = {'files': [file_signature(f) for f in files]}
+
+        values = data.table.values
+        data.table.values = None
+        try:
+            with open(os.path.join(tmp, 'parsed.pkl'), 'wb') as f:
+                pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            data.table.values = values
+        np.save(os.path.join(tmp, 'values.npy'), values)
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        if os.path.isdir(entry):
+            old = entry + '_' + utility.random_string()
+            try:
+                os.rename(entry, old)
+                shutil.rmtree(old)
+            except OSError:
+                pass
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another process got there first.
+            shutil.rmtree(tmp)
+
+
+# Random part of the names of workspaces (see utility.random_workspace).
+WORKSPACE_TOKEN = re.compile(r'mcazure_[a-z0-9]+')
+
+# Name of the archive member that holds the captured output of a run.
+RUN_MEMBER = '.brick_run.json'
+
+
+class RunCache:
+    '''
+    Content-addressed cache of AZURE2 runs.
+
+    The key of a run is a hash of everything that determines its output:
+        * the input file (with the random workspace names removed; see
+          utility.FloatFormat for identical formatting of identical values)
+        * the contents of the data files it lists
+        * the AZURE2 binary (path, size and modification time) and its
+          command-line flags
+        * the menu choices written to stdin and the contents of the files
+          they name (e.g. external capture integrals, temperatures)
+    Each entry is a compressed archive (.tar.gz) of the output directory of
+    the run and its captured output. Entries are written atomically (to a
+    temporary file that is then renamed), so processes on the same node can
+    share the cache. When the entries exceed max_size (bytes), the least
+    recently used ones are deleted.
+
+    Runs that exit with a nonzero status are not stored.
+
+    hits, misses : number of runs served from/not found in the cache (by
+                   this instance)
+    '''
+    def __init__(self, directory, max_size=2**30, compresslevel=1):
+        self.directory = directory
+        self.max_size = max_size
+        self.compresslevel = compresslevel
+        os.makedirs(directory, exist_ok=True)
+        self.lock_filename = os.path.join(directory, 'lock')
+        self.hits = 0
+        self.misses = 0
+        # estimate of the size of the entries (see evict)
+        self.size = None
+        # hashes of files, by (path, mtime, size)
+        self.file_hashes = {}
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['file_hashes'] = {}
+        return state
+
+
+    def hash_file(self, filename):
+        stat = os.stat(filename)
+        signature = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        if signature not in self.file_hashes:
+            self.file_hashes[signature] = file_hash(filename)
+        return self.file_hashes[signature]
+
+
+    def key(self, cl_args, options):
+        '''
+        Returns the key of the run of cl_args (see utility.azure2_arguments)
+        with options written to stdin.
+        '''
+        h = hashlib.sha256()
+        def add(text):
+            h.update(text.encode('utf-8'))
+            h.update(b'\x00')
+
+        command = shutil.which(cl_args[0]) or cl_args[0]
+        add(command)
+        if os.path.exists(command):
+            stat = os.stat(command)
+            add(f'{stat.st_size} {stat.st_mtime_ns}')
+        add(' '.join(cl_args[2:]))
+
+        with open(cl_args[1], 'r') as f:
+            contents = f.read()
+        add(WORKSPACE_TOKEN.sub('mcazure_', contents))
+
+        # data files
+        contents = contents.split('\n')
+        start = contents.index('<segmentsData>')+1
+        stop = contents.index('</segmentsData>')
+        for row in contents[start:stop]:
+            row = row.split()
+            if not row:
+                continue
+            offset = 2 if int(row[REACTION_TYPE]) == 2 else 0
+            filepath = row[FILEPATH_INDEX + offset]
+            if os.path.isfile(filepath):
+                add(self.hash_file(filepath))
+
+        # menu choices and the files they name
+        add(WORKSPACE_TOKEN.sub('mcazure_', options))
+        for line in options.split('\n'):
+            if line.strip() and os.path.isfile(line.strip()):
+                add(self.hash_file(line.strip()))
+
+        return h.hexdigest()
+
+
+    def entry(self, key):
+        return os.path.join(self.directory, key[:2], key + '.tar.gz')
+
+
+    def execute(self, cl_args, options, capture=None):
+        '''
+        Like utility.execute, except that the run is served from the cache if
+        possible (and stored in it otherwise).
+        '''
+        with open(cl_args[1], 'r') as f:
+            output_dir = f.read().split('\n')[OUTPUT_DIR_INDEX].strip()
+        output_dir = output_dir.rstrip('/')
+
+        key = self.key(cl_args, options)
+        entry = self.entry(key)
+        response = self.restore(entry, output_dir, cl_args, capture)
+        if response is not None:
+            self.hits += 1
+            return response
+
+        self.misses += 1
+        response = utility.execute(cl_args, options, capture=capture)
+        if capture is not None:
+            if capture.returncode != 0:
+                return response
+            run = {'output': capture.text(), 'returncode': capture.returncode}
+        else:
+            run = {'stdout': response[0], 'stderr': response[1]}
+        self.store(entry, output_dir, run)
+        return response
+
+
+    def restore(self, entry, output_dir, cl_args, capture):
+        '''
+        Extracts the entry into output_dir. Returns what utility.execute
+        would have returned, or None if there is no (readable) entry.
+        '''
+        try:
+            with tarfile.open(entry, 'r:gz') as tar:
+                run = json.loads(tar.extractfile(RUN_MEMBER).read())
+                members = [m for m in tar.getmembers() if m.name != RUN_MEMBER]
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(output_dir, members=members, filter='data')
+                else:
+                    tar.extractall(output_dir, members=members)
+            # The modification time orders the entries by their last use.
+            os.utime(entry)
+        except (OSError, KeyError, ValueError, tarfile.TarError):
+            return None
+
+        if capture is None:
+            if 'stdout' not in run:
+                return None
+            return (run['stdout'], run['stderr'])
+        if 'output' in run:
+            text = run['output']
+        else:
+            text = run.get('stdout', '') + run.get('stderr', '')
+        capture.replay(cl_args, text, run.get('returncode', 0))
+        return capture
+
+
+    def store(self, entry, output_dir, run):
+        '''
+        Writes the archive of output_dir and run (captured output) to entry.
+        '''
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = entry + '_' + utility.random_string()
+        try:
+            with tarfile.open(tmp, 'w:gz',
+                              compresslevel=self.compresslevel) as tar:
+                for name in sorted(os.listdir(output_dir)):
+                    tar.add(os.path.join(output_dir, name), arcname=name)
+                data = json.dumps(run).encode('utf-8')
+                info = tarfile.TarInfo(RUN_MEMBER)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+            size = os.path.getsize(tmp)
+            os.replace(tmp, entry)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        if self.size is None:
+            self.size = self.total_size()
+        else:
+            self.size += size
+        if self.size > self.max_size:
+            self.evict()
+
+
+    def entries(self):
+        '''
+        Returns a list of (modification time, size, path) of every entry.
+        '''
+        entries = []
+        for sub in os.listdir(self.directory):
+            path = os.path.join(self.directory, sub)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if not name.endswith('.tar.gz'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(path, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size,
+                                os.path.join(path, name)))
+        return entries
+
+
+    def total_size(self):
+        return sum(size for (_, size, _) in self.entries())
+
+
+    def evict(self):
+        '''
+        Deletes the least recently used entries until the cache holds at most
+        90% of max_size.
+        '''
+        with open(self.lock_filename, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = sorted(self.entries())
+                total = sum(size for (_, size, _) in entries)
+                for (_, size, path) in entries:
+                    if total <= 0.9*self.max_size:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    total -= size
+                self.size = total
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    def clear(self):
+        '''
+        Deletes every entry.
+        '''
+        for (_, _, path) in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.size = 0
@@ -0,0 +1,105 @@
+'''
+Capture of the AZURE2 output.
+
+AZURE2's output is only needed to diagnose failures, so it is not buffered in
+full. Capture streams the combined stdout and stderr of a run and keeps what
+the policy asks for:
+    'discard' : nothing (the output is sent to /dev/null)
+    'ring'    : the last size KB, in memory
+    'log'     : everything, appended to logfile (the last size KB are also
+                kept in memory)
+'''
+
+from subprocess import Popen, PIPE, STDOUT, DEVNULL
+
+POLICIES = ('discard', 'ring', 'log')
+
+class Capture:
+    '''
+    policy  : 'discard', 'ring' or 'log' (see above)
+    size    : KB of output kept in memory
+    logfile : file the output is appended to (policy 'log')
+
+    After run, returncode holds the exit status of the process and text()
+    returns the output kept in memory.
+    '''
+    def __init__(self, policy='ring', size=16, logfile=None):
+        assert policy in POLICIES, f'''
+Unknown capture policy: {policy}. Choose from {POLICIES}.'''
+        assert policy != 'log' or logfile is not None, '''
+The log capture policy requires a logfile.'''
+        self.policy = policy
+        self.size = size
+        self.logfile = logfile
+        self.buffer = bytearray()
+        self.returncode = None
+
+
+    def run(self, cl_args, options):
+        '''
+        Runs cl_args with options written to stdin and captures the output.
+        Returns the exit status.
+        '''
+        if self.policy == 'discard':
+            p = Popen(cl_args, stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL)
+            p.communicate(options.encode('utf-8'))
+            self.returncode = p.returncode
+            return self.returncode
+
+        limit = self.size * 1024
+        log = None
+        if self.policy == 'log':
+            log = open(self.logfile, 'ab')
+            log.write(('=== ' + ' '.join(cl_args) + '\n').encode('utf-8'))
+        p = None
+        try:
+            p = Popen(cl_args, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+            # The menu choices are short enough to fit in the pipe. The
+            # process may exit without reading them.
+            try:
+                p.stdin.write(options.encode('utf-8'))
+            except BrokenPipeError:
+                pass
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+            for chunk in iter(lambda: p.stdout.read1(65536), b''):
+                if log is not None:
+                    log.write(chunk)
+                self.buffer += chunk
+                if len(self.buffer) > limit:
+                    del self.buffer[:len(self.buffer) - limit]
+        finally:
+            if p is not None:
+                p.stdout.close()
+                self.returncode = p.wait()
+            if log is not None:
+                log.close()
+        return self.returncode
+
+
+    def replay(self, cl_args, text, returncode, note='cached'):
+        '''
+        Handles the output of a run that was not captured by run (e.g. a run
+        that was not repeated; see cache.RunCache) as if it had just been
+        captured.
+        '''
+        self.returncode = returncode
+        if self.policy == 'discard':
+            return
+        data = text.encode('utf-8')
+        if self.policy == 'log':
+            with open(self.logfile, 'ab') as log:
+                log.write((f'=== ({note}) ' + ' '.join(cl_args) + '\n')
+                          .encode('utf-8'))
+                log.write(data)
+        self.buffer = bytearray(data[-self.size*1024:])
+
+
+    def text(self):
+        return self.buffer.decode('utf-8', errors='replace')
+
+
+    def __str__(self):
+        return self.text()
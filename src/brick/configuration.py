@@ -4,18 +4,56 @@ The purpose is to remove as much of this work from AZR as possible.
 '''
 
 from . import utility
+from .cache import ConfigCache
 from .data import Data
 from .nodata import Test
 from .parameter import Parameter
+from .template import InputTemplate
+from .constraints import Constraints
+
+def parse_input_file(input_filename, mmap_data=False):
+    '''
+    Reads the .azr file once and builds every section BRICK needs from its
+    contents.
+    Returns the contents (list of strings), the levels, Data and Test.
+    '''
+    contents = utility.read_input_file(input_filename)
+    levels = utility.read_levels(input_filename, contents=contents)
+    data = Data(input_filename, contents=contents, mmap=mmap_data)
+    test = Test(input_filename, contents=contents)
+    return contents, levels, data, test
+
 
 class Config:
-    def __init__(self, input_filename, parameters=None):
-        self.input_filename = input_filename
+    '''
+    input_filename : .azr file
+    parameters     : list of Parameter instances (inferred from the input file
+                     if None)
+    cache_dir      : Directory of a ConfigCache. If provided, the parsed input
+                     file (including the data) is read from there as long as
+                     none of the files have changed.
+    mmap_data      : Are the data points read from memory-mapped binary copies
+                     of the data files? (See data.load_points.)
+    '''
+    def __init__(self, input_filename, parameters=None, cache_dir=None,
+                 mmap_data=False):
         self.input_filename = input_filename
-        self.input_file_contents = utility.read_input_file(input_filename)
-        self.initial_levels = utility.read_levels(input_filename)
-        self.data = Data(self.input_filename)
-        self.test = Test(self.input_filename)
+
+        parsed = None
+        if cache_dir is not None:
+            cache = ConfigCache(cache_dir)
+            parsed = cache.load(input_filename, mmap_data=mmap_data)
+            if parsed is None:
+                parsed = parse_input_file(input_filename, mmap_data=mmap_data)
+                cache.save(input_filename, parsed, mmap_data=mmap_data)
+        else:
+            parsed = parse_input_file(input_filename, mmap_data=mmap_data)
+        contents, levels, data, test = parsed
+
+        self.input_file_contents = contents
+        self.initial_levels = levels
+        self.data = data
+        self.test = test
 
         if parameters is None:
             self.parameters = []
@@ -64,15 +102,68 @@ class Config:
 
         self.n1 = len(self.parameters)
         self.n2 = len(self.data.norm_segment_indices)
+        # Energy shifts are only sampled if requested (see add_energy_shifts).
+        self.shift_segment_indices = []
+        self.n3 = 0
         # number of free parameters
         self.nd = self.n1 + self.n2
 
+        # formatting of the values written to input files (see
+        # set_significant_digits)
+        self.float_format = utility.FloatFormat()
+
+        # compiled input files (see generate_workspaces)
+        self.templates = {}
+        # compiled extrapolation input files and their output files (see
+        # generate_workspace_extrap)
+        self.extrap_templates = {}
+
         self.labels = []
         for i in range(self.n1):
             self.labels.append(self.parameters[i].label)
         for i in self.data.norm_segment_indices:
             self.labels.append(self.data.segments[i].nf.label)
 
+        # validity checks of thetas (see AZR.predict_batch)
+        self.constraints = Constraints(self)
+
+
+    def set_significant_digits(self, digits):
+        '''
+        Sets the number of significant digits of the values written to input
+        files (None for the shortest exact representation, the default). See
+        utility.FloatFormat.
+        '''
+        self.float_format = utility.FloatFormat(digits)
+        self.templates = {}
+        self.extrap_templates = {}
+
+
+    def add_energy_shifts(self, segment_indices):
+        '''
+        Adds an energy shift (MeV, lab) for each of the data segments
+        identified by segment_indices (indices into self.data.segments) to
+        the sampled parameters. The shifts follow the normalization factors
+        in theta.
+        '''
+        for i in segment_indices:
+            self.shift_segment_indices.append(i)
+            self.labels.append(
+                r'$\delta E_{%d}$' % (self.data.segments[i].index+1)
+            )
+        self.n3 = len(self.shift_segment_indices)
+        self.nd = self.n1 + self.n2 + self.n3
+
+
+    def shifted_data(self, theta):
+        '''
+        Returns the data modified by the energy shifts in theta as a list of
+        (segment index, shifted values) (see AZR.predict, mod_data).
+        '''
+        shifts = theta[self.n1+self.n2:self.n1+self.n2+self.n3]
+        return [(i, self.data.segments[i].shift_energies(shift)) for (i, shift)
+                in zip(self.shift_segment_indices, shifts)]
+
 
     def generate_levels(self, theta):
         levels = self.initial_levels.copy()
@@ -98,6 +189,7 @@ class Config:
                   self.addresses]
         for i in self.data.norm_segment_indices:
             values.append(self.data.segments[i].norm_factor)
+        values += [0.0]*self.n3
         return values
 
 
@@ -107,21 +199,36 @@ class Config:
         has to reflect that. In preparation, the contents of the input file are
         updated here.
         '''
-        contents = self.data.update_all_dir(new_dir, contents)
-        return self.data.write_segments(contents)
+        return self.data.update_all_dir(new_dir, contents)
 
 
-    def generate_workspace(self, theta, prepend='', mod_data=None):
+    def generate_workspace(self, theta, prepend='', mod_data=None,
+                           segment_indices=None, extrap_indices=None):
         '''
         Config handles the configuration of the calculation. That includes:
         * mapping theta to the relevant values in the input file
         * setting up the appropriate workspace for AZR to operate in
+        * (optionally) excluding every data segment that is not listed in
+          segment_indices (indices into self.data.segments)
+        * (optionally) excluding every test segment that is not listed in
+          extrap_indices (indices into self.test.all_segments), so the same
+          input file can be extrapolated (see AZR.evaluate)
+        * applying the sampled energy shifts (see add_energy_shifts) to the
+          data
         '''
         contents = self.input_file_contents.copy()
 
         new_levels = self.generate_levels(theta[:self.n1])
         contents = self.data.update_norm_factors(theta[self.n1:self.n1+self.n2],
-            contents)
+            contents, self.float_format)
+        if segment_indices is not None:
+            contents = self.data.select_segments(segment_indices, contents)
+        if extrap_indices is not None:
+            contents = self.test.select_segments(extrap_indices, contents)
+
+        if self.n3 > 0:
+            mod_data = (list(mod_data) if mod_data is not None else []) + \
+                self.shifted_data(theta)
 
         input_filename, output_dir, data_dir = utility.random_workspace(prepend=prepend)
 
@@ -129,37 +236,72 @@ class Config:
         if mod_data is not None:
             contents = self.data.update_all_dir(data_dir, contents)
             utility.write_input_file(contents, new_levels, input_filename,
-                output_dir)
+                output_dir, float_format=self.float_format)
             for (i, data) in mod_data:
                 self.data.segments[i].update_dir(data_dir, data)
         else:
             utility.write_input_file(contents, new_levels, input_filename,
-                output_dir)
+                output_dir, float_format=self.float_format)
 
         return input_filename, output_dir, data_dir
 
-    def generate_workspace_extrap(self, theta, segment_indices=None):
+    def template(self, segment_indices=None):
         '''
-        Similar to generate_workspace, except the test segments are updated
-        rather than the data segments.
+        Returns the InputTemplate for segment_indices (compiled the first time
+        it is needed).
         '''
-        contents = self.input_file_contents.copy()
+        key = None if segment_indices is None else tuple(segment_indices)
+        if key not in self.templates:
+            self.templates[key] = InputTemplate(self, segment_indices)
+        return self.templates[key]
 
-        # Map theta to a new list of levels.
-        new_levels = self.generate_levels(theta)
 
-        # What extrapolation files need to be read?
-        # If the user specifies the indices of the segments, then make sure
-        # those are "include"d in the calculation and everything else is
-        # excluded.
-        t = Test('', contents=contents)
-        if segment_indices is not None:
-            for (i, test_segment) in enumerate(t.all_segments):
-                test_segment.include = i in segment_indices
-            t.write_segments(contents)
+    def generate_workspaces(self, thetas, prepend='', segment_indices=None):
+        '''
+        Like generate_workspace (without modified data), for every point in
+        thetas, (N, nd) array. The input files are rendered from a compiled
+        InputTemplate (one per set of segment_indices).
+        Returns a list of (input_filename, output_dir, data_dir).
+        '''
+        assert self.n3 == 0, '''
+Input files with sampled energy shifts must be generated one at a time (see
+generate_workspace).'''
+        template = self.template(segment_indices)
+        workspaces = [utility.random_workspace(prepend=prepend) for _ in
+                      range(len(thetas))]
+        template.write(thetas, [w[0] for w in workspaces],
+                       [w[1] for w in workspaces])
+        return workspaces
 
-        # Write the updated contents to the input file and run.
+
+    def extrap_template(self, segment_indices=None):
+        '''
+        Returns the InputTemplate of the extrapolation of the test segments
+        identified by segment_indices (indices into self.test.all_segments;
+        the included segments if None) and the output files it generates.
+        Both are compiled the first time they are needed.
+        '''
+        key = None if segment_indices is None else tuple(segment_indices)
+        if key not in self.extrap_templates:
+            self.extrap_templates[key] = (
+                InputTemplate(self, segment_indices, extrap=True),
+                self.test.get_output_files(segment_indices)
+            )
+        return self.extrap_templates[key]
+
+
+    def generate_workspace_extrap(self, theta, segment_indices=None):
+        '''
+        Similar to generate_workspace, except the test segments are updated
+        rather than the data segments.
+        If the user specifies the indices of the segments, then those are
+        "include"d in the calculation and everything else is excluded.
+        The input file is rendered from the compiled template of the
+        segments (see extrap_template).
+        Returns the input file, the output directory and the extrapolation
+        files that need to be read.
+        '''
+        template, output_files = self.extrap_template(segment_indices)
         input_filename, output_dir = utility.random_output_dir_filename()
-        utility.write_input_file(contents, new_levels, input_filename,
-                                 output_dir)
-        return input_filename, output_dir, t.get_output_files()
+        template.write([theta], [input_filename], [output_dir])
+        return input_filename, output_dir, list(output_files)
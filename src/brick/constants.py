@@ -9,6 +9,10 @@ ENERGY_FIXED_INDEX = 3
 CHANNEL_INDEX = 5
 WIDTH_INDEX = 11
 WIDTH_FIXED_INDEX = 10
+LIGHT_MASS_INDEX = 17
+HEAVY_MASS_INDEX = 18
+LIGHT_CHARGE_INDEX = 19
+HEAVY_CHARGE_INDEX = 20
 SEPARATION_ENERGY_INDEX = 21
 CHANNEL_RADIUS_INDEX = 27
 OUTPUT_DIR_INDEX = 2
@@ -0,0 +1,163 @@
+'''
+Validity checks of points in parameter space, evaluated for a whole batch
+before AZURE2 is launched.
+
+AZURE2 accepts points that are not physical (or not what was set up in the
+input file) and often fails slowly on them. Constraints rejects such points
+with array operations on an (N, nd) array of thetas.
+'''
+
+from collections import Counter
+import numpy as np
+
+from . import utility
+from .constants import LIGHT_MASS_INDEX
+
+class Constraints:
+    '''
+    Rules derived from the Config:
+        * every parameter is finite
+        * normalization factors are positive
+        * anc_consistency: a sampled width of a particle channel is a partial
+          width if the level lies above the separation energy of the channel
+          and an ANC if it lies below it, as AZURE2 interprets the input
+          file (the level energy in the input file relative to the
+          separation energy; Parameter.is_anc is not used, since it is only
+          a label when the parameters are given by hand)
+        * allow_negative_widths: if False, widths (and ANCs) must be
+          non-negative. (AZURE2 uses the sign of a width for the sign of the
+          reduced width amplitude, so negative widths are allowed by default.)
+    Channel radii are not sampled, so they are checked once, when the
+    Constraints are built: a particle channel of an included level with a
+    radius that is not positive fails an assertion (the input file is wrong).
+    Optional rules set by the user:
+        * bounds on each parameter (set_bounds)
+        * priors: functions that map an (N, nd) array of thetas to (N,) log
+          prior densities; points with non-finite values are rejected
+          (add_prior)
+
+    checked  : number of points checked
+    rejected : number of points that failed each rule
+    '''
+    def __init__(self, config):
+        self.anc_consistency = True
+        self.allow_negative_widths = True
+        self.lower = None
+        self.upper = None
+        self.priors = []
+        self.checked = 0
+        self.rejected = Counter()
+
+        n1 = config.n1
+        self.norm_columns = np.arange(n1, n1+config.n2)
+
+        # Column of theta that holds the energy of each level group (-1 if
+        # the energy is not sampled).
+        levels = config.initial_levels
+        energy_column = [-1]*len(levels)
+        for (k, (i, j, kind)) in enumerate(config.addresses):
+            if kind == 'energy':
+                energy_column[i] = k
+
+        # Photon channels have no light particle (mass 0).
+        rows = [row.split() for row in utility.read_level_contents(None,
+                contents=config.input_file_contents) if row != '']
+        first = np.cumsum([0] + [len(group) for group in levels])
+        def is_particle(i, j):
+            return float(rows[first[i]+j][LIGHT_MASS_INDEX]) > 0
+
+        self.width_columns = np.array([k for (k, (i, j, kind)) in
+            enumerate(config.addresses) if kind == 'width'], dtype=int)
+
+        # sampled widths of particle channels
+        threshold = [(k, i, j) for (k, (i, j, kind)) in
+                     enumerate(config.addresses) if kind == 'width' and
+                     is_particle(i, j)]
+        self.threshold_energy_columns = np.array([energy_column[i] for
+            (k, i, j) in threshold], dtype=int)
+        self.energies = np.array([levels[i][j].energy for (k, i, j) in
+                                  threshold], dtype=float)
+        self.separation_energies = np.array([levels[i][j].separation_energy
+                                             for (k, i, j) in threshold],
+                                            dtype=float)
+        self.is_anc = self.energies < self.separation_energies
+
+        for (i, group) in enumerate(levels):
+            for (j, level) in enumerate(group):
+                assert (not level.include or not is_particle(i, j) or
+                        level.channel_radius > 0), f'''
+The channel radius of a particle channel must be positive.
+Level {level.spin}{'+' if level.parity > 0 else '-'}, {level.energy} MeV, \
+channel {level.channel} has a channel radius of {level.channel_radius} fm.
+Check the input file.'''
+
+
+    def __getstate__(self):
+        # Priors are often lambdas, which cannot be pickled. Copies sent to
+        # worker processes (see batch.py) do not check thetas.
+        state = self.__dict__.copy()
+        state['priors'] = []
+        return state
+
+
+    def set_bounds(self, lower=None, upper=None):
+        '''
+        Sets lower and upper bounds (arrays with an entry for every parameter;
+        use -np.inf/np.inf for unbounded parameters).
+        '''
+        self.lower = None if lower is None else np.asarray(lower, dtype=float)
+        self.upper = None if upper is None else np.asarray(upper, dtype=float)
+
+
+    def add_prior(self, log_prior):
+        '''
+        Adds a (vectorized) prior: log_prior(thetas) -> (N,) log densities.
+        '''
+        self.priors.append(log_prior)
+
+
+    def check(self, thetas):
+        '''
+        Returns an (N,) array of bools: which points in thetas, (N, nd)
+        array, satisfy every rule?
+        '''
+        thetas = np.atleast_2d(np.asarray(thetas, dtype=float))
+        valid = np.ones(thetas.shape[0], dtype=bool)
+
+        def apply(mask, rule):
+            failed = int(np.count_nonzero(~mask))
+            if failed > 0:
+                self.rejected[rule] += failed
+                valid[:] &= mask
+
+        apply(np.all(np.isfinite(thetas), axis=1), 'finite')
+        if self.norm_columns.size > 0:
+            apply(np.all(thetas[:, self.norm_columns] > 0, axis=1),
+                  'normalization factor')
+
+        if self.anc_consistency and self.is_anc.size > 0:
+            columns = self.threshold_energy_columns
+            energies = np.where(columns >= 0,
+                                thetas[:, np.maximum(columns, 0)],
+                                self.energies)
+            below = energies < self.separation_energies
+            apply(np.all(below == self.is_anc, axis=1), 'threshold')
+        if not self.allow_negative_widths and self.width_columns.size > 0:
+            apply(np.all(thetas[:, self.width_columns] >= 0, axis=1),
+                  'negative width')
+
+        nd = thetas.shape[1]
+        if self.lower is not None:
+            apply(np.all(thetas >= self.lower[:nd], axis=1), 'bounds')
+        if self.upper is not None:
+            apply(np.all(thetas <= self.upper[:nd], axis=1), 'bounds')
+
+        for log_prior in self.priors:
+            if not valid.any():
+                break
+            log_p = np.full(valid.size, -np.inf)
+            log_p[valid] = log_prior(thetas[valid])
+            apply(np.isfinite(log_p) | ~valid, 'prior')
+
+        self.checked += valid.size
+        return valid
@@ -2,32 +2,93 @@
 Classes to hold Data segments as found in .azr files.
 '''
 
+import os
 import numpy as np
 from . import utility
 from .parameter import NormFactor
 from .constants import *
 
+def count_points(filepath):
+    '''
+    Returns the number of data points (rows) in filepath without parsing
+    them. Blank lines and comments (#) are skipped, as in np.loadtxt.
+    '''
+    n = 0
+    with open(filepath, 'r') as f:
+        for line in f:
+            if line.split('#', 1)[0].strip() != '':
+                n += 1
+    return n
+
+
+def cache_filepath(filepath):
+    '''
+    Returns the binary (.npy) cache of the data file filepath.
+    '''
+    return filepath + '.npy'
+
+
+def load_points(filepath, mmap=False):
+    '''
+    Returns the data points in filepath.
+    If mmap, the points are read from a binary copy (see cache_filepath),
+    which is memory-mapped read-only so that processes reading the same file
+    share its pages. The copy is (re)written whenever it is missing or older
+    than filepath. If it cannot be written, the parsed points are returned.
+    '''
+    if not mmap:
+        return np.loadtxt(filepath)
+    npy = cache_filepath(filepath)
+    try:
+        if os.stat(npy).st_mtime_ns >= os.stat(filepath).st_mtime_ns:
+            return np.load(npy, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    values = np.loadtxt(filepath)
+    tmp = npy + '_' + utility.random_string() + '.npy'
+    try:
+        np.save(tmp, values)
+        os.replace(tmp, npy)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return values
+    return np.load(npy, mmap_mode='r')
+
+
 class Segment:
     '''
     Structure to organize the information contained in a line in the
     <segmentsData> section of an AZURE2 input file.
+
+    The data points are read on first access (values_original), from a
+    memory-mapped binary copy of the data file if mmap (see load_points). Once
+    the segment belongs to a SegmentTable, the table holds them. A separate
+    copy (values) is only stored when the segment is modified by assigning to
+    values.
     '''
-    def __init__(self, row, index):
-        self.row = row.split()
+    __slots__ = ('row', 'index', 'include', 'in_channel', 'out_channel',
+                 'reaction_type', 'norm_factor', 'vary_norm_factor',
+                 'filepath', 'filename', 'nf', 'n', 'output_filename', 'mmap',
+                 '_table', '_position', '_values_original', '_values')
+
+    def __init__(self, row, index, mmap=False):
+        self.row = row
+        row = row.split()
         self.index = index
-        self.include = (int(self.row[INCLUDE_INDEX]) == 1)
-        self.in_channel = int(self.row[IN_CHANNEL_INDEX])
-        self.out_channel = int(self.row[OUT_CHANNEL_INDEX])
-        self.reaction_type = int(self.row[REACTION_TYPE])
+        self.include = (int(row[INCLUDE_INDEX]) == 1)
+        self.in_channel = int(row[IN_CHANNEL_INDEX])
+        self.out_channel = int(row[OUT_CHANNEL_INDEX])
+        self.reaction_type = int(row[REACTION_TYPE])
 
         if self.reaction_type == 2:
-            self.norm_factor = float(self.row[NORM_FACTOR_INDEX + 2])
-            self.vary_norm_factor = int(self.row[VARY_NORM_FACTOR_INDEX + 2])
-            self.filepath = self.row[FILEPATH_INDEX + 2]
+            self.norm_factor = float(row[NORM_FACTOR_INDEX + 2])
+            self.vary_norm_factor = int(row[VARY_NORM_FACTOR_INDEX + 2])
+            self.filepath = row[FILEPATH_INDEX + 2]
         else:
-            self.norm_factor = float(self.row[NORM_FACTOR_INDEX])
-            self.vary_norm_factor = int(self.row[VARY_NORM_FACTOR_INDEX])
-            self.filepath = self.row[FILEPATH_INDEX]
+            self.norm_factor = float(row[NORM_FACTOR_INDEX])
+            self.vary_norm_factor = int(row[VARY_NORM_FACTOR_INDEX])
+            self.filepath = row[FILEPATH_INDEX]
 
         i = self.filepath.rfind('/')
         self.filename = self.filepath[i+1:]
@@ -36,32 +97,79 @@ class Segment:
             self.nf = NormFactor(self.index)
         else:
             self.nf = None
-        
-        self.values_original = np.loadtxt(self.filepath)
-        self.values = np.copy(self.values_original)
-        self.n = self.values.shape[0] if self.values.ndim > 1 else 1
+
+        self.mmap = mmap
+        self._table = None
+        self._position = None
+        self._values = None
+        self._values_original = None
+        if mmap:
+            # The binary copy is written now, and its header gives the shape.
+            values = load_points(self.filepath, mmap=True)
+            self.n = values.shape[0] if values.ndim > 1 else 1
+        else:
+            self.n = count_points(self.filepath)
 
         if self.out_channel != -1:
             self.output_filename = f'AZUREOut_aa={self.in_channel}_R={self.out_channel}.out'
         else:
             self.output_filename = f'AZUREOut_aa={self.in_channel}_TOTAL_CAPTURE.out'
 
-   
-    def string(self):
+
+    @property
+    def values_original(self):
+        '''
+        Data points as read from filepath (read-only).
+        '''
+        if self._table is not None:
+            return self._table.point_values(self._position)
+        if self._values_original is None:
+            self._values_original = load_points(self.filepath, mmap=self.mmap)
+        return self._values_original
+
+
+    @property
+    def values(self):
+        '''
+        Data points used in the calculation. Unless the segment has been
+        modified, these are the original data points.
+        '''
+        if self._values is None:
+            return self.values_original
+        return self._values
+
+
+    @values.setter
+    def values(self, values):
+        self._values = np.array(values)
+
+
+    def attach(self, table, position):
         '''
-        Returns a string of the text in the segment line.
+        Hands the storage of the data points over to table (a SegmentTable),
+        where this segment is stored at row position.
         '''
-        row = self.row.copy()
+        self._table = table
+        self._position = position
+        self._values_original = None
+
+
+    def string(self, float_format=utility.DEFAULT_FLOAT_FORMAT):
+        '''
+        Returns a string of the text in the segment line. The normalization
+        factor is formatted with float_format (see utility.FloatFormat).
+        '''
+        row = self.row.split()
         # Are these lines...
         # row[INCLUDE_INDEX] = '1' if self.include else '0'
         # row[IN_CHANNEL_INDEX] = str(self.in_channel)
         # row[OUT_CHANNEL_INDEX] = str(self.out_channel)
         if self.reaction_type == 2:
             row[FILEPATH_INDEX + 2] = str(self.filepath)
-            row[NORM_FACTOR_INDEX + 2] = str(self.norm_factor)
+            row[NORM_FACTOR_INDEX + 2] = float_format(self.norm_factor)
         else:
             row[FILEPATH_INDEX] = str(self.filepath)
-            row[NORM_FACTOR_INDEX] = str(self.norm_factor)
+            row[NORM_FACTOR_INDEX] = float_format(self.norm_factor)
         # necessary?
         
         return ' '.join(row)
@@ -94,12 +202,112 @@ class Segment:
         return values
 
 
+class SegmentTable:
+    '''
+    Columnar representation of a list of Segments.
+
+    Each attribute is an array with one entry per segment, except for the data
+    points. Those are read on first access, segment by segment (arrays; see
+    load_points). values, which holds the data points of every segment in one
+    concatenated (flat) array, is built when it is first accessed (or set by
+    ConfigCache). The points of segment i are then
+    values[offsets[i]:offsets[i+1]], reshaped to shapes[i].
+    '''
+    __slots__ = ('index', 'include', 'in_channel', 'out_channel',
+                 'reaction_type', 'norm_factor', 'vary_norm_factor', 'n',
+                 'filepaths', 'mmap', 'arrays', 'offsets', 'shapes', '_values')
+
+    def __init__(self, segments):
+        self.index = np.array([seg.index for seg in segments], dtype=int)
+        self.include = np.array([seg.include for seg in segments], dtype=bool)
+        self.in_channel = np.array([seg.in_channel for seg in segments],
+            dtype=int)
+        self.out_channel = np.array([seg.out_channel for seg in segments],
+            dtype=int)
+        self.reaction_type = np.array([seg.reaction_type for seg in segments],
+            dtype=int)
+        self.norm_factor = np.array([seg.norm_factor for seg in segments],
+            dtype=float)
+        self.vary_norm_factor = np.array(
+            [seg.vary_norm_factor for seg in segments], dtype=bool)
+        self.n = np.array([seg.n for seg in segments], dtype=int)
+
+        self.filepaths = [seg.filepath for seg in segments]
+        self.mmap = [seg.mmap for seg in segments]
+        self.arrays = [seg._values_original for seg in segments]
+        self.offsets = None
+        self.shapes = None
+        self._values = None
+
+        for (i, seg) in enumerate(segments):
+            seg.attach(self, i)
+
+
+    @property
+    def values(self):
+        '''
+        Data points of every segment in one flat array.
+        '''
+        if self._values is None:
+            arrays = [np.asarray(self.segment_values(i), dtype=float) for i in
+                      range(len(self.arrays))]
+            self.shapes = [a.shape for a in arrays]
+            self.offsets = np.zeros(len(arrays)+1, dtype=int)
+            self.offsets[1:] = np.cumsum([a.size for a in arrays])
+            if arrays:
+                self._values = np.concatenate([a.ravel() for a in arrays])
+            else:
+                self._values = np.zeros(0)
+        return self._values
+
+
+    @values.setter
+    def values(self, values):
+        # Points set here (see ConfigCache) replace those read segment by
+        # segment. offsets and shapes must already describe them.
+        self._values = values
+        self.arrays = [None]*len(self.arrays)
+
+
+    def segment_values(self, i):
+        '''
+        Returns the data points of the ith segment as read from its file.
+        '''
+        if self.arrays[i] is None:
+            self.arrays[i] = load_points(self.filepaths[i], mmap=self.mmap[i])
+        return self.arrays[i]
+
+
+    def point_values(self, i):
+        '''
+        Returns a read-only view of the data points of the ith segment.
+        '''
+        if self._values is None:
+            values = self.segment_values(i).view()
+        else:
+            values = self._values[self.offsets[i]:self.offsets[i+1]]
+            values = values.reshape(self.shapes[i])
+        values.flags.writeable = False
+        return values
+
+
 class Data:
     '''
     Structure to hold all of the data segments in a provided AZURE2 input file.
     '''
-    def __init__(self, filename):
-        self.contents = utility.read_input_file(filename)
+    def __init__(self, filename, contents=None, mmap=False):
+        '''
+        Takes:
+            * filename : input filename (.azr)
+            * contents : list of strings (generated from the input file)
+            * mmap     : Are the data points read from memory-mapped binary
+                         copies of the data files? (See load_points.)
+        '''
+        # If contents is provided, don't try to read the input file.
+        if contents is not None:
+            self.contents = contents
+        else:
+            self.contents = utility.read_input_file(filename)
         i = self.contents.index('<segmentsData>')+1
         j = self.contents.index('</segmentsData>')
 
@@ -111,25 +319,22 @@ class Data:
                 row_list = row.split()
                 include = (int(row_list[INCLUDE_INDEX]) == 1)
                 if include:
-                    self.segments.append(Segment(row, k))
+                    self.segments.append(Segment(row, k, mmap=mmap))
                 k += 1
 
+        # Columnar representation of the segments. The data points of all
+        # segments are stored (and read when needed) here.
+        self.table = SegmentTable(self.segments)
+
         # Indices of segments with varied normalization constants.
-        self.norm_segment_indices = []
-        for (i, seg) in enumerate(self.segments):
-            if seg.include and seg.vary_norm_factor:
-                self.norm_segment_indices.append(i)
+        self.norm_segment_indices = [int(i) for i in np.flatnonzero(
+            self.table.include & self.table.vary_norm_factor)]
 
         # Number of data points for each included segment.
-        self.ns = [seg.n for seg in self.segments] 
+        self.ns = [int(n) for n in self.table.n]
 
         # Output files that need to be read.
-        self.output_files = []
-        for seg in self.segments:
-            self.output_files.append(seg.output_filename)
-        # Eliminates repeated output files AND SORTS them:
-        # (1, 2, 3, ..., TOTAL_CAPTURE)
-        self.output_files = list(np.unique(self.output_files))
+        self.output_files = self.get_output_files()
 
 
     def update_all_dir(self, new_dir, contents):
@@ -155,7 +360,8 @@ class Data:
 
 
 
-    def write_segments(self, contents):
+    def write_segments(self, contents,
+                       float_format=utility.DEFAULT_FLOAT_FORMAT):
         '''
         Writes the segments to contents.
         "contents" is a representation of the .azr file (list of strings)
@@ -165,19 +371,96 @@ class Data:
         stop = contents.index('</segmentsData>')
 
         for segment in self.segments:
-            contents[start+segment.index] = segment.string()
+            contents[start+segment.index] = segment.string(float_format)
+
+        return contents
+
+
+    def get_output_files(self, segment_indices=None):
+        '''
+        Returns the output files generated by the segments identified by
+        segment_indices (indices into self.segments). If segment_indices is
+        None, all of the included segments are considered.
+        '''
+        if segment_indices is None:
+            segments = self.segments
+        else:
+            segments = [self.segments[i] for i in segment_indices]
+
+        # Eliminates repeated output files AND SORTS them:
+        # (1, 2, 3, ..., TOTAL_CAPTURE)
+        return list(np.unique([seg.output_filename for seg in segments]))
+
+
+    def output_layout(self, segment_indices=None, output_files=None):
+        '''
+        Returns the output files generated by the segments identified by
+        segment_indices (see get_output_files), unless they are given
+        (output_files), and the number of rows in each of them.
+        '''
+        if segment_indices is None:
+            segment_indices = range(len(self.segments))
+        if output_files is None:
+            output_files = self.get_output_files(segment_indices)
+
+        rows = []
+        for of in output_files:
+            rows.append(sum(self.segments[i].n for i in segment_indices if
+                            self.segments[i].output_filename == of))
+        return output_files, rows
+
+
+    def segment_rows(self, segment_indices=None, output_files=None):
+        '''
+        Locates the points of the segments identified by segment_indices in
+        the output files (see output_layout). AZURE2 writes the segments that
+        share an output file in the order they are listed in the input file.
+        Returns a dictionary that maps each segment index to the index of its
+        output file (in output_files) and the slice of its rows.
+        '''
+        if segment_indices is None:
+            segment_indices = range(len(self.segments))
+        if output_files is None:
+            output_files = self.get_output_files(segment_indices)
+
+        offsets = [0]*len(output_files)
+        rows = {}
+        for i in sorted(segment_indices):
+            of = self.segments[i].output_filename
+            if of not in output_files:
+                continue
+            k = output_files.index(of)
+            rows[i] = (k, slice(offsets[k], offsets[k]+self.segments[i].n))
+            offsets[k] += self.segments[i].n
+        return rows
+
+
+    def select_segments(self, segment_indices, contents):
+        '''
+        Flips the include flags in contents so that only the segments
+        identified by segment_indices (indices into self.segments) are
+        computed by AZURE2.
+        '''
+        start = contents.index('<segmentsData>')+1
+
+        for (i, segment) in enumerate(self.segments):
+            row = contents[start+segment.index].split()
+            row[INCLUDE_INDEX] = '1' if i in segment_indices else '0'
+            contents[start+segment.index] = ' '.join(row)
 
         return contents
 
 
-    def update_norm_factors(self, theta_norm, contents):
+    def update_norm_factors(self, theta_norm, contents,
+                            float_format=utility.DEFAULT_FLOAT_FORMAT):
         assert len(theta_norm) == len(self.norm_segment_indices), '''
 Number of normalization factors does not match the number of data segments
 indicating the normalization factor should be varied.
 '''
         for (f, i) in zip(theta_norm, self.norm_segment_indices):
             self.segments[i].norm_factor = f
+            self.table.norm_factor[i] = f
 
-        self.write_segments(contents)
+        self.write_segments(contents, float_format)
         
         return contents
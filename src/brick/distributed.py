@@ -0,0 +1,334 @@
+'''
+Distributed evaluation of batches of predictions across nodes.
+
+BrokerExecutor is an executor (see batch.py) that listens on a socket for
+worker daemons. Each worker receives a copy of the AZR object (including its
+Config), then receives thetas one at a time, runs AZURE2 locally and sends
+the results back. Workers send heartbeats while they compute. Work held by a
+worker that stops responding (or disconnects) is handed to another worker,
+up to max_retries times.
+
+To start workers on another node (which must have access to the data files
+and AZURE2), run
+    python -m brick.distributed --connect HOST:PORT --authkey KEY \
+        --processes N [--workdir DIR]
+where HOST:PORT is executor.address and KEY is executor.authkey.hex().
+'''
+
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+from multiprocessing import Process
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+from .batch import BatchResult, NCOLUMNS, layout, predict_one
+
+
+class BrokerExecutor:
+    '''
+    Task broker for worker daemons on any number of nodes.
+
+    address           : (host, port) the broker listens on (port 0 picks a
+                        free port; see the address attribute after start)
+    authkey           : shared secret (bytes) for the connections (random if
+                        None)
+    heartbeat_timeout : seconds without a message after which a worker that
+                        holds a task is considered dead. map also gives up
+                        on a batch when no worker has been connected for
+                        this long.
+    max_retries       : number of times a task is handed to another worker
+                        before it is marked as failed
+    timeout           : maximum number of seconds map waits for a batch (None
+                        waits indefinitely)
+
+    retries counts the tasks that were handed to another worker.
+    '''
+    def __init__(self, address=('', 0), authkey=None, heartbeat_timeout=30,
+                 max_retries=3, timeout=None):
+        self.authkey = authkey if authkey is not None else os.urandom(16)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.tasks = queue.Queue()
+        self.condition = threading.Condition()
+        self.azr = None
+        self.generation = 0
+        self.batch_id = 0
+        self.results = {}
+        self.processes = []
+        self.nworkers = 0
+        self.retries = 0
+        self.stopped = False
+
+        self.listener = Listener(address, authkey=self.authkey)
+        self.address = self.listener.address
+        self.accept_thread = threading.Thread(target=self.accept, daemon=True)
+        self.accept_thread.start()
+
+
+    def accept(self):
+        '''
+        Accepts worker connections and serves each in its own thread.
+        '''
+        while not self.stopped:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError):
+                if self.stopped:
+                    return
+                continue
+            with self.condition:
+                self.nworkers += 1
+            threading.Thread(target=self.serve, args=(conn,),
+                             daemon=True).start()
+
+
+    def serve(self, conn):
+        '''
+        Hands tasks to the worker on conn until it dies or the broker stops.
+        '''
+        generation = None
+        task = None
+        try:
+            while not self.stopped:
+                try:
+                    task = self.tasks.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                batch_id, k, theta, segments, full_output, attempts = task
+                if batch_id != self.batch_id:
+                    task = None
+                    continue
+
+                if generation != self.generation:
+                    conn.send(('azr', self.azr))
+                    generation = self.generation
+                conn.send(('task', (batch_id, k), theta, segments,
+                           full_output))
+
+                while True:
+                    if not conn.poll(self.heartbeat_timeout):
+                        raise TimeoutError('The worker stopped responding.')
+                    message = conn.recv()
+                    if message[0] == 'heartbeat':
+                        continue
+                    _, key, success, mu, rwas, error = message
+                    if key == (batch_id, k):
+                        self.store(batch_id, k, success, mu, rwas, error)
+                        task = None
+                        break
+        except (OSError, EOFError, TimeoutError):
+            if task is not None:
+                self.retry(task)
+        except Exception as e:
+            # Anything else (e.g. an AZR object that cannot be pickled) would
+            # fail again on another worker: the task fails and this worker
+            # is dropped, since its connection may be in an unknown state.
+            if task is not None:
+                self.store(task[0], task[1], False, None, None, repr(e))
+        finally:
+            with self.condition:
+                self.nworkers -= 1
+            try:
+                conn.send(('stop',))
+            except (OSError, EOFError, ValueError):
+                pass
+            conn.close()
+
+
+    def retry(self, task):
+        '''
+        Puts a task that was lost with its worker back in the queue (or marks
+        it as failed after max_retries attempts).
+        '''
+        batch_id, k, theta, segments, full_output, attempts = task
+        if attempts < self.max_retries:
+            with self.condition:
+                self.retries += 1
+            self.tasks.put((batch_id, k, theta, segments, full_output,
+                            attempts+1))
+        else:
+            self.store(batch_id, k, False, None, None,
+                       'The task was lost with its worker too many times.')
+
+
+    def store(self, batch_id, k, success, mu, rwas, error):
+        with self.condition:
+            if batch_id == self.batch_id and k not in self.results:
+                self.results[k] = (success, mu, rwas, error)
+                self.condition.notify_all()
+
+
+    def map(self, azr, thetas, segments=None, full_output=False):
+        if azr is not self.azr:
+            self.azr = azr
+            self.generation += 1
+
+        output_files, rows = layout(azr, segments)
+        values = np.full((len(thetas), sum(rows), NCOLUMNS), np.nan)
+        ok = np.zeros(len(thetas), dtype=bool)
+        rwas = [None]*len(thetas) if full_output else None
+        errors = [None]*len(thetas)
+
+        with self.condition:
+            self.batch_id += 1
+            self.results = {}
+        for (k, theta) in enumerate(thetas):
+            self.tasks.put((self.batch_id, k, np.asarray(theta), segments,
+                            full_output, 0))
+
+        start = time.time()
+        idle_since = None
+        missing = 'The batch timed out.'
+        with self.condition:
+            while len(self.results) < len(thetas):
+                now = time.time()
+                if self.timeout is not None and now - start > self.timeout:
+                    break
+                if self.nworkers > 0:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = now
+                elif now - idle_since > self.heartbeat_timeout:
+                    missing = f'''
+No worker was connected for {self.heartbeat_timeout} seconds.'''
+                    break
+                self.condition.wait(1.0)
+            results = dict(self.results)
+            # Anything left over from this batch is discarded.
+            self.batch_id += 1
+
+        for k in range(len(thetas)):
+            if k not in results:
+                errors[k] = missing
+                continue
+            success, mu, r, error = results[k]
+            if success and mu.shape == values.shape[1:]:
+                values[k] = mu
+                ok[k] = True
+                if full_output:
+                    rwas[k] = r
+            else:
+                errors[k] = error if error is not None else f'''
+Output shape {mu.shape} does not match the expected shape {values.shape[1:]}.'''
+
+        return BatchResult(values, ok, output_files, rows, rwas, errors)
+
+
+    def spawn_local_workers(self, n, workdir=None):
+        '''
+        Starts n worker daemons on this machine (e.g. for testing).
+        '''
+        host, port = self.address
+        if host in ('', '0.0.0.0'):
+            host = '127.0.0.1'
+        for _ in range(n):
+            p = Process(target=run_worker, args=((host, port), self.authkey),
+                        kwargs={'workdir': workdir}, daemon=True)
+            p.start()
+            self.processes.append(p)
+
+
+    def close(self):
+        '''
+        Stops the broker (workers are told to stop when they ask for work)
+        and any local workers.
+        '''
+        self.stopped = True
+        self.listener.close()
+        for p in self.processes:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self.processes = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def heartbeat(conn, lock, done, interval):
+    while not done.wait(interval):
+        with lock:
+            try:
+                conn.send(('heartbeat',))
+            except (OSError, ValueError):
+                return
+
+
+def run_worker(address, authkey, workdir=None, heartbeat_interval=5):
+    '''
+    Worker daemon: connects to the broker at address and evaluates the tasks
+    it receives until it is told to stop or the connection is lost.
+    '''
+    if workdir is not None:
+        os.chdir(workdir)
+    conn = Client(tuple(address), authkey=authkey)
+    lock = threading.Lock()
+    azr = None
+    try:
+        while True:
+            message = conn.recv()
+            if message[0] == 'stop':
+                break
+            if message[0] == 'azr':
+                azr = message[1]
+                continue
+
+            _, key, theta, segments, full_output = message
+            done = threading.Event()
+            beat = threading.Thread(target=heartbeat,
+                args=(conn, lock, done, heartbeat_interval), daemon=True)
+            beat.start()
+            try:
+                mu, rwas = predict_one(azr, theta, segments, full_output)
+                result = ('result', key, True, mu, rwas, None)
+            except Exception as e:
+                result = ('result', key, False, None, None, repr(e))
+            done.set()
+            beat.join()
+            with lock:
+                conn.send(result)
+    except (EOFError, OSError):
+        pass
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='BRICK worker daemon for BrokerExecutor.')
+    parser.add_argument('--connect', required=True, metavar='HOST:PORT')
+    parser.add_argument('--authkey', required=True,
+                        help='hex-encoded key (executor.authkey.hex())')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--heartbeat', type=float, default=5)
+    args = parser.parse_args(argv)
+
+    host, port = args.connect.rsplit(':', 1)
+    address = (host, int(port))
+    authkey = bytes.fromhex(args.authkey)
+
+    processes = [Process(target=run_worker, args=(address, authkey),
+                         kwargs={'workdir': args.workdir,
+                                 'heartbeat_interval': args.heartbeat})
+                 for _ in range(args.processes)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
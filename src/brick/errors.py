@@ -0,0 +1,57 @@
+'''
+Exceptions raised when AZURE2 fails to produce its output.
+
+The cause of a failure is identified from the (captured) AZURE2 output with
+the regular expressions in PATTERNS, which are checked in order. Failures
+that match none of them are reported as AZURE2Error. Additional patterns
+(taken from the output of failed runs, e.g. a capture log) can be inserted
+into PATTERNS, with subclasses of AZURE2Error.
+'''
+
+import re
+
+class AZURE2Error(Exception):
+    '''
+    AZURE2 did not generate the expected output.
+
+    output     : captured AZURE2 output (stdout and stderr, possibly
+                 truncated; see capture.Capture)
+    returncode : exit status of AZURE2
+    '''
+    def __init__(self, message, output='', returncode=None):
+        super().__init__(message)
+        self.output = output
+        self.returncode = returncode
+
+
+class CoulombFunctionError(AZURE2Error):
+    '''
+    The calculation of the Coulomb functions failed.
+    '''
+
+
+# GSL reports errors through its default error handler (gsl_error in
+# err/error.c), which prints
+#     gsl: <source file>:<line>: ERROR: <reason>
+# (err/stream.c) followed by "Default GSL error handler invoked." and aborts.
+# The Coulomb functions (--gsl-coul) are computed in specfunc/coulomb.c.
+PATTERNS = [
+    (re.compile(r'^gsl: coulomb\.c:\d+: ERROR: .*$', re.MULTILINE),
+     CoulombFunctionError),
+    (re.compile(r'^gsl: \S+:\d+: ERROR: .*$', re.MULTILINE),
+     AZURE2Error),
+]
+
+
+def classify(output, returncode=None,
+             message='AZURE2 did not generate the expected output.'):
+    '''
+    Returns the exception (not raised) that describes the failure reported
+    in output. The matching line is used as the message of classified
+    failures.
+    '''
+    for (pattern, error) in PATTERNS:
+        match = pattern.search(output)
+        if match is not None:
+            return error(match.group(0).strip(), output, returncode)
+    return AZURE2Error(message, output, returncode)
@@ -0,0 +1,176 @@
+'''
+Callbacks that observe the stages of the AZURE2 runs of AZR.
+
+predict, extrapolate, reaction_rate and evaluate go through three stages:
+the input file is rendered into a new workspace, AZURE2 is run (once for each
+menu choice evaluate needs) and its output is parsed. A Hooks registry
+(AZR.hooks) calls the callbacks registered for the events around these
+stages:
+    before_render, after_render : the workspace is generated
+    before_run, after_run       : AZURE2 runs (or the run cache serves it)
+    after_parse                 : the output files have been read (and the
+                                  workspace removed)
+    on_error                    : a stage failed; the exception is raised
+                                  after the callbacks return
+Every callback receives an Event. Typical use, e.g. to find the thetas that
+make AZURE2 slow:
+    def log_slow_run(event):
+        if event.elapsed > 10*typical:
+            print(event.theta, event.elapsed)
+    azr.hooks.register('after_run', log_slow_run)
+
+When no callback is registered, AZR uses NULL_TRACE, which does nothing (no
+clock is read and no events are created). Exceptions raised by a callback
+are not caught.
+'''
+
+import sys
+import time
+import numpy as np
+
+EVENTS = ('before_render', 'after_render', 'before_run', 'after_run',
+          'after_parse', 'on_error')
+
+# The stage that each event ends and the stage it begins.
+ENDS = {'after_render': 'render', 'after_run': 'run', 'after_parse': 'parse'}
+BEGINS = {'before_render': 'render', 'before_run': 'run', 'after_run': 'parse'}
+
+
+class Event:
+    '''
+    name      : event (see EVENTS)
+    method    : AZR method that is observed ('predict', 'extrapolate',
+                'reaction_rate' or 'evaluate')
+    theta     : point in parameter space
+    workspace : (input file, output directory, data directory) of the run;
+                None before the workspace is generated. (The data directory
+                is None for extrapolations.) The files are removed before
+                after_parse and on_error.
+    elapsed   : seconds spent in the stage the event ends (after_render:
+                rendering, after_run: AZURE2, after_parse: reading the
+                output, on_error: the failed stage); None for before_* events
+    timings   : seconds spent in each completed stage of the call so far
+                ('render', 'run', 'parse')
+    total     : seconds since the call began
+    stage     : stage that failed (on_error only)
+    error     : exception that was raised (on_error only)
+    '''
+    def __init__(self, name, method, theta, workspace, elapsed, timings, total,
+                 stage=None, error=None):
+        self.name = name
+        self.method = method
+        self.theta = theta
+        self.workspace = workspace
+        self.elapsed = elapsed
+        self.timings = timings
+        self.total = total
+        self.stage = stage
+        self.error = error
+
+
+class Hooks:
+    '''
+    Registry of callbacks for each event (see EVENTS).
+    '''
+    def __init__(self):
+        self.callbacks = {name: [] for name in EVENTS}
+
+
+    def register(self, name, callback):
+        '''
+        Calls callback(event) at every event called name. Returns the
+        callback.
+        '''
+        assert name in self.callbacks, f'''
+Unknown event {name}. The events are {EVENTS}.'''
+        self.callbacks[name].append(callback)
+        return callback
+
+
+    def remove(self, name, callback):
+        self.callbacks[name].remove(callback)
+
+
+    def clear(self):
+        for callbacks in self.callbacks.values():
+            callbacks.clear()
+
+
+    def __bool__(self):
+        return any(self.callbacks.values())
+
+
+    def trace(self, method, theta):
+        '''
+        Returns the Trace of a call of method at theta, or NULL_TRACE if no
+        callbacks are registered.
+        '''
+        if not self:
+            return NULL_TRACE
+        return Trace(self, method, theta)
+
+
+class Trace:
+    '''
+    Emits the events of one call of an AZR method (see Hooks.trace) and
+    times its stages.
+    '''
+    def __init__(self, hooks, method, theta):
+        self.hooks = hooks
+        self.method = method
+        self.theta = np.asarray(theta, dtype=float)
+        self.workspace = None
+        self.start = time.perf_counter()
+        self.began = {}
+        self.timings = {}
+
+
+    def emit(self, name, workspace=None):
+        now = time.perf_counter()
+        if workspace is not None:
+            self.workspace = workspace
+        elapsed = None
+        if name in ENDS:
+            elapsed = now - self.began.get(ENDS[name], self.start)
+            self.timings[ENDS[name]] = elapsed
+        if name in BEGINS:
+            self.began[BEGINS[name]] = now
+        callbacks = self.hooks.callbacks[name]
+        if callbacks:
+            event = Event(name, self.method, self.theta, self.workspace,
+                          elapsed, dict(self.timings), now - self.start)
+            for callback in callbacks:
+                callback(event)
+
+
+    def error(self, stage, error=None):
+        '''
+        Emits on_error for error, raised in stage. By default, error is the
+        exception being handled (when called in an except clause).
+        '''
+        now = time.perf_counter()
+        if error is None:
+            error = sys.exc_info()[1]
+        callbacks = self.hooks.callbacks['on_error']
+        if callbacks:
+            elapsed = now - self.began.get(stage, self.start)
+            event = Event('on_error', self.method, self.theta, self.workspace,
+                          elapsed, dict(self.timings), now - self.start,
+                          stage=stage, error=error)
+            for callback in callbacks:
+                callback(event)
+
+
+class NullTrace:
+    '''
+    Trace used when no callbacks are registered. Does nothing.
+    '''
+    def emit(self, name, workspace=None):
+        pass
+
+
+    def error(self, stage, error=None):
+        pass
+
+
+NULL_TRACE = NullTrace()
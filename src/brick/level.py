@@ -15,6 +15,10 @@ class Level:
     index   : Which spin^{parity} level is this? (There are frequently more than
               one. Consistent with the language, these are zero-based.)
     '''
+    __slots__ = ('spin', 'parity', 'energy', 'energy_fixed', 'width',
+                 'width_fixed', 'channel_radius', 'channel',
+                 'separation_energy', 'include')
+
     def __init__(self, row_str):
         row = row_str.split()
         self.spin = float(row[J_INDEX])
@@ -14,6 +14,9 @@ class TestSegment:
     Contains a single row within the <segmentsTest> section of a AZURE2 input
     file.
     '''
+    __slots__ = ('row', 'include', 'in_channel', 'out_channel',
+                 'output_filename')
+
     def __init__(self, row):
         self.row = row.split()
         self.include = (int(self.row[INCLUDE_INDEX]) == 1)
@@ -25,12 +28,15 @@ class TestSegment:
             self.output_filename = f'AZUREOut_aa={self.in_channel}_TOTAL_CAPTURE.extrap'
 
 
-    def string(self):
+    def string(self, include=None):
         '''
-        Returns a string of the text in the segment line.
+        Returns a string of the text in the segment line (with the include
+        flag set to include, if provided).
         '''
+        if include is None:
+            include = self.include
         row = self.row.copy()
-        row[INCLUDE_INDEX] = '1' if self.include else '0'
+        row[INCLUDE_INDEX] = '1' if include else '0'
         row[IN_CHANNEL_INDEX] = str(self.in_channel)
         
         return ' '.join(row)
@@ -90,18 +96,36 @@ class Test:
 
         return contents
 
+
+    def select_segments(self, segment_indices, contents):
+        '''
+        Writes the segments to contents with the include flags set so that
+        only the segments identified by segment_indices (indices into
+        self.all_segments) are computed by AZURE2. The segments themselves are
+        not changed.
+        '''
+        start = contents.index('<segmentsTest>')+1
+        stop = contents.index('</segmentsTest>')
+
+        for (i, (k, segment)) in zip(range(start, stop),
+                                     enumerate(self.all_segments)):
+            contents[i] = segment.string(include=(k in segment_indices))
+
+        return contents
+
     
-    def get_output_files(self):
-        segments = [] #  only the segments to be included in the calculation
-        for seg in self.all_segments:
-            if seg.include:
-                segments.append(seg)
-       
-        output_files = []
-        for seg in segments:
-            output_files.append(seg.output_filename)
+    def get_output_files(self, segment_indices=None):
+        '''
+        Returns the output files generated by the segments identified by
+        segment_indices (indices into self.all_segments). If segment_indices
+        is None, all of the included segments are considered.
+        '''
+        if segment_indices is None:
+            segments = [seg for seg in self.all_segments if seg.include]
+        else:
+            segments = [self.all_segments[i] for i in segment_indices]
 
-        return list(np.unique(output_files))
+        return list(np.unique([seg.output_filename for seg in segments]))
 
 
     def show_test_segments(self):
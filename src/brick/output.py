@@ -1,5 +1,31 @@
 import numpy as np
 
+# Names of the columns of the AZUREOut_*.out files (see Output).
+COLUMNS = ('e_com', 'e_x', 'angle_com', 'xs_com_fit', 'sf_com_fit',
+           'xs_com_data', 'xs_err_com_data', 'sf_com_data', 'sf_err_com_data')
+
+# Columns that depend on the R-matrix parameters. The others only depend on
+# the data (and its normalization).
+FIT_COLUMNS = (3, 4)
+
+
+def column_indices(columns):
+    '''
+    Returns the indices of columns (names in COLUMNS or indices).
+    '''
+    indices = []
+    for c in columns:
+        if isinstance(c, str):
+            assert c in COLUMNS, f'''
+Unknown column: {c}. Choose from {COLUMNS}.'''
+            indices.append(COLUMNS.index(c))
+        else:
+            assert 0 <= c < len(COLUMNS), f'''
+Column indices must be between 0 and {len(COLUMNS)-1}.'''
+            indices.append(int(c))
+    return indices
+
+
 class Output:
     '''
     Packages AZURE2 output.
@@ -34,6 +60,35 @@ class Output:
         self.sf_err_com_data = self.contents[:, 8]
 
 
+class Evaluation:
+    '''
+    Products of one point in parameter space (see AZR.evaluate).
+
+    theta        : point in parameter space
+    data         : output of each file in output_files (list of arrays, or of
+                   Output instances if dressed up); None if not requested
+    output_files : output files (AZUREOut_*.out) of the data segments
+    extrap       : output of each file in extrap_files (list of arrays); None
+                   if not requested
+    extrap_files : output files (AZUREOut_*.extrap) of the test segments
+    rwas         : reduced width amplitudes (see utility.read_rwas_jpi); None
+                   if not requested
+    rate         : (temperature, rate) rows of the reaction rate; None if not
+                   requested
+    choices      : menu choices of the AZURE2 runs that produced them
+    '''
+    def __init__(self, theta, data=None, output_files=None, extrap=None,
+                 extrap_files=None, rwas=None, rate=None, choices=None):
+        self.theta = theta
+        self.data = data
+        self.output_files = output_files
+        self.extrap = extrap
+        self.extrap_files = extrap_files
+        self.rwas = rwas
+        self.rate = rate
+        self.choices = choices if choices is not None else []
+
+
 class OutputList:
     '''
     List of Output objects.
@@ -10,13 +10,18 @@ class Parameter:
     rank    : Which spin^{parity} level is this? (There are frequently
               more than one. Consistent with AZURE2, these are 
               one-based.)
+    is_anc  : Is the "width" an asymptotic normalization coefficient (ANC)?
     '''
+    __slots__ = ('spin', 'parity', 'kind', 'channel', 'rank', 'is_anc',
+                 'label')
+
     def __init__(self, spin, parity, kind, channel, rank=1, is_anc=False):
         self.spin = spin
         self.parity = parity
         self.kind = kind
         self.channel = int(channel)
         self.rank = rank
+        self.is_anc = is_anc
         
         jpi_label = '+' if self.parity == 1 else '-'
         subscript = f'{rank:d},{channel:d}'
@@ -50,6 +55,8 @@ class NormFactor:
     '''
     Defines a sampled normalization factor (n_i in the AZURE2 manual).
     '''
+    __slots__ = ('index', 'label')
+
     def __init__(self, dataset_index):
         self.index = dataset_index
         self.label = r'$n_{%d}$' % (self.index+1)
@@ -0,0 +1,84 @@
+'''
+Maxwellian-averaged reaction rates computed in this process.
+
+AZURE2 computes reaction rates (AZR.reaction_rate) with a complete R-matrix
+calculation on its own energy grid for every theta. Given the S factor on a
+fixed energy grid (e.g. one extrapolation of a test segment), the rate at
+every temperature is a weighted sum of the S factor:
+    N_A<sigma v>(T9) = 3.7318e10 mu^(-1/2) T9^(-3/2)
+                       * int S(E) exp(-2 pi eta(E) - 11.605 E/T9) dE,
+with 2 pi eta = 0.989534 Z1 Z2 sqrt(mu/E), E in MeV (center of mass), S in
+MeV b, mu in amu and the rate in cm^3 mol^-1 s^-1. The weights of the
+trapezoidal rule are computed once (MaxwellianRate), so each rate is a
+matrix-vector product.
+'''
+
+import numpy as np
+
+from . import utility
+from .constants import *
+
+def trapezoid_weights(x):
+    '''
+    Returns the weights w such that sum(w*f) is the trapezoidal rule for the
+    integral of f over the points x.
+    '''
+    dx = np.diff(x)
+    w = np.zeros_like(x)
+    w[:-1] += dx/2
+    w[1:] += dx/2
+    return w
+
+
+def pair_properties(contents, pair):
+    '''
+    Returns the reduced mass (amu) and the charges of the particles of the
+    particle pair (channel) in the levels of an input file (see
+    utility.read_input_file).
+    '''
+    for row in utility.read_level_contents(None, contents=contents):
+        if row == '':
+            continue
+        row = row.split()
+        if int(row[CHANNEL_INDEX]) == pair:
+            m1 = float(row[LIGHT_MASS_INDEX])
+            m2 = float(row[HEAVY_MASS_INDEX])
+            z1 = float(row[LIGHT_CHARGE_INDEX])
+            z2 = float(row[HEAVY_CHARGE_INDEX])
+            return m1*m2/(m1 + m2), z1, z2
+    raise ValueError(f'Particle pair {pair} is not used by any level.')
+
+
+class MaxwellianRate:
+    '''
+    energies     : center-of-mass energies (MeV) of the S factor
+    temperatures : temperatures (GK)
+    mu           : reduced mass of the entrance pair (amu)
+    z1, z2       : charges of the entrance pair
+
+    weights : (len(temperatures), len(energies)) array
+    '''
+    def __init__(self, energies, temperatures, mu, z1, z2):
+        self.energies = np.asarray(energies, dtype=float)
+        self.temperatures = np.atleast_1d(np.asarray(temperatures,
+                                                     dtype=float))
+        assert np.all(np.diff(self.energies) > 0), '''
+The energies must increase.'''
+
+        e = self.energies[None, :]
+        t9 = self.temperatures[:, None]
+        with np.errstate(divide='ignore'):
+            exponent = -0.989534*z1*z2*np.sqrt(mu/e) - 11.605*e/t9
+        # Points at or below threshold do not contribute.
+        exponent = np.where(e > 0, exponent, -np.inf)
+        self.weights = (3.7318e10 / np.sqrt(mu) * t9**-1.5 *
+                        trapezoid_weights(self.energies) * np.exp(exponent))
+
+
+    def __call__(self, sfactors):
+        '''
+        Returns the rates at every temperature for the S factor(s) on the
+        energy grid: (len(energies),) -> (len(temperatures),) or
+        (N, len(energies)) -> (N, len(temperatures)).
+        '''
+        return np.asarray(sfactors) @ self.weights.T
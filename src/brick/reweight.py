@@ -0,0 +1,221 @@
+'''
+Importance reweighting of posterior samples.
+
+Changing the prior, the data segments included in the likelihood or the
+uncertainties of a segment changes the posterior, but samples of the old
+posterior can be reweighted to the new one without new AZURE2 runs:
+    w_i ∝ p_new(theta_i) / p_old(theta_i).
+The likelihood is a sum over segments, so the (log) likelihood of any
+selection of segments follows from the per-segment components of every sample
+(segment_log_likelihoods), which in turn follow from stored predictions (see
+store.PredictionStore).
+
+The weights are Pareto-smoothed (PSIS; Vehtari et al. 2024, "Pareto smoothed
+importance sampling"). The shape k of the generalized Pareto distribution
+fitted to the largest weights tells whether the reweighted estimates can be
+trusted (k < 0.7) or whether the new posterior must be sampled.
+'''
+
+import numpy as np
+
+# Columns of the .out files: (calculation, data, uncertainty).
+COLUMNS = {'xs': (3, 5, 6), 'sf': (4, 7, 8)}
+
+
+def segment_log_likelihoods(predictions, data, output_files=None,
+                            quantity='xs', scales=None):
+    '''
+    Returns the Gaussian log likelihood of every included segment for every
+    prediction, (N, number of segments) array.
+    predictions  : N predictions, each a list of arrays (as returned by
+                   AZR.predict with dress_up=False); None for a sample whose
+                   prediction is not known (its row is NaN)
+    data         : Data (AZR.config.data)
+    output_files : output files of the predictions (all by default; see
+                   Data.get_output_files)
+    quantity     : 'xs' (cross section) or 'sf' (S factor)
+    scales       : factor applied to the uncertainty of each segment (1 if
+                   None)
+    '''
+    (fit, y, dy) = COLUMNS[quantity]
+    rows = data.segment_rows(output_files=output_files)
+    nseg = len(data.segments)
+    if scales is None:
+        scales = np.ones(nseg)
+    components = np.full((len(predictions), nseg), np.nan)
+    for (n, prediction) in enumerate(predictions):
+        if prediction is None:
+            continue
+        for (i, (k, rows_i)) in rows.items():
+            values = prediction[k][rows_i]
+            sigma = scales[i]*values[:, dy]
+            components[n, i] = np.sum(-np.log(np.sqrt(2*np.pi)*sigma) -
+                                      0.5*((values[:, y] - values[:, fit])/
+                                           sigma)**2)
+    return components
+
+
+def stored_predictions(store, positions):
+    '''
+    Returns the predictions of the records at positions (e.g. from
+    PredictionStore.locate) in a PredictionStore; None where there is no
+    record (position -1) or no stored prediction.
+    '''
+    return [store.read(i)['prediction'] if i >= 0 else None for i in
+            np.ravel(positions)]
+
+
+def segment_log_ratios(components, old_segments, new_segments):
+    '''
+    Returns ln(L_new/L_old) for every sample, where the likelihoods are the
+    sums of the components (see segment_log_likelihoods) of the segments in
+    old_segments and new_segments (lists of indices).
+    '''
+    components = np.asarray(components, dtype=float)
+    old = components[:, list(old_segments)].sum(axis=1)
+    new = components[:, list(new_segments)].sum(axis=1)
+    return new - old
+
+
+def prior_log_ratios(samples, old_log_prior, new_log_prior):
+    '''
+    Returns ln(Pi_new/Pi_old) for every sample, (N, nd) array. The log priors
+    are functions of theta.
+    '''
+    old = np.array([old_log_prior(theta) for theta in samples], dtype=float)
+    new = np.array([new_log_prior(theta) for theta in samples], dtype=float)
+    with np.errstate(invalid='ignore'):
+        return new - old
+
+
+def log_sum_exp(x):
+    m = np.max(x)
+    return m + np.log(np.sum(np.exp(x - m)))
+
+
+def fit_generalized_pareto(x):
+    '''
+    Returns the shape (k) and scale (sigma) of the generalized Pareto
+    distribution fitted to the sorted (increasing), positive values x (Zhang &
+    Stephens 2009, with the weakly informative prior on k of Vehtari et al.).
+    '''
+    n = x.size
+    m = 30 + int(np.sqrt(n))
+    b = 1 - np.sqrt(m / (np.arange(1, m+1) - 0.5))
+    b /= 3 * x[int(n/4 + 0.5) - 1]
+    b += 1 / x[-1]
+    k = np.mean(np.log1p(-b[:, None] * x), axis=1)
+    profile = n * (np.log(-b/k) - k - 1)
+    weights = 1 / np.sum(np.exp(profile[None, :] - profile[:, None]), axis=1)
+    keep = weights >= 10*np.finfo(float).eps
+    b = b[keep]
+    weights = weights[keep] / np.sum(weights[keep])
+    b_post = np.sum(b * weights)
+    k_post = np.mean(np.log1p(-b_post * x))
+    sigma = -k_post / b_post
+    k_post = (n*k_post + 5) / (n + 10)
+    return k_post, sigma
+
+
+def pareto_smooth(log_ratios):
+    '''
+    Returns the Pareto-smoothed, normalized log weights and the Pareto shape
+    k. If the tail is too short to fit (e.g. the log ratios are (nearly)
+    constant, so no weight stands out), the weights are not smoothed and k
+    is -np.inf.
+    '''
+    log_weights = np.array(log_ratios, dtype=float)
+    n = log_weights.size
+    log_weights -= np.max(log_weights)
+
+    m = int(np.ceil(min(0.2*n, 3*np.sqrt(n))))
+    order = np.argsort(log_weights)
+    cutoff = max(log_weights[order[-m-1]], np.log(np.finfo(float).tiny))
+    tail = order[log_weights[order] > cutoff]
+    k = -np.inf
+    if tail.size > 4:
+        x = np.exp(log_weights[tail]) - np.exp(cutoff)
+        k, sigma = fit_generalized_pareto(x)
+        if np.isfinite(k) and sigma > 0:
+            # Replace the tail by the expected order statistics of the fit.
+            p = np.arange(0.5, tail.size) / tail.size
+            if abs(k) < np.finfo(float).eps:
+                quantiles = -sigma*np.log1p(-p)
+            else:
+                quantiles = sigma*np.expm1(-k*np.log1p(-p)) / k
+            log_weights[tail] = np.minimum(
+                np.log(quantiles + np.exp(cutoff)), 0)
+
+    return log_weights - log_sum_exp(log_weights), k
+
+
+class Reweighting:
+    '''
+    Importance weights of samples for a new posterior.
+
+    log_ratios  : ln(p_new/p_old) for every sample (e.g. the sum of
+                  prior_log_ratios and segment_log_ratios); NaN where it is
+                  not known
+    k_threshold : largest Pareto k for which the weights are reliable
+
+    weights          : normalized (Pareto-smoothed) weights; 0 for samples
+                       that need evaluation
+    k                : Pareto shape of the tail of the weights (-inf if the
+                       tail is too short to fit, see pareto_smooth; inf if
+                       no sample has a finite log ratio)
+    ess              : effective sample size, 1/sum(w^2)
+    reliable         : k < k_threshold?
+    needs_evaluation : samples whose log ratio is not known (NaN), e.g.
+                       because no prediction was stored for them. Only these
+                       need to be evaluated (with AZURE2); the weights are
+                       then computed again.
+    '''
+    def __init__(self, log_ratios, k_threshold=0.7):
+        log_ratios = np.asarray(log_ratios, dtype=float)
+        self.needs_evaluation = np.isnan(log_ratios)
+        known = ~self.needs_evaluation
+        self.weights = np.zeros(log_ratios.size)
+        self.k = np.inf
+        # Samples with ln(ratio) = -inf (e.g. outside the new prior) get 0.
+        finite = known & np.isfinite(log_ratios)
+        assert not np.any(log_ratios == np.inf), '''
+Some samples have a log ratio of +inf. They are impossible under the old
+posterior.'''
+        if np.any(finite):
+            log_weights, self.k = pareto_smooth(log_ratios[finite])
+            self.weights[finite] = np.exp(log_weights)
+        self.ess = 1/np.sum(self.weights**2) if np.any(finite) else 0.0
+        self.k_threshold = k_threshold
+        self.reliable = bool(self.k < k_threshold)
+
+
+    def mean(self, values):
+        '''
+        Returns the weighted mean of values, (N, ...) array with one entry
+        per sample.
+        '''
+        values = np.asarray(values, dtype=float)
+        w = self.weights.reshape((-1,) + (1,)*(values.ndim-1))
+        return np.sum(w*np.where(w > 0, values, 0), axis=0)
+
+
+    def resample(self, n=None, seed=None):
+        '''
+        Returns the indices of n samples drawn with replacement according to
+        the weights (ess samples by default).
+        '''
+        rng = np.random.default_rng(seed)
+        if n is None:
+            n = int(self.ess)
+        return rng.choice(self.weights.size, size=n, p=self.weights)
+
+
+    def report(self):
+        '''
+        Returns a summary of the diagnostics.
+        '''
+        status = 'reliable' if self.reliable else 'unreliable: sample again'
+        return (f'Pareto k = {self.k:.2f} ({status}), '
+                f'ESS = {self.ess:.1f} of {self.weights.size}, '
+                f'{int(np.count_nonzero(self.needs_evaluation))} samples '
+                f'need evaluation')
@@ -0,0 +1,272 @@
+'''
+Parallel-tempering (multi-temperature) ensemble sampling built around AZR.
+
+R-matrix posteriors are frequently multimodal (e.g. the signs of partial
+widths and interference solutions). PTSampler runs an ensemble of walkers at
+each of K temperatures, proposes swaps between neighboring temperatures, and
+(optionally) adapts the temperature ladder. All of the proposals made at a
+given half-step, for every walker at every temperature, are evaluated with a
+single pool.map call, so K temperatures cost (roughly) the wall-clock time of
+one when there are enough processes.
+'''
+
+import numpy as np
+
+def default_betas(ntemps, tmax=None):
+    '''
+    Returns a geometric ladder of ntemps inverse temperatures from 1 to 1/tmax.
+    By default, each temperature is twice the previous one.
+    '''
+    if tmax is None:
+        tmax = 2.0**(ntemps-1)
+    return np.logspace(0, -np.log10(tmax), ntemps)
+
+
+class PTSampler:
+    '''
+    Parallel-tempering affine-invariant (stretch move) ensemble sampler.
+
+    ntemps          : number of temperatures (K)
+    nwalkers        : number of walkers at each temperature (even)
+    ndim            : number of sampled parameters
+    log_likelihood  : function of theta that returns ln(L) (typically calls
+                      AZR.predict); evaluated through pool
+    log_prior       : function of theta that returns ln(Pi); evaluated in this
+                      process, and log_likelihood is only evaluated where it is
+                      finite
+    pool            : object with a map method (e.g. multiprocessing.Pool)
+    betas           : initial inverse temperatures, betas[0] = 1
+                      (default_betas(ntemps) if None)
+    adapt           : Adapt the ladder to equalize the swap acceptance
+                      fractions (Vousden, Farr & Mandel 2016)?
+    adaptation_lag  : time scale (steps) of the decay of the adaptation
+    adaptation_time : time scale (steps) of the adaptation
+    a               : stretch-move scale parameter
+    backend         : filename of an HDF5 file. The beta = 1 chain is written
+                      to the group "mcmc", so it can be read with
+                      emcee.backends.HDFBackend(backend). The chain at
+                      temperature k is written to "temperature_k". (Requires
+                      emcee and h5py.)
+    seed            : seed of the random number generator
+    '''
+    def __init__(self, ntemps, nwalkers, ndim, log_likelihood, log_prior,
+                 pool=None, betas=None, adapt=True, adaptation_lag=10000,
+                 adaptation_time=100, a=2.0, backend=None, seed=None):
+        assert nwalkers % 2 == 0, 'The number of walkers must be even.'
+        self.ntemps = ntemps
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.log_likelihood = log_likelihood
+        self.log_prior = log_prior
+        self.pool = pool
+        self.betas = (np.array(betas, dtype=float) if betas is not None else
+                      default_betas(ntemps))
+        assert self.betas.size == ntemps, '''
+The number of inverse temperatures does not match the number of temperatures.'''
+        self.adapt = adapt
+        self.adaptation_lag = adaptation_lag
+        self.adaptation_time = adaptation_time
+        self.a = a
+        self.random = np.random.RandomState(seed)
+
+        self.backends = None
+        if backend is not None:
+            import emcee
+            names = ['mcmc'] + [f'temperature_{k}' for k in range(1, ntemps)]
+            self.backends = [emcee.backends.HDFBackend(backend, name=name)
+                             for name in names]
+            for b in self.backends:
+                b.reset(nwalkers, ndim)
+
+        self.reset()
+
+
+    def reset(self):
+        '''
+        Clears the stored chains and acceptance statistics.
+        '''
+        self.time = 0
+        self.chain = []
+        self.log_likelihoods = []
+        self.log_priors = []
+        self.beta_history = []
+        self.naccepted = np.zeros((self.ntemps, self.nwalkers))
+        self.nswap_accepted = np.zeros(self.ntemps-1)
+        self.nswap_proposed = np.zeros(self.ntemps-1)
+        self.nevaluations = 0
+
+
+    def evaluate(self, thetas):
+        '''
+        Takes an array of points (M, ndim).
+        Returns ln(L) and ln(Pi) at each point. ln(L) is -inf wherever ln(Pi)
+        is -inf. All likelihood evaluations are dispatched at once.
+        '''
+        log_priors = np.array([self.log_prior(theta) for theta in thetas],
+                              dtype=float)
+        log_likelihoods = np.full(len(thetas), -np.inf)
+        valid = np.flatnonzero(np.isfinite(log_priors))
+        if valid.size > 0:
+            mapper = self.pool.map if self.pool is not None else map
+            results = mapper(self.log_likelihood, [thetas[i] for i in valid])
+            log_likelihoods[valid] = np.array(list(results), dtype=float)
+            self.nevaluations += valid.size
+        log_likelihoods[np.isnan(log_likelihoods)] = -np.inf
+        return log_likelihoods, log_priors
+
+
+    def stretch(self, p, ll, lp, half):
+        '''
+        Updates the walkers in one half of the ensemble (at every temperature)
+        with stretch moves whose partners are drawn from the other half.
+        '''
+        nhalf = self.nwalkers // 2
+        active = np.arange(half*nhalf, (half+1)*nhalf)
+        partners = np.arange((1-half)*nhalf, (2-half)*nhalf)
+
+        z = ((self.a - 1) * self.random.uniform(size=(self.ntemps, nhalf))
+             + 1)**2 / self.a
+        choice = partners[self.random.randint(nhalf,
+                                              size=(self.ntemps, nhalf))]
+        rows = np.arange(self.ntemps)[:, None]
+        complement = p[rows, choice]
+        proposals = complement + z[:, :, None] * (p[:, active] - complement)
+
+        new_ll, new_lp = self.evaluate(proposals.reshape(-1, self.ndim))
+        new_ll = new_ll.reshape(self.ntemps, nhalf)
+        new_lp = new_lp.reshape(self.ntemps, nhalf)
+
+        with np.errstate(invalid='ignore'):
+            log_ratio = ((self.ndim - 1) * np.log(z)
+                         + self.betas[:, None] * (new_ll - ll[:, active])
+                         + new_lp - lp[:, active])
+        accept = np.log(self.random.uniform(size=log_ratio.shape)) < log_ratio
+        accept &= np.isfinite(new_lp)
+
+        index = np.nonzero(accept)
+        p[index[0], active[index[1]]] = proposals[accept]
+        ll[index[0], active[index[1]]] = new_ll[accept]
+        lp[index[0], active[index[1]]] = new_lp[accept]
+        self.naccepted[:, active] += accept
+        return p, ll, lp
+
+
+    def swap(self, p, ll, lp):
+        '''
+        Proposes swaps between every walker and a random walker at the next
+        (colder) temperature, from the hottest pair of temperatures down.
+        Returns the swap acceptance fraction of each pair at this step.
+        '''
+        fractions = np.zeros(self.ntemps-1)
+        for k in range(self.ntemps-1, 0, -1):
+            j = self.random.permutation(self.nwalkers)
+            db = self.betas[k-1] - self.betas[k]
+            with np.errstate(invalid='ignore'):
+                log_ratio = db * (ll[k] - ll[k-1, j])
+            accept = np.log(self.random.uniform(size=self.nwalkers)) < log_ratio
+            i = np.flatnonzero(accept)
+            ij = j[i]
+
+            p[k, i], p[k-1, ij] = p[k-1, ij].copy(), p[k, i].copy()
+            ll[k, i], ll[k-1, ij] = ll[k-1, ij].copy(), ll[k, i].copy()
+            lp[k, i], lp[k-1, ij] = lp[k-1, ij].copy(), lp[k, i].copy()
+
+            fractions[k-1] = i.size / self.nwalkers
+            self.nswap_accepted[k-1] += i.size
+            self.nswap_proposed[k-1] += self.nwalkers
+        return fractions
+
+
+    def adapt_betas(self, fractions):
+        '''
+        Moves the intermediate temperatures so that the swap acceptance
+        fractions of all pairs become equal. The first and last temperatures
+        are fixed.
+        '''
+        decay = self.adaptation_lag / (self.time + self.adaptation_lag)
+        kappa = decay / self.adaptation_time
+        dSs = kappa * (fractions[:-1] - fractions[1:])
+        deltaTs = np.diff(1 / self.betas[:-1]) * np.exp(dSs)
+        self.betas[1:-1] = 1 / (np.cumsum(deltaTs) + 1 / self.betas[0])
+
+
+    def run_mcmc(self, p0, nsteps, thin=1, progress=False):
+        '''
+        Takes:
+            * p0     : initial positions, (ntemps, nwalkers, ndim)
+            * nsteps : number of steps
+            * thin   : only every thin-th step is stored
+        Returns:
+            * the final positions, ln(L) and ln(Pi) (each with a leading
+              (ntemps, nwalkers) shape)
+        '''
+        p = np.array(p0, dtype=float)
+        assert p.shape == (self.ntemps, self.nwalkers, self.ndim), '''
+The initial positions must have the shape (ntemps, nwalkers, ndim).'''
+
+        ll, lp = self.evaluate(p.reshape(-1, self.ndim))
+        ll = ll.reshape(self.ntemps, self.nwalkers)
+        lp = lp.reshape(self.ntemps, self.nwalkers)
+
+        if self.backends is not None:
+            for b in self.backends:
+                b.grow(nsteps // thin, None)
+
+        for i in range(nsteps):
+            naccepted = self.naccepted.copy()
+            for half in (0, 1):
+                p, ll, lp = self.stretch(p, ll, lp, half)
+            fractions = self.swap(p, ll, lp)
+            if self.adapt and self.ntemps > 2:
+                self.adapt_betas(fractions)
+            self.time += 1
+
+            if (i+1) % thin == 0:
+                self.save(p, ll, lp, self.naccepted - naccepted)
+            if progress:
+                print(f'step {i+1}/{nsteps} | betas: {self.betas}')
+
+        return p, ll, lp
+
+
+    def save(self, p, ll, lp, accepted):
+        '''
+        Stores the current step in memory and, if requested, in the HDF5
+        backend.
+        '''
+        self.chain.append(p.copy())
+        self.log_likelihoods.append(ll.copy())
+        self.log_priors.append(lp.copy())
+        self.beta_history.append(self.betas.copy())
+
+        if self.backends is not None:
+            import emcee
+            for (k, b) in enumerate(self.backends):
+                state = emcee.State(p[k], log_prob=self.betas[k]*ll[k] + lp[k],
+                                    random_state=self.random.get_state())
+                b.save_step(state, accepted[k] > 0)
+
+
+    def get_chain(self, temperature=0):
+        '''
+        Returns the stored chain at the given temperature index (0 is
+        beta = 1): (nsteps, nwalkers, ndim).
+        '''
+        return np.array(self.chain)[:, temperature]
+
+
+    @property
+    def acceptance_fraction(self):
+        '''
+        Fraction of accepted stretch moves for each walker at each
+        temperature.
+        '''
+        return self.naccepted / max(self.time, 1)
+
+
+    @property
+    def swap_acceptance_fraction(self):
+        '''
+        Fraction of accepted swaps between temperatures k and k+1.
+        '''
+        return self.nswap_accepted / np.maximum(self.nswap_proposed, 1)
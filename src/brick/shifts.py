@@ -0,0 +1,49 @@
+'''
+Interpolation of external capture (EC) integrals in the energy shifts of data
+segments.
+
+The EC integrals of a data point only depend on the energy of that point, so
+the shift of one segment only changes the rows of the EC file that belong to
+that segment. The integrals at shifts (s_1, ..., s_m) are therefore
+    EC(s_1, ..., s_m) = EC_0 + sum_i [EC_i(s_i) - EC_0],
+where EC_0 are the unshifted integrals and EC_i(s) are the integrals with
+only segment i shifted by s. EC_i is tabulated on a grid of shifts and
+linearly interpolated.
+'''
+
+import numpy as np
+
+class ExtCaptureGrid:
+    '''
+    Tabulated EC integrals.
+
+    shifts : grid of energy shifts (MeV, lab), increasing
+    base   : EC integrals without shifts (see utility.read_ext_capture_file)
+    tables : one array per shifted segment, (len(shifts),) + base.shape,
+             holding the EC integrals with only that segment shifted
+    '''
+    def __init__(self, shifts, base, tables):
+        self.shifts = np.asarray(shifts, dtype=float)
+        self.base = np.asarray(base, dtype=float)
+        self.tables = np.array(tables, dtype=float)
+        assert self.tables.shape[1:] == (self.shifts.size,) + self.base.shape, '''
+The EC tables do not match the shift grid and the unshifted integrals.'''
+        # Only the change relative to the unshifted integrals is kept.
+        self.tables -= self.base
+
+
+    def evaluate(self, shifts):
+        '''
+        Returns the EC integrals with segment i shifted by shifts[i] (MeV,
+        lab). Shifts outside the grid are clipped to its end points.
+        '''
+        s = np.clip(np.asarray(shifts, dtype=float), self.shifts[0],
+                    self.shifts[-1])
+        k = np.clip(np.searchsorted(self.shifts, s), 1, self.shifts.size-1)
+        t = (s - self.shifts[k-1]) / (self.shifts[k] - self.shifts[k-1])
+
+        i = np.arange(s.size)
+        lower = self.tables[i, k-1]
+        upper = self.tables[i, k]
+        t = t.reshape((-1,) + (1,)*self.base.ndim)
+        return self.base + np.sum((1-t)*lower + t*upper, axis=0)
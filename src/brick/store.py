@@ -0,0 +1,200 @@
+'''
+Store of evaluated points in parameter space for post-processing.
+
+Re-running AZR.predict for every posterior sample that is plotted repeats
+work that was done during sampling. PredictionStore keeps, for every
+evaluated theta, the log likelihood, the reduced width amplitudes (see
+utility.read_rwas_jpi) and, optionally, the predictions. Records are appended
+to a file as independently compressed chunks (.npz), and a fixed-width index
+holds the location of every chunk, so any record can be read without reading
+the others.
+
+Appends are serialized with an exclusive lock (fcntl.flock), so Pool
+workers can append to the same store. Typical use inside a log-likelihood
+function:
+    mu, rwas = azr.predict(theta, dress_up=False, full_output=True)
+    ln_l = ...
+    store.append(theta, ln_l, rwas=rwas, prediction=mu)
+
+Samplers that evaluate points in worker processes (e.g. emcee with a Pool)
+do not pass the step and walker to the log likelihood. Records are therefore
+also indexed by a hash of theta, and locate(chain) maps the samples of a
+chain to their records.
+'''
+
+import os
+import io
+import fcntl
+import hashlib
+import numpy as np
+
+INDEX_DTYPE = np.dtype([
+    ('hash', '<u8'),
+    ('step', '<i8'),
+    ('walker', '<i8'),
+    ('offset', '<i8'),
+    ('length', '<i8'),
+    ('log_likelihood', '<f8')
+])
+
+
+def theta_hash(theta):
+    '''
+    Returns a 64-bit hash of the values in theta.
+    '''
+    data = np.ascontiguousarray(theta, dtype='<f8').tobytes()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          'little')
+
+
+class PredictionStore:
+    '''
+    directory   : where the records (records.bin), the index (index.bin) and
+                  the lock file are kept (created if needed)
+    predictions : Are predictions stored (if they are passed to append)?
+    '''
+    def __init__(self, directory, predictions=True):
+        self.directory = directory
+        self.predictions = predictions
+        os.makedirs(directory, exist_ok=True)
+        self.records_filename = os.path.join(directory, 'records.bin')
+        self.index_filename = os.path.join(directory, 'index.bin')
+        self.lock_filename = os.path.join(directory, 'lock')
+        self.cached_index = None
+        self.lookup = None
+
+
+    def append(self, theta, log_likelihood=np.nan, rwas=None, prediction=None,
+               step=-1, walker=-1):
+        '''
+        Appends a record.
+        theta          : point in parameter space
+        log_likelihood : its log likelihood
+        rwas           : reduced width amplitudes (see utility.read_rwas_jpi)
+        prediction     : list of arrays (e.g. AZR.predict with dress_up=False)
+        step, walker   : position in the chain, if known (-1 otherwise)
+        '''
+        theta = np.asarray(theta, dtype=float)
+        arrays = {'theta': theta}
+        if rwas is not None:
+            arrays['rwa_jpi'] = np.array([r[0] for r in rwas], dtype=str)
+            arrays['rwa_channel'] = np.array([r[1] for r in rwas], dtype=int)
+            arrays['rwa_value'] = np.array([r[2] for r in rwas], dtype=float)
+        if prediction is not None and self.predictions:
+            for (i, p) in enumerate(prediction):
+                arrays[f'prediction_{i}'] = np.asarray(p)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        blob = buffer.getvalue()
+
+        entry = np.zeros(1, dtype=INDEX_DTYPE)
+        entry['hash'] = theta_hash(theta)
+        entry['step'] = step
+        entry['walker'] = walker
+        entry['length'] = len(blob)
+        entry['log_likelihood'] = log_likelihood
+
+        with open(self.lock_filename, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.records_filename, 'ab') as f:
+                    entry['offset'] = f.seek(0, os.SEEK_END)
+                    f.write(blob)
+                # The index entry is written after its record, so readers
+                # never see an entry without its data.
+                with open(self.index_filename, 'ab') as f:
+                    f.write(entry.tobytes())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    def index(self):
+        '''
+        Returns the index: a structured array (see INDEX_DTYPE) with an entry
+        for every record, in the order they were appended.
+        '''
+        if not os.path.exists(self.index_filename):
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        n = os.path.getsize(self.index_filename) // INDEX_DTYPE.itemsize
+        if self.cached_index is None or self.cached_index.size != n:
+            self.cached_index = np.fromfile(self.index_filename,
+                                            dtype=INDEX_DTYPE, count=n)
+            self.lookup = None
+        return self.cached_index
+
+
+    def __len__(self):
+        return self.index().size
+
+
+    def read(self, i):
+        '''
+        Returns the ith record as a dictionary with theta, log_likelihood,
+        step, walker, rwas (None if not stored) and prediction (None if not
+        stored).
+        '''
+        entry = self.index()[i]
+        with open(self.records_filename, 'rb') as f:
+            f.seek(int(entry['offset']))
+            blob = f.read(int(entry['length']))
+        arrays = np.load(io.BytesIO(blob))
+
+        rwas = None
+        if 'rwa_value' in arrays:
+            rwas = [[str(j), int(c), float(v)] for (j, c, v) in
+                    zip(arrays['rwa_jpi'], arrays['rwa_channel'],
+                        arrays['rwa_value'])]
+        n = sum(1 for name in arrays.files if name.startswith('prediction_'))
+        prediction = [arrays[f'prediction_{k}'] for k in range(n)] if n else None
+
+        return {
+            'theta': arrays['theta'],
+            'log_likelihood': float(entry['log_likelihood']),
+            'step': int(entry['step']),
+            'walker': int(entry['walker']),
+            'rwas': rwas,
+            'prediction': prediction
+        }
+
+
+    def find(self, theta):
+        '''
+        Returns the position of the (first) record of theta, or -1.
+        '''
+        index = self.index()
+        if self.lookup is None:
+            self.lookup = {}
+            for (i, h) in enumerate(index['hash'].tolist()):
+                self.lookup.setdefault(h, i)
+        return self.lookup.get(theta_hash(theta), -1)
+
+
+    def get(self, theta=None, step=None, walker=None):
+        '''
+        Returns the record of theta, or the record stored with step and
+        walker (see read). Raises KeyError if there is none.
+        '''
+        if theta is not None:
+            i = self.find(theta)
+        else:
+            index = self.index()
+            matches = np.flatnonzero((index['step'] == step) &
+                                     (index['walker'] == walker))
+            i = matches[0] if matches.size > 0 else -1
+        if i < 0:
+            raise KeyError('No record was found.')
+        return self.read(i)
+
+
+    def locate(self, chain):
+        '''
+        Maps the samples of a chain, (nsteps, nwalkers, nd) array (e.g.
+        emcee's get_chain()), to the positions of their records. Returns an
+        (nsteps, nwalkers) array (-1 where there is no record).
+        '''
+        chain = np.asarray(chain, dtype=float)
+        positions = np.full(chain.shape[:2], -1, dtype=int)
+        for step in range(chain.shape[0]):
+            for walker in range(chain.shape[1]):
+                positions[step, walker] = self.find(chain[step, walker])
+        return positions
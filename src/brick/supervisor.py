@@ -0,0 +1,278 @@
+'''
+Pipelined AZURE2 runs from persistent workspaces.
+
+AZURE2 reads its input file and data, sets up its channels and exits after
+every menu choice, so a process cannot be kept alive and fed new parameters.
+Supervisor hides as much of the remaining overhead as it can:
+    * its workspaces (input file and output directory) are created once and
+      reused, rather than created and removed for every theta
+    * the runs are pipelined over two workspaces: while AZURE2 runs in one,
+      the output of the previous run is read from the other and the input
+      file of the next theta is rendered into it (see InputTemplate)
+    * AZURE2's output is written to a file in the workspace, so the
+      supervisor does not have to read a pipe while the run is in progress
+
+Supervisor is an executor (see batch.py): set AZR.executor to one, or call
+map directly. It records the latency of every run (latencies) so the
+pipelined evaluation can be compared with the serial one (compare_latency).
+'''
+
+import os
+import time
+import shutil
+from subprocess import Popen, PIPE, STDOUT, DEVNULL
+import numpy as np
+
+from . import utility
+from .batch import BatchResult, NCOLUMNS, layout, evaluate_serial
+
+
+class Slot:
+    '''
+    A persistent workspace: input file, output directory and log file.
+    '''
+    def __init__(self, prepend=''):
+        self.input_filename, self.output_dir, self.data_dir = \
+            utility.random_workspace(prepend=prepend)
+        self.log_filename = self.data_dir + '/azure2.log'
+        self.process = None
+        self.cl_args = None
+        self.returncode = None
+        self.k = None
+        self.started = None
+
+
+    def reset(self):
+        '''
+        Removes the output of the last run, so it cannot be read again.
+        '''
+        for name in os.listdir(self.output_dir):
+            path = os.path.join(self.output_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+    def remove(self):
+        for path in (self.output_dir, self.data_dir):
+            shutil.rmtree(path, ignore_errors=True)
+        if os.path.exists(self.input_filename):
+            os.remove(self.input_filename)
+
+
+class Supervisor:
+    '''
+    Evaluates batches of predictions in this process, one AZURE2 run at a
+    time, with the preparation of the next run and the reading of the last
+    one overlapping the current run.
+
+    latencies : seconds from the launch of each run until its output has
+                been read
+    '''
+    def __init__(self):
+        self.slots = None
+        self.prepend = None
+        self.latencies = []
+
+
+    def start(self, azr):
+        self.close()
+        self.prepend = azr.root_directory
+        self.slots = [Slot(self.prepend) for _ in range(2)]
+
+
+    def launch(self, azr, slot, k):
+        '''
+        Starts the run of the input file in slot (for the kth theta).
+        '''
+        slot.reset()
+        cl_args = utility.azure2_arguments(slot.input_filename,
+            azr.use_brune, azr.use_gsl, azr.command)
+        options = utility.menu_options(1, azr.ext_par_file,
+                                       azr.ext_capture_file)
+        if azr.capture == 'discard':
+            log = DEVNULL
+        else:
+            log = open(slot.log_filename, 'wb')
+        try:
+            slot.process = Popen(cl_args, stdin=PIPE, stdout=log,
+                                 stderr=STDOUT)
+        finally:
+            if log is not DEVNULL:
+                log.close()
+        # AZURE2 may exit without reading the menu choices. The failure is
+        # reported by collect (from the exit status and the output).
+        try:
+            slot.process.stdin.write(options.encode('utf-8'))
+        except BrokenPipeError:
+            pass
+        try:
+            slot.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        slot.k = k
+        slot.started = time.perf_counter()
+        slot.cl_args = cl_args
+
+
+    def collect(self, azr, slot, output_files, full_output):
+        '''
+        Reads the output of the (finished) run in slot.
+        Returns (stacked output, rwas).
+        '''
+        try:
+            values = [np.atleast_2d(np.loadtxt(slot.output_dir + '/' + of))
+                      for of in output_files]
+            rwas = (utility.read_rwas_jpi(slot.output_dir) if full_output
+                    else None)
+        except Exception as e:
+            capture = azr.new_capture()
+            text = ''
+            if capture.policy != 'discard':
+                with open(slot.log_filename, 'rb') as f:
+                    f.seek(max(os.path.getsize(slot.log_filename) -
+                               capture.size*1024, 0))
+                    text = f.read().decode('utf-8', errors='replace')
+            capture.replay(slot.cl_args, text, slot.returncode,
+                           note='pipelined')
+            raise azr.failure(capture,
+                              'Output files were not properly read.') from e
+        finally:
+            self.latencies.append(time.perf_counter() - slot.started)
+        return np.concatenate(values, axis=0), rwas
+
+
+    def map(self, azr, thetas, segments=None, full_output=False):
+        '''
+        Evaluates predict (with dress_up=False) at each point in thetas.
+        Returns a BatchResult (see batch.py).
+        '''
+        thetas = np.asarray(thetas, dtype=float)
+        # Runs that depend on more than theta, or whose output AZR handles
+        # itself, are not pipelined.
+        if (azr.config.n3 > 0 or azr.run_cache is not None or
+                azr.reuse_rmatrix):
+            return evaluate_serial(azr, thetas, segments, full_output)
+        if self.slots is None or self.prepend != azr.root_directory:
+            self.start(azr)
+
+        output_files, rows = layout(azr, segments)
+        n = len(thetas)
+        values = np.full((n, sum(rows), NCOLUMNS), np.nan)
+        ok = np.zeros(n, dtype=bool)
+        rwas = [None]*n if full_output else None
+        errors = [None]*n
+
+        template = azr.config.template(segments)
+        def render(slot, k):
+            template.write(thetas[k:k+1], [slot.input_filename],
+                           [slot.output_dir])
+
+        def wait(slot):
+            slot.returncode = slot.process.wait()
+            slot.process = None
+
+        def read(slot):
+            k = slot.k
+            try:
+                mu, r = self.collect(azr, slot, output_files, full_output)
+                assert mu.shape == values.shape[1:], f'''
+Output shape {mu.shape} does not match the expected shape {values.shape[1:]}.'''
+                values[k] = mu
+                ok[k] = True
+                if full_output:
+                    rwas[k] = r
+            except Exception as e:
+                errors[k] = repr(e)
+
+        (current, following) = self.slots
+        try:
+            if n > 0:
+                render(current, 0)
+                self.launch(azr, current, 0)
+            for k in range(1, n):
+                # The input of the next run is rendered during the current
+                # run, and the output of the current run is read during the
+                # next one.
+                render(following, k)
+                wait(current)
+                self.launch(azr, following, k)
+                read(current)
+                (current, following) = (following, current)
+            if n > 0:
+                wait(current)
+                read(current)
+        finally:
+            for slot in self.slots:
+                if slot.process is not None:
+                    slot.process.kill()
+                    slot.process.wait()
+                    slot.process = None
+
+        return BatchResult(values, ok, output_files, rows, rwas, errors)
+
+
+    def stats(self):
+        '''
+        Returns a summary of the latencies (seconds) of the recorded runs.
+        '''
+        return latency_stats(self.latencies)
+
+
+    def close(self):
+        '''
+        Removes the workspaces.
+        '''
+        if self.slots is not None:
+            for slot in self.slots:
+                if slot.process is not None:
+                    slot.process.kill()
+                    slot.process.wait()
+                slot.remove()
+        self.slots = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def latency_stats(latencies):
+    '''
+    Returns the number, mean, median and 90th percentile of latencies
+    (seconds).
+    '''
+    latencies = np.asarray(latencies, dtype=float)
+    if latencies.size == 0:
+        return {'n': 0, 'mean': np.nan, 'median': np.nan, 'p90': np.nan}
+    return {
+        'n': int(latencies.size),
+        'mean': float(np.mean(latencies)),
+        'median': float(np.median(latencies)),
+        'p90': float(np.percentile(latencies, 90))
+    }
+
+
+def compare_latency(azr, thetas, segments=None):
+    '''
+    Evaluates thetas serially (AZR.predict, one workspace per theta) and with
+    a Supervisor. Returns the seconds per prediction of each
+    ('serial', 'supervisor') and the latency stats of the supervised runs.
+    '''
+    thetas = np.asarray(thetas, dtype=float)
+    start = time.perf_counter()
+    for theta in thetas:
+        azr.predict(theta, dress_up=False, segments=segments)
+    serial = (time.perf_counter() - start) / len(thetas)
+
+    with Supervisor() as supervisor:
+        start = time.perf_counter()
+        supervisor.map(azr, thetas, segments)
+        supervised = (time.perf_counter() - start) / len(thetas)
+        stats = supervisor.stats()
+
+    return {'serial': serial, 'supervisor': supervised, 'latency': stats}
@@ -0,0 +1,130 @@
+'''
+Compiled input files for rendering many points in parameter space at once.
+
+The input file written for theta (see utility.write_input_file) is fixed
+text with the output directory and the sampled values (level energies and
+widths, normalization factors) inserted at known positions. InputTemplate
+splits the text at those positions once. Rendering N thetas then formats all
+N x (number of slots) values with a single NumPy operation (see
+utility.FloatFormat) and writes each
+file with a single write call.
+'''
+
+import numpy as np
+
+from .constants import *
+
+class InputTemplate:
+    '''
+    config          : Config of the input file
+    segment_indices : Indices (into config.data.segments) of the data segments
+                      to include (all included segments if None). See
+                      Config.generate_workspace.
+    extrap          : Is the template for extrapolations (see
+                      Config.generate_workspace_extrap)? If so,
+                      segment_indices are indices into
+                      config.test.all_segments, the test segments to include,
+                      and the data segments are left as they are in the input
+                      file (only the levels are sampled).
+
+    Values are formatted with config.float_format (see utility.FloatFormat).
+
+    chunks  : text between the slots (one more than the number of slots)
+    columns : entry of theta inserted in each slot (-1 for the output
+              directory)
+    '''
+    def __init__(self, config, segment_indices=None, extrap=False):
+        self.float_format = config.float_format
+        fmt = self.float_format
+        contents = config.input_file_contents.copy()
+        data = config.data
+        if extrap:
+            if segment_indices is not None:
+                contents = config.test.select_segments(segment_indices,
+                                                       contents)
+            norm_segment_indices = []
+        else:
+            contents = data.write_segments(contents, fmt)
+            if segment_indices is not None:
+                contents = data.select_segments(segment_indices, contents)
+            norm_segment_indices = data.norm_segment_indices
+
+        # Each slot is marked by a token that cannot appear in the file.
+        def marker(k):
+            return f'\x00{k}\x00'
+
+        # normalization factors
+        start = contents.index('<segmentsData>')+1
+        for (k, i) in enumerate(norm_segment_indices):
+            segment = data.segments[i]
+            row = contents[start+segment.index].split()
+            offset = 2 if segment.reaction_type == 2 else 0
+            row[NORM_FACTOR_INDEX + offset] = marker(config.n1+k)
+            contents[start+segment.index] = ' '.join(row)
+
+        # levels (see utility.write_input_file)
+        start = contents.index('<levels>')+1
+        stop = contents.index('</levels>')
+        level_rows = [i for i in range(start, stop) if contents[i] != '']
+        groups = config.initial_levels
+        first = np.cumsum([0] + [len(g) for g in groups])
+        rows = []
+        for (i, group) in enumerate(groups):
+            for (j, level) in enumerate(group):
+                row = contents[level_rows[first[i]+j]].split()
+                row[J_INDEX] = str(level.spin)
+                row[PI_INDEX] = str(level.parity)
+                row[ENERGY_INDEX] = fmt(level.energy)
+                row[WIDTH_INDEX] = fmt(level.width)
+                row[CHANNEL_RADIUS_INDEX] = fmt(level.channel_radius)
+                rows.append(row)
+        field = {'energy': ENERGY_INDEX, 'width': WIDTH_INDEX,
+                 'channel_radius': CHANNEL_RADIUS_INDEX}
+        for (k, (i, j, kind)) in enumerate(config.addresses):
+            if kind == 'energy':
+                for jj in range(len(groups[i])):
+                    rows[first[i]+jj][ENERGY_INDEX] = marker(k)
+            else:
+                rows[first[i]+j][field[kind]] = marker(k)
+        for (r, row) in zip(level_rows, rows):
+            contents[r] = '  '.join(row)
+
+        contents[OUTPUT_DIR_INDEX] = marker(-1) + '/'
+        text = '\n'.join(contents) + '\n'
+
+        pieces = text.split('\x00')
+        self.chunks = pieces[0::2]
+        self.columns = np.array([int(k) for k in pieces[1::2]], dtype=int)
+        self.nd = config.n1 + len(norm_segment_indices)
+
+
+    def render(self, thetas, output_dirs):
+        '''
+        Returns the text of the input files for the points in thetas, (N, nd)
+        array, with the outputs written to output_dirs.
+        '''
+        thetas = np.asarray(thetas, dtype=float)
+        assert thetas.ndim == 2 and thetas.shape[1] >= self.nd, f'''
+Expected an array of points with at least {self.nd} parameters.'''
+        values = self.float_format.strings(
+            thetas[:, np.maximum(self.columns, 0)])
+        dir_slots = np.flatnonzero(self.columns == -1)
+        texts = []
+        for (row, output_dir) in zip(values, output_dirs):
+            for k in dir_slots:
+                row[k] = output_dir
+            parts = [None]*(2*len(self.chunks)-1)
+            parts[0::2] = self.chunks
+            parts[1::2] = row
+            texts.append(''.join(parts))
+        return texts
+
+
+    def write(self, thetas, input_filenames, output_dirs):
+        '''
+        Writes the input files for the points in thetas.
+        '''
+        for (text, filename) in zip(self.render(thetas, output_dirs),
+                                    input_filenames):
+            with open(filename, 'w') as f:
+                f.write(text)
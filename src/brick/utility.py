@@ -10,6 +10,46 @@ import numpy as np
 from .level import Level
 from .constants import *
 
+class FloatFormat:
+    '''
+    Formats the floating-point values written to input files.
+
+    digits : number of significant digits ('%.{digits}g'). If None, values
+             are written with the shortest representation that reads back
+             exactly (str(float)).
+
+    With a fixed number of digits, values that differ only in their last bits
+    produce identical input files.
+    '''
+    def __init__(self, digits=None):
+        assert digits is None or 1 <= digits <= 17, '''
+The number of significant digits must be between 1 and 17.'''
+        self.digits = digits
+        self.pattern = None if digits is None else f'%.{digits}g'
+
+
+    def __call__(self, value):
+        '''
+        Returns value formatted as a string.
+        '''
+        if self.pattern is None:
+            return str(float(value))
+        return self.pattern % value
+
+
+    def strings(self, values):
+        '''
+        Returns the formatted values of an array as a (nested) list of strings.
+        '''
+        values = np.asarray(values, dtype=float)
+        if self.pattern is None:
+            return values.astype(str).tolist()
+        return np.char.mod(self.pattern, values).tolist()
+
+
+DEFAULT_FLOAT_FORMAT = FloatFormat()
+
+
 def read_input_file(filename):
     '''
     Reads AZURE2 input file (.azr file) – purely for convenience.
@@ -21,24 +61,27 @@ def read_input_file(filename):
     return contents
 
 
-def read_level_contents(infile):
+def read_level_contents(infile, contents=None):
     '''
     Reads rows between <levels> and </levels>.
+    If contents (see read_input_file) is provided, infile is not read.
     '''
-    contents = read_input_file(infile)
+    if contents is None:
+        contents = read_input_file(infile)
     start = contents.index('<levels>')+1
     stop = contents.index('</levels>')
     return contents[start:stop]
 
 
-def read_levels(infile):
+def read_levels(infile, contents=None):
     '''
     Packages the contents of the input file (infile, str) into instances of
     Level.
-    Takes an input filename (str).
+    Takes an input filename (str) and, optionally, its contents (see
+    read_input_file).
     Returns a list of Level instances.
     '''
-    level_contents = read_level_contents(infile)
+    level_contents = read_level_contents(infile, contents=contents)
 
     levels = []
     sublevels = []
@@ -93,11 +136,12 @@ def update_segmentsData_dir(contents0, data_dir):
 
 
 def write_input_file(old_input_file_contents, new_levels, input_filename,
-    output_dir, data_dir=None):
+    output_dir, data_dir=None, float_format=DEFAULT_FLOAT_FORMAT):
     '''
         Takes:
             * contents of an old .azr file (see read_input_file function)
             * list of new Levels
+            * FloatFormat of the level parameters
         Does:
             * replaces the level parameters of the old .azr files with the
               parameters of the new levels
@@ -127,9 +171,9 @@ The number of levels passed in does not match the number of existing levels.'''
             nlevel = old_levels[i].split()
             nlevel[J_INDEX] = str(level.spin)
             nlevel[PI_INDEX] = str(level.parity)
-            nlevel[ENERGY_INDEX] = str(level.energy)
-            nlevel[WIDTH_INDEX] = str(level.width)
-            nlevel[CHANNEL_RADIUS_INDEX] = str(level.channel_radius)
+            nlevel[ENERGY_INDEX] = float_format(level.energy)
+            nlevel[WIDTH_INDEX] = float_format(level.width)
+            nlevel[CHANNEL_RADIUS_INDEX] = float_format(level.channel_radius)
             new_level_data.append(str.join('  ', nlevel))
             j += 1
 
@@ -201,19 +245,51 @@ def write_ext_capture_file(filename, data):
             f.write(f'({x:.5e},{y:.5e})\n')
         
     
-def run_AZURE2(input_filename, choice=1, use_brune=False, ext_par_file='\n',
-        ext_capture_file='\n', use_gsl=False, command='AZURE2'):
+def azure2_arguments(input_filename, use_brune=False, use_gsl=False,
+                     command='AZURE2'):
     cl_args = [command, input_filename, '--no-gui', '--no-readline']
     if use_brune:
         cl_args += ['--use-brune']
     if use_gsl:
         cl_args += ['--gsl-coul']
+    return cl_args
+
+
+def execute(cl_args, options, capture=None, run_cache=None):
+    '''
+    Runs AZURE2 (cl_args) with the menu choices (options) written to stdin.
+    If capture (a capture.Capture) is provided, it handles the output and is
+    returned. Otherwise, stdout and stderr are returned as strings.
+    If run_cache (a cache.RunCache) is provided, runs with the same inputs are
+    served from it.
+    '''
+    if run_cache is not None:
+        return run_cache.execute(cl_args, options, capture=capture)
+
+    if capture is not None:
+        capture.run(cl_args, options)
+        return capture
+
     p = Popen(cl_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    options = str(choice) + '\n' + ext_par_file + ext_capture_file
     response = p.communicate(options.encode('utf-8'))
     return (response[0].decode('utf-8'), response[1].decode('utf-8'))
 
 
+def menu_options(choice=1, ext_par_file='\n', ext_capture_file='\n'):
+    '''
+    Returns the menu choices written to AZURE2's stdin.
+    '''
+    return str(choice) + '\n' + ext_par_file + ext_capture_file
+
+
+def run_AZURE2(input_filename, choice=1, use_brune=False, ext_par_file='\n',
+        ext_capture_file='\n', use_gsl=False, command='AZURE2', capture=None,
+        run_cache=None):
+    cl_args = azure2_arguments(input_filename, use_brune, use_gsl, command)
+    options = menu_options(choice, ext_par_file, ext_capture_file)
+    return execute(cl_args, options, capture=capture, run_cache=run_cache)
+
+
 def reaction_rate(
     input_filename,
     temperatures_filename,
@@ -222,24 +298,17 @@ def reaction_rate(
     ext_par_file='\n',
     use_brune=False,
     use_gsl=False,
-    command='AZURE2'):
+    command='AZURE2',
+    capture=None,
+    run_cache=None):
     '''
     Calculatates the reaction rate for the entrance_pair -> exit_pair reaction
     at temperatures stored in temperatures_filename.
     '''
-    cl_args = [command, input_filename, '--no-gui', '--no-readline']
-    if use_brune:
-        cl_args += ['--use-brune']
-    if use_gsl:
-        cl_args += ['--gsl-coul']
-
-    p = Popen(cl_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-
+    cl_args = azure2_arguments(input_filename, use_brune, use_gsl, command)
     options = '5\n' + ext_par_file + str(entrance_pair)+'\n' + \
         str(exit_pair)+'\n' + 'yes\n' + temperatures_filename+'\n'
-    response = p.communicate(options.encode('utf-8'))
-
-    return (response[0].decode('utf-8'), response[1].decode('utf-8'))
+    return execute(cl_args, options, capture=capture, run_cache=run_cache)
 
 
 def fit(
@@ -248,20 +317,13 @@ def fit(
     ext_capture_file='\n',
     use_brune=False,
     use_gsl=False,
-    command='AZURE2'):
+    command='AZURE2',
+    capture=None,
+    run_cache=None):
     '''
     Fits Segments from Data.
     This can take a while.
     '''
-    cl_args = [command, input_filename, '--no-gui', '--no-readline']
-    if use_brune:
-        cl_args += ['--use-brune']
-    if use_gsl:
-        cl_args += ['--gsl-coul']
-
-    p = Popen(cl_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-
+    cl_args = azure2_arguments(input_filename, use_brune, use_gsl, command)
     options = '2\n' + ext_param_file + ext_capture_file
-    response = p.communicate(options.encode('utf-8'))
-
-    return (response[0].decode('utf-8'), response[1].decode('utf-8'))
+    return execute(cl_args, options, capture=capture, run_cache=run_cache)
@@ -5,10 +5,35 @@ Tests the implementation of various features of BRICK.
 * energy shifts
 '''
 
+import os
+import sys
+import shutil
+import time
 import unittest
+import tempfile
+import threading
 import numpy as np
 
-from brick.azr import AZR
+from brick import batch
+from brick.azr import AZR, clean_up
+from brick.bands import BandAccumulator
+from brick.batch import AutoscalingExecutor, SharedMemoryExecutor
+from brick.cache import ConfigCache, RunCache
+from brick.capture import Capture
+from brick.constants import CHANNEL_RADIUS_INDEX
+from brick.data import cache_filepath
+from brick.distributed import BrokerExecutor
+from brick.errors import AZURE2Error, CoulombFunctionError, classify
+from brick.hooks import EVENTS
+from brick.nodata import Test
+from brick.parameter import Parameter
+from brick.reweight import (segment_log_likelihoods, segment_log_ratios,
+                            Reweighting)
+from brick.sampling import PTSampler
+from brick.store import PredictionStore
+from brick.supervisor import Supervisor
+from brick.utility import (read_input_file, write_input_file,
+                           read_ext_capture_file)
 
 class BRICKTests(unittest.TestCase):
     '''
@@ -110,5 +135,865 @@ explicitly shifted energies is {rel_diff}.
 ''')
 
 
+    def test_segment_subset(self):
+        '''
+        Tests the evaluation of a subset of the data segments.
+
+        Both segments of 12C+p.azr generate the same output file, with the
+        first segment's points listed first. Computing only the first segment
+        must reproduce those rows of the full calculation.
+        '''
+        theta = self.azr.config.get_input_values()
+        n = self.azr.config.data.ns[0]
+
+        mu_all = self.azr.predict(theta, dress_up=False)[0]
+        mu_sub = self.azr.predict(theta, dress_up=False, segments=[0])[0]
+
+        self.assertEqual(mu_sub.shape[0], n)
+        abs_diff = np.linalg.norm(mu_all[:n] - mu_sub)
+        self.assertTrue(abs_diff == 0, msg=f'''
+Segment subset test failed. The norm of the absolute difference between the
+full calculation and the calculation of the first segment is {abs_diff}.
+''')
+
+
+    def test_ext_capture_grid(self):
+        '''
+        Tests the interpolation of external capture (EC) integrals in the
+        energy shifts of data segments.
+
+        Both data segments are shifted by amounts between the nodes of the
+        grid. The interpolated integrals (the sum of the linearly interpolated
+        changes of the two segments) must match the integrals AZURE2 computes
+        with the data shifted explicitly to within 1e-4 (relative). The
+        integrals change by ~1e-3 across a grid interval, and AZURE2 writes
+        them with 6 significant digits. predict must pass the interpolated
+        integrals to AZURE2, and only for all of the segments.
+        '''
+        SHIFT = 0.001 # MeV, lab
+        shifts = [SHIFT, -1.5*SHIFT]
+
+        grid = self.azr.precompute_ext_capture_integrals(
+            [-2*SHIFT, 0, 2*SHIFT], segment_indices=[0, 1])
+        ec1 = grid.evaluate(shifts)
+        ec2 = self.azr.update_ext_capture_integrals([0, 1], shifts)
+
+        rel_diff = np.linalg.norm(ec1 - ec2) / np.linalg.norm(ec2)
+        self.assertTrue(rel_diff < 1e-4, msg=f'''
+EC grid test failed. The relative difference between the interpolated and
+computed EC integrals is {rel_diff}.
+''')
+
+        passed = []
+        def read_ext_capture(event):
+            passed.append(read_ext_capture_file(event.workspace[2] +
+                                                '/intEC.dat'))
+        self.azr.hooks.register('after_render', read_ext_capture)
+        theta = np.hstack((self.azr.config.get_input_values()[:-2], shifts))
+        self.azr.predict(theta, dress_up=False)
+        rel_diff = np.linalg.norm(passed[0] - ec1) / np.linalg.norm(ec1)
+        self.assertTrue(rel_diff < 1e-5, msg=f'''
+EC grid test failed. The EC integrals passed to AZURE2 by predict differ from
+the interpolated integrals by {rel_diff} (relative).
+''')
+        with self.assertRaises(AssertionError):
+            self.azr.predict(theta, dress_up=False, segments=[0])
+
+
+    def test_reuse_rmatrix(self, norm_factor=1.1):
+        '''
+        Tests the reuse of the last AZURE2 run when only normalization factors
+        change.
+
+        With check_reuse set, the second prediction is computed both by
+        rescaling the first and by AZURE2, and the two are compared (to within
+        the precision of the AZURE2 output files).
+        '''
+        theta0 = np.array(self.azr.config.get_input_values())
+        theta1 = np.copy(theta0)
+        theta1[-2] = norm_factor
+        theta1[-1] = norm_factor
+
+        self.azr.reuse_rmatrix = True
+        self.azr.check_reuse = True
+        self.azr.predict(theta0, dress_up=False)
+        try:
+            self.azr.predict(theta1, dress_up=False)
+        except AssertionError as e:
+            self.fail(f'''
+R-matrix reuse test failed. {e}
+''')
+
+
+    def test_output_columns(self, norm_factor=1.1):
+        '''
+        Tests the selection of output columns in predict.
+
+        After a first run, only the calculated columns are read; the data
+        columns are kept and rescaled to the normalization factors. The
+        selected columns must match those of the full output (to within the
+        precision of the AZURE2 output files).
+        '''
+        columns = ('xs_com_fit', 'xs_com_data', 'xs_err_com_data')
+        theta0 = np.array(self.azr.config.get_input_values())
+        theta1 = np.copy(theta0)
+        theta1[-2] = norm_factor
+        theta1[-1] = norm_factor
+
+        for theta in (theta0, theta1):
+            selected = self.azr.predict(theta, columns=columns)[0]
+            full = self.azr.predict(theta, dress_up=False)[0][:, [3, 5, 6]]
+            rel_diff = np.max(np.abs(selected/full - 1))
+            self.assertTrue(rel_diff < 1e-6, msg=f'''
+Output columns test failed. The largest relative difference between the
+selected and the full output is {rel_diff}.
+''')
+
+
+    def test_input_template(self):
+        '''
+        Tests the batched rendering of input files.
+
+        The input files rendered for several thetas at once
+        (generate_workspaces) must be identical to those written one at a time
+        (generate_workspace), up to the random output directory.
+        '''
+        theta0 = np.array(self.azr.config.get_input_values())
+        rng = np.random.default_rng(0)
+        thetas = theta0 * (1 + 0.1*rng.normal(size=(3, theta0.size)))
+
+        workspaces = self.azr.config.generate_workspaces(thetas)
+        for (theta, workspace) in zip(thetas, workspaces):
+            reference = self.azr.config.generate_workspace(theta)
+            texts = []
+            for (input_filename, output_dir, data_dir) in (workspace,
+                                                           reference):
+                with open(input_filename, 'r') as f:
+                    texts.append(f.read().replace(output_dir, ''))
+                clean_up(input_filename, output_dir, data_dir)
+            self.assertEqual(texts[0], texts[1], msg='''
+Input template test failed. The rendered input file does not match the one
+written by write_input_file.
+''')
+
+
+    def test_supervisor(self):
+        '''
+        Tests the pipelined evaluation of a batch in persistent workspaces.
+
+        Every prediction of the Supervisor must be identical to the one
+        computed by predict. A run that exits before reading its menu
+        choices must be reported as a failure of its theta.
+        '''
+        theta0 = np.array(self.azr.config.get_input_values())
+        rng = np.random.default_rng(0)
+        thetas = theta0 * (1 + 0.01*rng.normal(size=(3, theta0.size)))
+
+        with Supervisor() as supervisor:
+            result = supervisor.map(self.azr, thetas)
+        self.assertTrue(np.all(result.ok))
+        for (k, theta) in enumerate(thetas):
+            mu = self.azr.predict(theta, dress_up=False)
+            for (a, b) in zip(result.split(k), mu):
+                self.assertTrue(np.array_equal(a, b), msg='''
+Supervisor test failed. The pipelined prediction does not match the one
+computed by predict.
+''')
+
+        # An executable that exits (with status 1) before it reads the menu
+        # choices, which are made longer than the pipe buffer.
+        with tempfile.TemporaryDirectory() as directory:
+            command = os.path.join(directory, 'AZURE2')
+            with open(command, 'w') as f:
+                f.write('#!/bin/sh\nexit 1\n')
+            os.chmod(command, 0o755)
+            self.azr.command = command
+            self.azr.ext_par_file = 'x'*(1 << 20) + '\n'
+            self.azr.verbose = False
+            with Supervisor() as supervisor:
+                result = supervisor.map(self.azr, thetas)
+        self.assertFalse(np.any(result.ok))
+        for error in result.errors:
+            self.assertIn('AZURE2Error', error, msg=f'''
+Supervisor test failed. A run that exited early was reported as {error}.
+''')
+
+
+    def test_significant_digits(self):
+        '''
+        Tests the formatting of input files with a fixed number of significant
+        digits.
+
+        Points that differ only in the last bits of their values must produce
+        identical input files.
+        '''
+        theta0 = np.array(self.azr.config.get_input_values())
+        theta1 = theta0 * (1 + 1e-15)
+        self.azr.config.set_significant_digits(12)
+
+        texts = []
+        for theta in (theta0, theta1):
+            input_filename, output_dir, data_dir = \
+                self.azr.config.generate_workspace(theta)
+            with open(input_filename, 'r') as f:
+                texts.append(f.read().replace(output_dir, ''))
+            clean_up(input_filename, output_dir, data_dir)
+        self.assertEqual(texts[0], texts[1], msg='''
+Significant digits test failed. Points that agree to 12 significant digits
+produce different input files.
+''')
+
+
+    def test_run_cache(self):
+        '''
+        Tests the cache of AZURE2 runs.
+
+        The second prediction at the same point must be served from the cache
+        and be identical to the first.
+        '''
+        theta = np.array(self.azr.config.get_input_values())
+        with tempfile.TemporaryDirectory() as directory:
+            self.azr.run_cache = RunCache(directory)
+            mu1 = self.azr.predict(theta, dress_up=False)
+            mu2 = self.azr.predict(theta, dress_up=False)
+
+        self.assertEqual((self.azr.run_cache.misses, self.azr.run_cache.hits),
+                         (1, 1))
+        for (a, b) in zip(mu1, mu2):
+            self.assertTrue(np.array_equal(a, b), msg='''
+Run cache test failed. The cached output does not match the output of AZURE2.
+''')
+
+
+    def test_integrated_rate(self):
+        '''
+        Tests the reaction rate integrated in BRICK.
+
+        A test segment with a fine energy grid (10 keV to 3 MeV) for
+        12C(p,gamma) is added to a copy of the input file. The rate integrated
+        from its S factor must agree with the rate computed by AZURE2 to
+        within 1%. (The 1% tolerance has only been validated against the
+        stand-in AZURE2 in benchmarks/fake_azure2.py.)
+        '''
+        contents = read_input_file('12C+p.azr')
+        i = contents.index('<segmentsTest>')
+        contents.insert(i+2, '1 1 2 0.01 3.0 0.001 0 0 0 0')
+        # The data paths in the input file are relative to this directory.
+        with tempfile.NamedTemporaryFile('w', suffix='.azr', dir='.') as f:
+            f.write('\n'.join(contents))
+            f.flush()
+
+            azr = AZR(f.name)
+            theta = np.array(azr.config.get_input_values())
+            temperatures = np.array([0.1, 0.3, 1.0])
+            rate1 = azr.reaction_rate(theta, 1, 2, temperatures)[:, 1]
+            rate2 = azr.reaction_rate(theta, 1, 2, temperatures,
+                                      segment_index=1)[:, 1]
+
+        rel_diff = np.max(np.abs(rate2/rate1 - 1))
+        self.assertTrue(rel_diff < 1e-2, msg=f'''
+Integrated rate test failed. The largest relative difference between the rates
+computed by BRICK and AZURE2 is {rel_diff}.
+''')
+
+
+    def test_prediction_store(self):
+        '''
+        Tests the random access of records in a PredictionStore.
+
+        Predictions of a small chain (2 steps, 2 walkers) are appended in
+        reverse order. locate must map every sample of the chain to its
+        record, and the stored prediction must be the one computed for it.
+        '''
+        theta0 = np.array(self.azr.config.get_input_values())
+        rng = np.random.default_rng(0)
+        chain = theta0 * (1 + 0.01*rng.normal(size=(2, 2, theta0.size)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = PredictionStore(directory)
+            predictions = {}
+            for theta in chain.reshape(-1, theta0.size)[::-1]:
+                mu, rwas = self.azr.predict(theta, dress_up=False,
+                                            full_output=True)
+                store.append(theta, 0.0, rwas=rwas, prediction=mu)
+                predictions[theta.tobytes()] = mu[0]
+
+            positions = store.locate(chain)
+            self.assertTrue(np.all(positions >= 0))
+            for (step, walker) in np.ndindex(positions.shape):
+                record = store.read(positions[step, walker])
+                expected = predictions[chain[step, walker].tobytes()]
+                self.assertTrue(np.array_equal(record['prediction'][0],
+                                               expected), msg='''
+Prediction store test failed. The stored prediction does not match the one
+computed for the sample.
+''')
+
+
+    def test_reweight(self):
+        '''
+        Tests the per-segment likelihood components used for reweighting.
+
+        The components of the two segments must add up to the Gaussian log
+        likelihood of the full prediction, and reweighting to the same
+        segments must give equal weights (ESS = number of samples) that are
+        reported as reliable.
+        '''
+        theta0 = np.array(self.azr.config.get_input_values())
+        rng = np.random.default_rng(0)
+        thetas = theta0 * (1 + 0.01*rng.normal(size=(5, theta0.size)))
+        predictions = [self.azr.predict(theta, dress_up=False) for theta in
+                       thetas]
+
+        components = segment_log_likelihoods(predictions,
+                                             self.azr.config.data)
+        for (prediction, row) in zip(predictions, components):
+            mu = np.vstack(prediction)
+            ln_l = np.sum(-np.log(np.sqrt(2*np.pi)*mu[:, 6]) -
+                          0.5*((mu[:, 5] - mu[:, 3])/mu[:, 6])**2)
+            rel_diff = abs(np.sum(row)/ln_l - 1)
+            self.assertTrue(rel_diff < 1e-12, msg=f'''
+Reweighting test failed. The relative difference between the sum of the
+segment components and the full log likelihood is {rel_diff}.
+''')
+
+        log_ratios = segment_log_ratios(components, [0, 1], [1, 0])
+        reweighting = Reweighting(log_ratios)
+        self.assertAlmostEqual(reweighting.ess, thetas.shape[0], msg='''
+Reweighting test failed. Reweighting to the same segments does not give equal
+weights.
+''')
+        self.assertTrue(reweighting.reliable, msg=f'''
+Reweighting test failed. Equal weights are reported as unreliable:
+{reweighting.report()}
+''')
+
+        reweighting = Reweighting(np.zeros(1000))
+        self.assertEqual(reweighting.k, -np.inf)
+        self.assertTrue(reweighting.reliable)
+        self.assertAlmostEqual(reweighting.ess, 1000)
+
+
+    def test_mmap_data(self):
+        '''
+        Tests the memory-mapped data points.
+
+        The data points read from the binary copies of the data files must be
+        identical to those read from the text files, which are only read when
+        they are accessed.
+        '''
+        azr = AZR('12C+p.azr', mmap_data=True)
+        try:
+            table = self.azr.config.data.table
+            self.assertTrue(all(a is None for a in table.arrays))
+            for (seg1, seg2) in zip(self.azr.config.data.segments,
+                                    azr.config.data.segments):
+                self.assertEqual(seg1.n, seg2.n)
+                self.assertTrue(np.array_equal(seg1.values, seg2.values), msg='''
+Memory-mapped data test failed. The memory-mapped data points do not match
+those read from the text file.
+''')
+        finally:
+            for seg in azr.config.data.segments:
+                os.remove(cache_filepath(seg.filepath))
+
+
+    def test_bands(self):
+        '''
+        Tests the streaming quantile estimates used for credible bands.
+
+        Samples are accumulated in two BandAccumulators (one sample at a time)
+        that are then merged. The bounds of the 2 sigma band must match
+        np.percentile to within 5% of the standard deviation.
+        '''
+        rng = np.random.default_rng(0)
+        samples = rng.normal(10, 1, size=(10000, 20))
+
+        acc1 = BandAccumulator()
+        acc2 = BandAccumulator()
+        for sample in samples[:3000]:
+            acc1.add(sample)
+        for sample in samples[3000:]:
+            acc2.add(sample)
+        acc1.merge(acc2)
+
+        lower, upper = acc1.bands()['2sigma']
+        expected = np.percentile(samples, [2.275, 97.725], axis=0)
+        max_diff = np.max(np.abs(np.array([lower, upper]) - expected))
+        self.assertTrue(max_diff < 0.05, msg=f'''
+Band test failed. The largest difference between the streaming and exact
+quantiles is {max_diff}.
+''')
+
+
+    def test_extrap_template(self):
+        '''
+        Tests the compiled extrapolation input files.
+
+        The input files rendered from the template of a subset of the test
+        segments must be identical to those written by write_input_file
+        (up to the random output directory), and the output files must be
+        those of the included segments.
+        '''
+        config = self.azr.config
+        theta = np.array(config.get_input_values())
+        nseg = len(config.test.all_segments)
+        for segment_indices in (None, [0], list(range(nseg))[::-1]):
+            input_filename, output_dir, output_files = \
+                config.generate_workspace_extrap(theta, segment_indices)
+            with open(input_filename, 'r') as f:
+                text = f.read().replace(output_dir, '')
+            os.remove(input_filename)
+            os.rmdir(output_dir)
+
+            contents = config.input_file_contents.copy()
+            test = Test('', contents=contents)
+            if segment_indices is not None:
+                for (i, segment) in enumerate(test.all_segments):
+                    segment.include = i in segment_indices
+                test.write_segments(contents)
+            with tempfile.TemporaryDirectory() as directory:
+                filename = directory + '/reference.azr'
+                write_input_file(contents, config.generate_levels(theta),
+                                 filename, '')
+                with open(filename, 'r') as f:
+                    reference = f.read()
+            self.assertEqual(text, reference, msg='''
+Extrapolation template test failed. The rendered input file does not match
+the one written by write_input_file.
+''')
+            self.assertEqual(output_files, test.get_output_files())
+
+
+    def test_hooks(self):
+        '''
+        Tests the callbacks that observe the stages of predict.
+
+        The events of a successful prediction must arrive in order with the
+        workspace and the timings of the completed stages. A failed run must
+        be reported to on_error.
+        '''
+        theta = np.array(self.azr.config.get_input_values())
+        events = []
+        for name in EVENTS:
+            self.azr.hooks.register(name, events.append)
+
+        self.azr.predict(theta, dress_up=False)
+        self.assertEqual([e.name for e in events], list(EVENTS[:-1]), msg='''
+Hooks test failed. The events did not arrive in order.
+''')
+        self.assertEqual(events[-1].workspace, events[1].workspace)
+        self.assertEqual(sorted(events[-1].timings), ['parse', 'render', 'run'])
+        self.assertTrue(events[3].elapsed <= events[-1].total)
+
+        events.clear()
+        self.azr.command = 'false'
+        self.azr.verbose = False
+        with self.assertRaises(Exception):
+            self.azr.predict(theta, dress_up=False)
+        self.assertEqual(events[-1].name, 'on_error')
+        self.assertEqual(events[-1].stage, 'parse')
+
+
+    def test_evaluate(self):
+        '''
+        Tests the evaluation of several products in one workspace.
+
+        The data, the extrapolation, the reduced width amplitudes and the
+        rate of evaluate must be identical to those of predict, extrapolate,
+        rwas and reaction_rate, with one AZURE2 run per menu choice.
+        '''
+        theta = np.array(self.azr.config.get_input_values())
+        temperatures = np.array([0.1, 0.3, 1.0])
+        runs = []
+        self.azr.hooks.register('before_run', runs.append)
+        evaluation = self.azr.evaluate(theta, rate=(1, 2, temperatures),
+                                       dress_up=False)
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(evaluation.choices, [1, 3, 5])
+        self.azr.hooks.clear()
+
+        expected = (self.azr.predict(theta, dress_up=False),
+                    self.azr.extrapolate(theta))
+        for (values, reference) in zip((evaluation.data, evaluation.extrap),
+                                       expected):
+            for (a, b) in zip(values, reference):
+                self.assertTrue(np.array_equal(a, b), msg='''
+Evaluate test failed. The output does not match the output of predict or
+extrapolate.
+''')
+        self.assertEqual(evaluation.rwas, self.azr.rwas(theta))
+        self.assertTrue(np.array_equal(evaluation.rate,
+            self.azr.reaction_rate(theta, 1, 2, temperatures)))
+
+
+    def test_config_cache(self):
+        '''
+        Tests the keys of the cache of parsed input files.
+
+        An entry is served to a new AZR with the same input file, working
+        directory and mmap_data setting, and to no other.
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ConfigCache(directory)
+            azr = AZR('12C+p.azr', cache_dir=directory)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            AZR('12C+p.azr', cache_dir=directory)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertIsNotNone(cache.load('12C+p.azr'))
+            self.assertIsNone(cache.load('12C+p.azr', mmap_data=True))
+
+            mapped = AZR('12C+p.azr', cache_dir=directory, mmap_data=True)
+            try:
+                self.assertEqual(len(os.listdir(directory)), 2)
+                self.assertTrue(np.array_equal(
+                    mapped.config.data.table.values,
+                    azr.config.data.table.values))
+            finally:
+                for seg in mapped.config.data.segments:
+                    os.remove(cache_filepath(seg.filepath))
+
+            entry = cache.entry('12C+p.azr')
+            cwd = os.getcwd()
+            try:
+                os.chdir('data')
+                other = cache.entry(os.path.join(cwd, '12C+p.azr'))
+            finally:
+                os.chdir(cwd)
+            self.assertNotEqual(entry, other)
+
+
+    def test_pt_sampler(self):
+        '''
+        Tests the parallel-tempering sampler on an analytic bimodal
+        likelihood (two Gaussians at -3 and 3, sigma = 0.5).
+
+        All walkers start in one mode. With swaps between temperatures, the
+        beta = 1 chain must visit both, the intermediate temperatures must be
+        adapted with the first and last fixed, and the chain read back from
+        the HDF5 file by emcee must match the one in memory.
+        '''
+        import emcee
+
+        def log_likelihood(theta):
+            return np.logaddexp(-0.5*((theta[0] - 3)/0.5)**2,
+                                -0.5*((theta[0] + 3)/0.5)**2)
+
+        def log_prior(theta):
+            return 0.0 if -10 < theta[0] < 10 else -np.inf
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'chain.h5')
+            sampler = PTSampler(4, 8, 1, log_likelihood, log_prior,
+                                backend=filename, adaptation_lag=100,
+                                adaptation_time=10, seed=0)
+            betas = sampler.betas.copy()
+            rng = np.random.default_rng(0)
+            sampler.run_mcmc(-3 + 0.1*rng.normal(size=(4, 8, 1)), 300)
+
+            chain = sampler.get_chain(0)
+            for fraction in (np.mean(chain > 0), np.mean(chain < 0)):
+                self.assertTrue(fraction > 0.1, msg=f'''
+PT sampler test failed. One of the modes holds only a fraction {fraction} of
+the beta = 1 samples.
+''')
+            self.assertEqual(sampler.betas[0], betas[0])
+            self.assertEqual(sampler.betas[-1], betas[-1])
+            self.assertFalse(np.array_equal(sampler.betas, betas))
+            self.assertTrue(np.all(np.diff(sampler.betas) < 0))
+            self.assertTrue(np.all(sampler.swap_acceptance_fraction > 0))
+
+            backend = emcee.backends.HDFBackend(filename, name='mcmc',
+                                                read_only=True)
+            self.assertTrue(np.array_equal(backend.get_chain(), chain))
+
+
+    def test_classify_and_capture(self):
+        '''
+        Tests the classification of failures and the capture policies.
+
+        A process that prints the message of GSL's default error handler (the
+        format of err/stream.c) and aborts, as AZURE2 does when the Coulomb
+        functions fail, must be classified as CoulombFunctionError. Output
+        that matches no pattern is an AZURE2Error with the given message.
+        '''
+        gsl = ('gsl: coulomb.c:1402: ERROR: overflow\n'
+               'Default GSL error handler invoked.\n')
+        script = ('import os, sys; sys.stdout.write(sys.argv[1]); '
+                  'sys.stdout.flush(); os.abort()')
+        capture = Capture('ring')
+        returncode = capture.run([sys.executable, '-c', script, gsl], '')
+        self.assertEqual(capture.text(), gsl)
+        error = classify(capture.text(), returncode)
+        self.assertIs(type(error), CoulombFunctionError, msg=f'''
+Classification test failed. {error!r} was returned for the output
+{capture.text()!r}.
+''')
+        self.assertEqual(str(error), 'gsl: coulomb.c:1402: ERROR: overflow')
+        self.assertEqual(error.returncode, returncode)
+
+        error = classify('gsl: bessel_J0.c:76: ERROR: underflow\n')
+        self.assertIs(type(error), AZURE2Error)
+        self.assertEqual(str(error), 'gsl: bessel_J0.c:76: ERROR: underflow')
+
+        error = classify('Fake AZURE2 failed: Bad level parameters.\n', 1,
+                         message='No output.')
+        self.assertIs(type(error), AZURE2Error)
+        self.assertEqual(str(error), 'No output.')
+
+        text = ''.join(f'{i:09d}\n' for i in range(1000))
+        cl_args = [sys.executable, '-c',
+                   'import sys; sys.stdout.write(sys.stdin.read())']
+
+        capture = Capture('discard')
+        self.assertEqual(capture.run(cl_args, text), 0)
+        self.assertEqual(capture.text(), '')
+
+        capture = Capture('ring', size=1)
+        capture.run(cl_args, text)
+        self.assertEqual(capture.text(), text[-1024:])
+
+        with tempfile.TemporaryDirectory() as directory:
+            logfile = os.path.join(directory, 'azure2.log')
+            capture = Capture('log', size=1, logfile=logfile)
+            capture.run(cl_args, text)
+            self.assertEqual(capture.text(), text[-1024:])
+            capture.replay(cl_args, gsl, -6)
+            self.assertEqual(capture.text(), gsl)
+            self.assertEqual(capture.returncode, -6)
+            with open(logfile) as f:
+                log = f.read()
+            header = ' '.join(cl_args) + '\n'
+            self.assertEqual(log, '=== ' + header + text +
+                             '=== (cached) ' + header + gsl)
+
+        # A process that exits without reading its input.
+        capture = Capture('ring')
+        self.assertEqual(capture.run(['true'], 'x'*(1 << 20)), 0)
+        self.assertEqual(capture.text(), '')
+
+
+    def test_constraints(self):
+        '''
+        Tests the rules of Constraints.check and their use in predict_batch.
+
+        Points with a non-finite parameter, a normalization factor <= 0 or a
+        level moved below the separation energy of a channel whose width is
+        sampled as a partial width must be rejected without running AZURE2
+        (also when the parameters are given by hand) and reported as such by
+        predict_batch. An input file with a channel radius of 0 must be
+        refused when it is read.
+        '''
+        constraints = self.azr.config.constraints
+        theta = self.azr.config.get_input_values()
+        nan = theta.copy()
+        nan[2] = np.nan
+        norm = theta.copy()
+        norm[self.azr.config.n1] = -1.0
+        below = theta.copy()
+        below[1] = 1.5 # 2.3689 MeV level, 1.94351 MeV separation energy
+        thetas = np.array([theta, nan, norm, below])
+
+        self.assertTrue(np.array_equal(constraints.check(thetas),
+                                       [True, False, False, False]))
+        self.assertEqual(constraints.rejected['finite'], 1)
+        self.assertEqual(constraints.rejected['normalization factor'], 1)
+        self.assertEqual(constraints.rejected['threshold'], 1)
+
+        result = self.azr.predict_batch(thetas)
+        mu = np.vstack(self.azr.predict(theta, dress_up=False))
+        self.assertTrue(np.array_equal(result.ok, [True, False, False, False]))
+        self.assertTrue(np.array_equal(result.values[0], mu), msg='''
+Constraints test failed. The prediction at the valid point does not match
+predict.
+''')
+        self.assertTrue(np.all(np.isnan(result.values[1:])))
+        self.assertEqual(result.errors[0], None)
+        self.assertEqual(result.errors[1:], ['Rejected by the constraints.']*3)
+
+        # Parameters given by hand (is_anc is False by default) are checked
+        # against the input file.
+        parameters = [Parameter(p.spin, p.parity, p.kind, p.channel,
+                                rank=p.rank) for p in
+                      self.azr.config.parameters]
+        azr = AZR('12C+p.azr', parameters=parameters)
+        self.assertTrue(np.array_equal(azr.config.constraints.check(thetas),
+                                       [True, False, False, False]))
+
+        with open('12C+p.azr') as f:
+            lines = f.read().split('\n')
+        k = lines.index('<levels>') + 1
+        row = lines[k].split()
+        row[CHANNEL_RADIUS_INDEX] = '0'
+        lines[k] = ' '.join(row)
+        with tempfile.NamedTemporaryFile('w', suffix='.azr', dir='.') as f:
+            f.write('\n'.join(lines))
+            f.flush()
+            with self.assertRaisesRegex(AssertionError, 'channel radius'):
+                AZR(f.name)
+
+
+    def test_shared_memory_executor(self):
+        '''
+        Tests predict_batch through SharedMemoryExecutor.
+
+        The values, successes and failures must match those of
+        evaluate_serial (for a batch with one point that AZURE2 cannot
+        compute), and no shared-memory block may be left after close().
+        '''
+        from multiprocessing import shared_memory
+
+        theta = np.array(self.azr.config.get_input_values())
+        failed = theta.copy()
+        failed[2] = np.nan
+        thetas = [theta, failed, 1.01*theta]
+        self.azr.validate = False
+        self.azr.verbose = False
+        serial = batch.evaluate_serial(self.azr, thetas)
+
+        executor = SharedMemoryExecutor(nprocs=2)
+        self.azr.executor = executor
+        try:
+            result = self.azr.predict_batch(thetas)
+            values = result.values.copy()
+            name = executor.block.name
+        finally:
+            executor.close()
+            self.azr.executor = None
+
+        self.assertTrue(np.array_equal(result.ok, [True, False, True]))
+        self.assertTrue(np.array_equal(result.ok, serial.ok))
+        self.assertTrue(np.array_equal(values, serial.values, equal_nan=True),
+                        msg='''
+Shared-memory executor test failed. The predictions do not match those
+evaluated serially.
+''')
+        self.assertTrue(result.errors[1] is not None)
+        self.assertIs(executor.block, None)
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+    def test_autoscaling_executor(self):
+        '''
+        Tests predict_batch through AutoscalingExecutor.
+
+        The predictions made while probing and with the chosen configuration
+        must match those evaluated serially, report() must list every probed
+        candidate, and a drop in throughput must start a new probe.
+        '''
+        theta = np.array(self.azr.config.get_input_values())
+        thetas = [theta, 1.01*theta]
+        serial = batch.evaluate_serial(self.azr, thetas)
+
+        candidates = [(1, 1), (2, 1)]
+        executor = AutoscalingExecutor(candidates=candidates, window=1,
+                                       verbose=False)
+        self.azr.executor = executor
+        try:
+            for _ in range(3):
+                result = self.azr.predict_batch(thetas)
+                self.assertTrue(np.all(result.ok))
+                self.assertTrue(np.array_equal(result.values, serial.values),
+                                msg='''
+Autoscaling executor test failed. The predictions do not match those
+evaluated serially.
+''')
+            self.assertIn(executor.choice, candidates)
+            self.assertEqual(set(executor.measurements), set(candidates))
+            report = executor.report()
+            for (nprocs, omp_threads) in candidates:
+                self.assertIn(f'{nprocs} processes with '
+                              f'OMP_NUM_THREADS={omp_threads}:', report)
+            self.assertEqual([h[:2] for h in executor.history],
+                             candidates + [executor.choice])
+
+            # No batch can keep up with an infinite baseline.
+            executor.baseline = np.inf
+            self.azr.predict_batch(thetas)
+            self.assertEqual(executor.queue, candidates)
+            self.assertEqual(executor.measurements, {})
+        finally:
+            executor.close()
+            self.azr.executor = None
+
+
+    def test_broker_executor(self):
+        '''
+        Tests predict_batch through BrokerExecutor with three local workers.
+
+        One worker is killed while the batch is evaluated (each AZURE2 run
+        of the stand-in takes 0.3 s, see FAKE_AZURE2_DELAY). Its task must
+        be handed to another worker, and every prediction must match
+        predict. A batch whose tasks cannot be sent to any worker must fail
+        instead of waiting forever.
+        '''
+        theta = np.array(self.azr.config.get_input_values())
+        thetas = [(1 + 0.01*k)*theta for k in range(9)]
+        delay = os.environ.get('FAKE_AZURE2_DELAY')
+        os.environ['FAKE_AZURE2_DELAY'] = '0.3'
+
+        def kill_worker(executor):
+            # Once the first result is in, every worker holds a task.
+            while not executor.results:
+                time.sleep(0.01)
+            executor.processes[0].kill()
+
+        # The workspace of the killed worker is never removed (and its
+        # AZURE2 run may still write to it), so the directory is removed
+        # ignoring errors.
+        directory = tempfile.mkdtemp()
+        self.azr.root_directory = directory + '/'
+        executor = BrokerExecutor(('127.0.0.1', 0))
+        self.azr.executor = executor
+        try:
+            executor.spawn_local_workers(3)
+            killer = threading.Thread(target=kill_worker, args=(executor,),
+                                      daemon=True)
+            killer.start()
+            result = self.azr.predict_batch(thetas)
+            killer.join()
+        finally:
+            executor.close()
+            self.azr.executor = None
+            if delay is None:
+                del os.environ['FAKE_AZURE2_DELAY']
+            else:
+                os.environ['FAKE_AZURE2_DELAY'] = delay
+
+        try:
+            self.assertTrue(executor.retries > 0, msg='''
+Broker executor test failed. No task was handed to another worker.
+''')
+            self.assertTrue(np.all(result.ok), msg=f'''
+Broker executor test failed. Errors: {result.errors}
+''')
+            for (k, theta) in enumerate(thetas):
+                mu = np.vstack(self.azr.predict(theta, dress_up=False))
+                self.assertTrue(np.array_equal(result.values[k], mu), msg=f'''
+Broker executor test failed. Prediction {k} does not match predict.
+''')
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        # A task that fails in the broker (the AZR object cannot be pickled)
+        # fails its theta. The workers are dropped, and the rest of the batch
+        # fails once none has been connected for heartbeat_timeout seconds.
+        self.azr.root_directory = ''
+        self.azr.unpicklable = lambda: None
+        with BrokerExecutor(('127.0.0.1', 0), heartbeat_timeout=2) as executor:
+            executor.spawn_local_workers(2)
+            self.azr.executor = executor
+            try:
+                result = self.azr.predict_batch(thetas[:4])
+            finally:
+                self.azr.executor = None
+        self.assertFalse(np.any(result.ok))
+        self.assertTrue(any('pickle' in error.lower() for error in
+                            result.errors), msg=f'''
+Broker executor test failed. Errors: {result.errors}
+''')
+        self.assertTrue(any('No worker' in error for error in result.errors))
+
 if __name__ == 'main':
     unittest.main()